@@ -1,19 +1,50 @@
 #!/usr/bin/env python
 from __future__ import print_function
+from contextlib import contextmanager
 from datetime import datetime
+from array import array
 from shutil import copy2
+from shutil import copyfile
 from shutil import rmtree
 import traceback
 import signal
+import functools
+import glob
+import multiprocessing
 import time
 import optparse
 import math
+import hashlib
+import json
+import mmap
 import os
 import pickle
 import sys
 import subprocess as sub
+import tempfile
+import threading
 import re
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+try:
+    from time import monotonic
+except ImportError:  # python 2
+    from time import time as monotonic
+
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
 """
     Requirements: Python 2.6 or higher or Python 3.x
                   Antechamber (from AmberTools preferably)
@@ -103,6 +134,13 @@ minDist = 0.5
 maxDist2 = maxDist ** 2  # squared Ang.
 minDist2 = minDist ** 2  # squared Ang.
 diffTol = 0.01
+killGrace = 5  # sec. between SIGTERM and SIGKILL to a timed out process group
+
+parseCacheMaxSize = 2 * 1024 ** 3  # bytes of decoded prmtops kept by PrmtopCache
+prmtopCacheVersion = 2  # part of the PrmtopCache keys, bump it when decodeSection changes
+resultCacheMaxSize = 1024 ** 3  # bytes of antechamber/parmchk outputs kept by ResultCache
+parmCacheMaxSize = 256 * 1024 ** 2  # bytes of merged parm files kept by parmMerge
+memProfileTop = 5  # allocation sites reported per stage with '--memprofile'
 
 dictAmbAtomType2AmbGmxCode = \
     {'BR': '1', 'C': '2', 'CA': '3', 'CB': '4', 'CC': '5', 'CK': '6', 'CM': '7', 'CN': '8', 'CQ': '9',
@@ -248,9 +286,6 @@ a2oD = {'amber99_2': ['opls_235', 'opls_271'],
         'amber99_48': ['opls_200'],
         }
 
-global pid
-pid = 0
-
 head = "%s created by acpype (Rev: " + svnRev + ") on %s\n"
 
 date = datetime.now().ctime()
@@ -258,7 +293,8 @@ date = datetime.now().ctime()
 usage = \
     """
     acpype -i _file_ [-c _string_] [-n _int_] [-m _int_] [-a _string_] [-f] etc. or
-    acpype -p _prmtop_ -x _inpcrd_ [-d]"""
+    acpype -p _prmtop_ -x _inpcrd_ [-d] or
+    acpype --batch _inputs_ [--jobs _int_] [-c _string_] etc."""
 
 epilog = \
     """
@@ -343,6 +379,67 @@ def imprDihAngle(a, b, c, d):
     return angle
 
 
+def imprDihAngles(quads):
+    '''
+        imprDihAngle of many quads at once: quads is a (..., 4, 3) sequence
+        of a, b, c, d coordinates, e.g. (K, 4, 3) for K chiral centres or
+        (conformers, K, 4, 3). Vectorized with numpy (a float array of the
+        leading shape is returned), nested lists of the same shape from
+        imprDihAngle otherwise
+    '''
+    if np is None:
+        quads = list(quads)
+        if not quads:
+            return []
+        if not hasattr(quads[0][0], '__len__'):  # down to a single quad
+            return imprDihAngle(*quads)
+        return [imprDihAngles(sub) for sub in quads]
+    q = np.asarray(quads, dtype=np.float64)
+    if not len(q):
+        return np.zeros(0)
+    b = q[..., 1, :]
+    c = q[..., 2, :]
+    bc = c - b
+    n1 = np.cross(q[..., 0, :] - b, bc)
+    n2 = np.cross(b - c, q[..., 3, :] - c)
+    cos = np.einsum('...i,...i', n1, n2) / (np.linalg.norm(n1, axis=-1) * np.linalg.norm(n2, axis=-1))
+    angle = np.arccos(np.clip(cos, -1.0, 1.0)) * 180 / Pi
+    sign = np.einsum('...i,...i', np.cross(n1, n2), bc)
+    return np.where(sign < 0, -angle, angle)
+
+
+def findClosePairs(points, cutoff):
+    """
+        Pairs of points closer than cutoff, found with a cell list of cells
+        cutoff wide, so only points in neighbouring cells are compared.
+        points is a sequence of (x, y, z); returns [(i, j, dist2), ...] with
+        i < j, sorted.
+    """
+    cutoff2 = cutoff * cutoff
+    cells = {}
+    for i, (x, y, z) in enumerate(points):
+        key = (int(math.floor(x / cutoff)), int(math.floor(y / cutoff)), int(math.floor(z / cutoff)))
+        cells.setdefault(key, []).append(i)
+    shifts = [(dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
+    pairs = []
+    for (cx, cy, cz), members in cells.items():
+        for dx, dy, dz in shifts:
+            others = cells.get((cx + dx, cy + dy, cz + dz))
+            if not others:
+                continue
+            for i in members:
+                xi, yi, zi = points[i]
+                for j in others:
+                    if j <= i:
+                        continue
+                    xj, yj, zj = points[j]
+                    dist2 = (xi - xj) ** 2 + (yi - yj) ** 2 + (zi - zj) ** 2
+                    if dist2 < cutoff2:
+                        pairs.append((i, j, dist2))
+    pairs.sort()
+    return pairs
+
+
 def invalidArgs(text=None):
     if text:
         print('ERROR: ' + text)
@@ -392,143 +489,211 @@ def elapsedTime(seconds, suffixes=['y', 'w', 'd', 'h', 'm', 's'], add_s=False, s
     return separator.join(time)
 
 
-def splitBlock(dat):
-    '''split a amber parm dat file in blocks
-       0 = mass, 1 = extra + bond, 2 = angle, 3 = dihedral, 4 = improp, 5 = hbond
-       6 = equiv nbon, 7 = nbon, 8 = END, 9 = etc.
-    '''
-    dict_ = {}
-    count = 0
-    for line in dat:
-        line = line.rstrip()
-        if count in dict_:
-            dict_[count].append(line)
-        else:
-            dict_[count] = [line]
-        if not line:
-            count += 1
-    return dict_
-
-
 def getParCode(line):
     key = line.replace(' -', '-').replace('- ', '-').split()[0]
     return key
 
 
-def parseFrcmod(lista):
-    heads = ['MASS', 'BOND', 'ANGL', 'DIHE', 'IMPR', 'HBON', 'NONB']
-    dict_ = {}
-    for line in lista[1:]:
-        line = line.strip()
-        if line[:4] in heads:
-            head = line[:4]
-            dict_[head] = []
-            dd = {}
-            continue
-        elif line:
-            key = line.replace(' -', '-').replace('- ', '-').split()[0]
-            if key in dd:
-                if not dd[key].count(line):
-                    dd[key].append(line)
-            else:
-                dd[key] = [line]
-            dict_[head] = dd
-    for k in dict_.keys():
-        if not dict_[k]:
-            dict_.pop(k)
-    return dict_
+class ParmLibrary(object):
+
+    """
+        Amber parameters of a leap parm .dat file, with frcmod files merged
+        into it. Each block keeps its entries (the lines of a parameter,
+        several for a multi term dihedral) in a dict keyed by the atom types
+        of the entry in canonical order, 'ca-c3' and 'c3-ca' being the same
+        bond, so merge, override and lookup are hash based. Improper keys are
+        not reversed, their third atom being the central one.
+        write gives back the leap .dat text.
+    """
+
+    blockNames = ('MASS', 'BOND', 'ANGL', 'DIHE', 'IMPR', 'HBON', 'EQUI', 'NONB')
+    numTypes = {'BOND': 2, 'ANGL': 3, 'DIHE': 4, 'IMPR': 4, 'HBON': 2}
+
+    def __init__(self, title=''):
+        self.title = title
+        self.hydrophilic = []  # atom types of the line before the bonds
+        self.nonbHeader = 'MOD4      RE'
+        self.tail = []  # END and whatever follows the nonbonded block
+        self.order = dict([(block, []) for block in self.blockNames])
+        self.entries = dict([(block, {}) for block in self.blockNames])
+
+    def getKey(self, block, types):
+        """Canonical key for the atom types (a tuple) of an entry of block"""
+        if block in ('BOND', 'ANGL', 'DIHE', 'HBON'):
+            return min(types, types[::-1])
+        return types
+
+    def getLineKey(self, block, line):
+        """Canonical key of a .dat or frcmod line of block"""
+        num = self.numTypes.get(block)
+        if not num:
+            return tuple(line.split()[:1])
+        if block == 'HBON':
+            types = line.split()[:2]
+        else:
+            types = getParCode(line).split('-')
+            if len(types) != num:  # e.g. a '-' in a type name, use leap columns
+                types = line[:3 * num - 1].split('-')
+        return self.getKey(block, tuple([t.strip() for t in types]))
+
+    def addEntry(self, block, key, lines, override=False):
+        """Set the lines of key in block; an existing entry is kept unless override"""
+        entries = self.entries[block]
+        if key not in entries:
+            self.order[block].append(key)
+        elif not override:
+            return
+        entries[key] = lines
+
+    def addLines(self, block, lines, override=False):
+        """Add the .dat lines of block; consecutive lines with the same key
+           (terms of a dihedral) make one entry"""
+        entries = {}
+        order = []
+        lastKey = None
+        for line in lines:
+            key = self.getLineKey(block, line)
+            if key not in entries:
+                order.append(key)
+                entries[key] = [line]
+            elif key == lastKey or override:  # frcmod entries may come apart
+                if line not in entries[key]:
+                    entries[key].append(line)
+            lastKey = key
+        for key in order:
+            self.addEntry(block, key, entries[key], override)
+
+    def merge(self, other, override=False):
+        """Add the entries of other ParmLibrary, replacing ours if override"""
+        for block in self.blockNames:
+            for key in other.order[block]:
+                self.addEntry(block, key, other.entries[block][key], override)
+        for atomType in other.hydrophilic:
+            if atomType not in self.hydrophilic:
+                self.hydrophilic.append(atomType)
+        if '' in other.tail:  # skip its END
+            self.tail += other.tail[other.tail.index('') + 1:]
+
+    def getEntry(self, block, types):
+        """Lines of the entry of block for the atom types given (a tuple),
+           trying the 'X' wildcards of leap for dihedrals; None if not found"""
+        entries = self.entries[block]
+        lines = entries.get(self.getKey(block, tuple(types)))
+        if lines is None and block == 'DIHE':
+            lines = entries.get(self.getKey(block, ('X', types[1], types[2], 'X')))
+        elif lines is None and block == 'IMPR':
+            lines = entries.get(('X', types[1], types[2], types[3])) or \
+                entries.get(('X', 'X', types[2], types[3]))
+        return lines
+
+    def write(self, datFile):
+        """Write the leap parm .dat text to datFile"""
+        text = [self.title]
+        for block in self.blockNames:
+            if block == 'BOND':
+                text.append(''.join(['%-4s' % t for t in self.hydrophilic]).rstrip())
+            elif block == 'NONB':
+                text.append(self.nonbHeader)
+            for key in self.order[block]:
+                text += self.entries[block][key]
+            text.append('')
+        text += self.tail
+        datFile.write('\n'.join(text) + '\n')
+
+
+def readParmDat(fileName):
+    '''ParmLibrary of a leap parm .dat file'''
+    lines = [line.rstrip() for line in open(fileName)]
+    lib = ParmLibrary(lines and lines[0] or '')
+    pos = 1
+
+    def readBlock():
+        end = pos
+        while end < len(lines) and lines[end]:
+            end += 1
+        return lines[pos:end], end + 1
+
+    for block in lib.blockNames:
+        chunk, pos = readBlock()
+        if block == 'BOND':
+            while chunk and '-' not in chunk[0]:
+                lib.hydrophilic += chunk.pop(0).split()
+        elif block == 'NONB' and chunk:
+            lib.nonbHeader = chunk.pop(0)
+        lib.addLines(block, chunk)
+    lib.tail = lines[pos:]
+    return lib
+
+
+def readFrcmod(fileName):
+    '''ParmLibrary of a frcmod file'''
+    lines = [line.rstrip() for line in open(fileName)]
+    lib = ParmLibrary(lines and lines[0] or '')
+    chunks = {}
+    block = None
+    for line in lines[1:]:
+        head = line.strip()[:4]
+        if head in lib.blockNames or head in ('CMAP', 'IPOL'):
+            block = head
+            chunks[block] = []
+        elif line.strip() and block:
+            chunks[block].append(line)
+    for block in lib.blockNames:
+        lib.addLines(block, chunks.get(block, []), override=True)
+    return lib
 
 
 def parmMerge(fdat1, fdat2, frcmod=False):
-    '''merge two amber parm dat/frcmod files and save in /tmp'''
-    name1 = os.path.basename(fdat1).split('.dat')[0]
+    '''merge two amber parm dat/frcmod files; the result is kept in the
+       per-user cache, keyed by the content of both files, and reused while
+       they are unchanged (also when fdat1 is itself a cached merge)'''
+    # a merged file from the cache is named <name>_<key>.dat
+    name1 = re.sub('_[0-9a-f]{40}$', '', os.path.basename(fdat1).split('.dat')[0])
     if frcmod:
         name2 = os.path.basename(fdat2).split('.')[1]
     else:
         name2 = os.path.basename(fdat2).split('.dat')[0]
-    mname = '/tmp/' + name1 + name2 + '.dat'
-    mdatFile = open(mname, 'w')
-    mdat = ['merged %s %s' % (name1, name2)]
-
-    # if os.path.exists(mname): return mname
-    dat1 = splitBlock(open(fdat1).readlines())
-
-    if frcmod:
-        dHeads = {'MASS': 0, 'BOND': 1, 'ANGL': 2, 'DIHE': 3, 'IMPR': 4, 'HBON': 5, 'NONB': 7}
-        dat2 = parseFrcmod(open(fdat2).readlines())  # dict
-        for k in dat2:
-            for parEntry in dat2[k]:
-                idFirst = None
-                for line in dat1[dHeads[k]][:]:
-                    if line:
-                        key = line.replace(' -', '-').replace('- ', '-').split()[0]
-                        if key == parEntry:
-                            if not idFirst:
-                                idFirst = dat1[dHeads[k]].index(line)
-                            dat1[dHeads[k]].remove(line)
-                rev = dat2[k][parEntry][:]
-                rev.reverse()
-                if idFirst is None:
-                    idFirst = 0
-                for ll in rev:
-                    if dHeads[k] in [0, 1, 7]:  # MASS has title in index 0 and so BOND, NONB
-                        dat1[dHeads[k]].insert(idFirst + 1, ll)
-                    else:
-                        dat1[dHeads[k]].insert(idFirst, ll)
-        dat1[0][0] = mdat[0]
-        for k in dat1:
-            for line in dat1[k]:
-                mdatFile.write(line + '\n')
+    cacheDir = getCacheDir('parm')
+    key = hashlib.sha1(repr(frcmod).encode())
+    for fdat in (fdat1, fdat2):
+        key.update(('%s\n' % fileHash(fdat)).encode())
+    mname = os.path.join(cacheDir, '%s%s_%s.dat' % (name1, name2, key.hexdigest()))
+    if os.path.exists(mname):
+        markCacheUse(mname)
         return mname
+    # written aside and renamed, so concurrent runs never see it half written
+    fd, tmpName = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=cacheDir)
+    try:
+        mdatFile = os.fdopen(fd, 'w')
+        try:
+            writeParmMerge(mdatFile, fdat1, fdat2, frcmod, 'merged %s %s' % (name1, name2))
+        finally:
+            mdatFile.close()
+        os.rename(tmpName, mname)
+    except:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        raise
+    pruneCache(cacheDir, parmCacheMaxSize)
+    return mname
 
-    dat2 = splitBlock(open(fdat2).readlines())
-    for k in dat1.keys()[:8]:
-        if k == 0:
-            lines = dat1[k][1:-1] + dat2[k][1:-1] + ['']
-            for line in lines:
-                mdat.append(line)
-        if k == 1:
-            for i in dat1[k]:
-                if '-' in i:
-                    id1 = dat1[k].index(i)
-                    break
-            for j in dat2[k]:
-                if '-' in j:
-                    id2 = dat2[k].index(j)
-                    break
-            l1 = dat1[k][:id1]
-            l2 = dat2[k][:id2]
-            line = ''
-            for item in l1 + l2:
-                line += item.strip() + ' '
-            mdat.append(line)
-            lines = dat1[k][id1:-1] + dat2[k][id2:-1] + ['']
-            for line in lines:
-                mdat.append(line)
-        if k in [2, 3, 4, 5, 6]:  # angles, p dih, imp dih
-            lines = dat1[k][:-1] + dat2[k][:-1] + ['']
-            for line in lines:
-                mdat.append(line)
-        if k == 7:
-            lines = dat1[k][:-1] + dat2[k][1:-1] + ['']
-            for line in lines:
-                mdat.append(line)
-    for k in dat1.keys()[8:]:
-        for line in dat1[k]:
-            mdat.append(line)
-    for k in dat2.keys()[9:]:
-        for line in dat2[k]:
-            mdat.append(line)
-    for line in mdat:
-        mdatFile.write(line + '\n')
-    mdatFile.close()
 
-    return mname
+def writeParmMerge(mdatFile, fdat1, fdat2, frcmod, title):
+    '''write to mdatFile the merge of two amber parm dat/frcmod files;
+       frcmod entries replace those of fdat1'''
+    lib = readParmDat(fdat1)
+    if frcmod:
+        lib.merge(readFrcmod(fdat2), override=True)
+    else:
+        lib.merge(readParmDat(fdat2))
+    lib.title = title
+    lib.write(mdatFile)
 
 
-def _getoutput(cmd):
-    '''to simulate commands.getoutput in order to work with python 2.6 up to 3.x'''
-    out = sub.Popen(cmd, shell=True, stderr=sub.STDOUT, stdout=sub.PIPE).communicate()[0][:-1]
+def _getoutput(cmd, cwd=None):
+    '''to simulate commands.getoutput in order to work with python 2.6 up to 3.x;
+       cmd runs in dir cwd if given'''
+    out = sub.Popen(cmd, shell=True, cwd=cwd, stderr=sub.STDOUT, stdout=sub.PIPE).communicate()[0][:-1]
     try:
         o = str(out.decode())
     except:
@@ -536,6 +701,572 @@ def _getoutput(cmd):
     return o
 
 
+def readMol2Atoms(fileName):
+    '''atoms of the first molecule in a mol2 file, as a list of
+       (atomName, resName, (x, y, z), charge); charge is 0.0 if not given'''
+    atoms = []
+    section = None
+    with open(fileName, 'r') as f:
+        for line in f:
+            if line.startswith('@<TRIPOS>'):
+                section = line[9:].strip()
+                if section == 'MOLECULE' and atoms:
+                    break
+                continue
+            cols = line.split()
+            if section != 'ATOM' or not cols or cols[0].startswith('#'):
+                continue
+            resName = len(cols) > 7 and cols[7] or 'MOL'
+            charge = len(cols) > 8 and float(cols[8]) or 0.0
+            atoms.append((cols[1], resName, tuple(map(float, cols[2:5])), charge))
+    return atoms
+
+
+def readMdlAtoms(fileName):
+    '''atoms of the first record in a MDL mol/sdf file (V2000 or V3000), as
+       in readMol2Atoms; atoms are named element + count, as antechamber
+       does, residue is 'MOL' and charge is the formal charge'''
+    with open(fileName, 'r') as f:
+        lines = f.read().split('\n')
+    atoms = []
+    elements = {}
+
+    def addAtom(element, xyz, charge):
+        elements[element] = elements.get(element, 0) + 1
+        atoms.append(('%s%i' % (element, elements[element]), 'MOL', xyz, float(charge)))
+
+    if lines[3][34:39].strip() == 'V3000':
+        inAtoms = False
+        for line in lines[4:]:
+            if line.startswith('M  V30 BEGIN ATOM'):
+                inAtoms = True
+            elif line.startswith('M  V30 END ATOM') or line.startswith('M  END'):
+                break
+            elif inAtoms:
+                cols = line.split()
+                charge = 0
+                for col in cols[8:]:
+                    if col.startswith('CHG='):
+                        charge = int(col[4:])
+                addAtom(cols[3], tuple(map(float, cols[4:7])), charge)
+        return atoms
+    chargeCodes = {1: 3, 2: 2, 3: 1, 5: -1, 6: -2, 7: -3}
+    numAtoms = int(lines[3][0:3])
+    for line in lines[4:4 + numAtoms]:
+        code = line[36:39].strip()
+        addAtom(line[31:34].strip(), (float(line[0:10]), float(line[10:20]), float(line[20:30])),
+                chargeCodes.get(int(code or 0), 0))
+    charges = {}
+    for line in lines[4 + numAtoms:]:
+        if line.startswith('M  CHG'):  # supersedes the charge codes of the atom block
+            vals = list(map(int, line[6:].split()))[1:]
+            charges.update(zip(vals[0::2], vals[1::2]))
+        elif line.startswith('M  END'):
+            break
+    if charges:
+        atoms = [(name, res, xyz, float(charges.get(i + 1, 0)))
+                 for i, (name, res, xyz, _charge) in enumerate(atoms)]
+    return atoms
+
+
+def readPdbAtoms(fileName):
+    '''ATOM and HETATM records of a pdb file, as in readMol2Atoms,
+       with charge 0.0'''
+    atoms = []
+    with open(fileName, 'r') as f:
+        for line in f:
+            if line.startswith('ATOM  ') or line.startswith('HETATM'):
+                atoms.append((line[12:16].strip(), line[17:20].strip(),
+                              (float(line[30:38]), float(line[38:46]), float(line[46:54])), 0.0))
+    return atoms
+
+
+def readInputAtoms(fileName):
+    '''atoms of an acpype input file (pdb, mol2, mdl, mol or sdf) without
+       calling antechamber, as in readMol2Atoms'''
+    ext = os.path.splitext(fileName)[1].lower()
+    if ext == '.mol2':
+        return readMol2Atoms(fileName)
+    if ext in ('.mdl', '.mol', '.sdf'):
+        return readMdlAtoms(fileName)
+    if ext == '.pdb':
+        return readPdbAtoms(fileName)
+    raise Exception("cannot read atoms from '%s', unknown extension" % fileName)
+
+
+def mapFile(fileName):
+    '''read-only memory map of a file, None if the file is empty'''
+    if os.path.getsize(fileName) == 0:
+        return None
+    f = open(fileName, 'rb')
+    try:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+
+def getCacheDir(name):
+    '''per-user acpype cache sub dir ($ACPYPE_CACHE_DIR or ~/.cache/acpype), created if needed'''
+    root = os.environ.get('ACPYPE_CACHE_DIR')
+    if not root:
+        root = os.path.join(os.environ.get('XDG_CACHE_HOME') or
+                            os.path.join(os.path.expanduser('~'), '.cache'), 'acpype')
+    path = os.path.join(root, name)
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+    return path
+
+
+def fileHash(fileName, blockSize=1 << 20):
+    '''sha1 hex digest of a file content, read in blocks'''
+    sha = hashlib.sha1()
+    f = open(fileName, 'rb')
+    try:
+        block = f.read(blockSize)
+        while block:
+            sha.update(block)
+            block = f.read(blockSize)
+    finally:
+        f.close()
+    return sha.hexdigest()
+
+
+def exeStamp(exe):
+    '''real path, size and mtime of an executable, standing for its version
+       in cache keys; a new build or install of it gives a new stamp'''
+    path = os.path.realpath(exe)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return path
+    return '%s:%i:%i' % (path, st.st_size, int(st.st_mtime))
+
+
+def markCacheUse(path):
+    '''set the atime of a cache entry to now, keeping its mtime, which may
+       be part of the key of what is made from it'''
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+    except OSError:  # removed meanwhile by another process
+        pass
+
+
+def pruneCache(cacheDir, maxSize):
+    '''remove least recently used entries (by atime, see markCacheUse) until
+       cacheDir holds at most maxSize bytes'''
+    entries = []
+    for name in os.listdir(cacheDir):
+        if name.startswith('.'):  # temporary files being written
+            continue
+        path = os.path.join(cacheDir, name)
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        entries.append((st.st_atime, st.st_size, path))
+    total = sum([e[1] for e in entries])
+    entries.sort()
+    for atime, size, path in entries:
+        if total <= maxSize:
+            break
+        try:
+            os.remove(path)
+        except OSError:  # already removed by another process
+            pass
+        total -= size
+
+
+def decodeInpcrd(buf):
+    """
+        Decode an AMBER inpcrd or restart file given as bytes or mmap.
+        Returns (coords, velocities, box), where coords and velocities are
+        flat sequences x1, y1, z1, x2, ... in the file units; with numpy they
+        are views sharing one float64 buffer, otherwise stdlib arrays.
+        velocities is None for a plain inpcrd and box is
+        [[a, b, c], [alpha, beta, gamma]] or None. After the coordinates
+        only n3 velocities and/or 6 box values are accepted, velocities
+        taken first (so for 2 atoms 6 more values are velocities).
+    """
+    end1 = buf.find(b'\n')
+    end2 = buf.find(b'\n', end1 + 1)
+    try:
+        natoms = int(buf[end1 + 1:end2].split()[0])
+    except (IndexError, ValueError):
+        raise Exception("INPCRD file empty?")
+    lines = [line.rstrip() for line in buf[end2 + 1:].splitlines()]  # trailing blanks are fine
+    for line in lines:
+        if len(line) % 12:
+            raise Exception("INPCRD fields are not 12 characters wide")
+    if np is not None:
+        values = np.frombuffer(b''.join(lines), dtype='S12').astype(np.float64)
+    else:
+        values = array('d')
+        for line in lines:
+            values.extend([float(line[i:i + 12]) for i in range(0, len(line), 12)])
+    n3 = 3 * natoms
+    rest = len(values) - n3
+    velocities = None
+    box = None
+    if rest in (n3, n3 + 6):  # restart file with velocities
+        velocities = values[n3:2 * n3]
+        rest -= n3
+    elif rest not in (0, 6):
+        raise Exception("INPCRD has %i values for %i atoms" % (len(values), natoms))
+    if rest == 6:
+        box = [[float(x) for x in values[-6:-3]], [float(x) for x in values[-3:]]]
+    return values[:n3], velocities, box
+
+
+def scaleCoords(coords, factor):
+    '''flat coords times factor, in a single multiply when numpy is available'''
+    if np is not None:
+        return np.asarray(coords) * factor
+    return array('d', [c * factor for c in coords])
+
+
+def parseFormatWidth(fmt):
+    '''field width of a prmtop %FORMAT spec, e.g. 10I8 -> 8, 5E16.8 -> 16'''
+    fmt = fmt.strip().strip('%FORMAT()').split('.')[0]
+    for c in fmt:
+        if c.isalpha():
+            return int(fmt.split(c)[1])
+    raise Exception("Unknown prmtop format '%s'" % fmt)
+
+
+def decodeSection(flag, data, width):
+    '''split a fixed-width prmtop data block and convert it to floats, ints or strings'''
+    sdata = [data[i:i + width].strip() for i in range(0, len(data), width)]
+    if '.' in data:  # it's a float
+        ndata = list(map(float, sdata))
+    elif flag != 'RESIDUE_LABEL':
+        try:  # try if it's integer
+            ndata = list(map(int, sdata))
+        except:  # it's string
+            ndata = sdata
+    else:
+        ndata = sdata
+    return ndata
+
+
+class PrmtopReader(object):
+
+    """
+        Index of prmtop lines built in a single pass: for every %FLAG it keeps
+        the field width given by %FORMAT and the range of its data lines.
+        Sections are only decoded when asked for with getSection(flag).
+    """
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.sections = {}  # flag: (width, firstLine, lastLine)
+        flag = None
+        width = None
+        first = None
+        for i, line in enumerate(lines):
+            if line[:1] != '%':
+                continue
+            if line.startswith('%FLAG '):
+                if flag is not None:
+                    self.sections[flag] = (width, first, i)
+                flag = line[6:].strip()
+                width = None
+                first = i + 1
+            elif line.startswith('%FORMAT') and flag is not None:
+                width = parseFormatWidth(line)
+                first = i + 1
+        if flag is not None:
+            self.sections[flag] = (width, first, len(lines))
+
+    def hasSection(self, flag):
+        return flag in self.sections
+
+    def getSectionLines(self, flag):
+        width, first, last = self.sections[flag]
+        return self.lines[first:last]
+
+    def getSection(self, flag):
+        """
+            Decode the data block of a given flag; returns [] if flag is absent
+        """
+        if flag not in self.sections:
+            return []
+        data = ''.join([line.rstrip('\r\n') for line in self.getSectionLines(flag)
+                        if not line.startswith('%COMMENT')])
+        return decodeSection(flag, data, self.sections[flag][0])
+
+
+class MmapPrmtopReader(PrmtopReader):
+
+    """
+        PrmtopReader over a read-only memory map of the prmtop file. The index
+        holds byte offsets and only the section asked for is copied out of the
+        map, so the whole file is never held as Python strings.
+    """
+
+    flagPattern = re.compile(b'^%(FLAG|FORMAT)([^\n]*)', re.M)
+
+    def __init__(self, fileName):
+        self.lines = None
+        self.fileName = os.path.abspath(fileName)
+        self.buf = None
+        self.sections = {}  # flag: (width, firstByte, lastByte)
+        buf = self.getBuffer()
+        flag = None
+        width = None
+        first = None
+        for match in self.flagPattern.finditer(buf):
+            if match.group(1) == b'FLAG':
+                if flag is not None:
+                    self.sections[flag] = (width, first, match.start())
+                flag = match.group(2).strip().decode('ascii')
+                width = None
+            elif flag is not None:
+                width = parseFormatWidth(match.group(2).decode('ascii'))
+            first = match.end() + 1
+        if flag is not None:
+            self.sections[flag] = (width, first, len(buf))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['buf'] = None  # mmap objects can't be pickled, map again on demand
+        return state
+
+    def getBuffer(self):
+        if self.buf is None:
+            self.buf = mapFile(self.fileName)
+            if self.buf is None:
+                raise Exception("PRMTOP file empty?")
+        return self.buf
+
+    def getSectionLines(self, flag):
+        width, first, last = self.sections[flag]
+        return self.getBuffer()[first:last].decode('ascii').splitlines()
+
+
+class CachedPrmtopReader(PrmtopReader):
+
+    """
+        PrmtopReader keeping each decoded section in a PrmtopCache entry of
+        its own. A section is decoded from the prmtop, by the reader that
+        makeReader returns, the first time it is asked for and loaded from
+        the cache afterwards; the prmtop itself is only read on a miss.
+    """
+
+    def __init__(self, cache, key, makeReader):
+        self.lines = None
+        self.cache = cache
+        self.key = key
+        self.makeReader = makeReader
+        self.reader = None
+        flags = cache.load(key, 'sections')
+        if flags is None:
+            flags = list(self.getReader().sections)
+            cache.save(key, 'sections', flags)
+        self.sections = dict.fromkeys(flags)
+
+    def getReader(self):
+        if self.reader is None:
+            self.reader = self.makeReader()
+        return self.reader
+
+    def getSectionLines(self, flag):
+        return self.getReader().getSectionLines(flag)
+
+    def getSection(self, flag):
+        if flag not in self.sections:
+            return []
+        data = self.cache.load(self.key, flag)
+        if data is None:
+            data = self.getReader().getSection(flag)
+            try:
+                self.cache.save(self.key, flag, data)
+            except (IOError, OSError):  # e.g. disk full, it's only a cache
+                pass
+        return data
+
+
+class PrmtopCache(object):
+
+    """
+        On-disk cache of decoded prmtop sections, one pickle per section (and
+        one with the list of sections) keyed by the prmtop content and
+        prmtopCacheVersion. When the cache grows beyond maxSize bytes the
+        least recently used entries are removed.
+    """
+
+    def __init__(self, cacheDir=None, maxSize=parseCacheMaxSize):
+        self.cacheDir = cacheDir or getCacheDir('prmtop')
+        self.maxSize = maxSize
+
+    def getKey(self, fileName):
+        key = 'v%i:%s' % (prmtopCacheVersion, fileHash(fileName))
+        return hashlib.sha1(key.encode('ascii')).hexdigest()
+
+    def getPath(self, key, name):
+        return os.path.join(self.cacheDir, '%s_%s.pkl' % (key, re.sub(r'\W', '_', name)))
+
+    def load(self, key, name):
+        """
+            Data of entry name ('sections' or a flag) of key, None on a miss
+            or an unreadable entry
+        """
+        path = self.getPath(key, name)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                data = pickle.load(f)
+            except Exception:
+                return None
+        finally:
+            f.close()
+        markCacheUse(path)
+        return data
+
+    def save(self, key, name, data):
+        """
+            Store data as entry name of key; the file is written aside and
+            renamed, so concurrent runs never see it half written. A new
+            prmtop (name 'sections') prunes the cache
+        """
+        fd, tmpName = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=self.cacheDir)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(tmpName, self.getPath(key, name))
+        except:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+        if name == 'sections':
+            pruneCache(self.cacheDir, self.maxSize)
+
+
+class LazyAttribute(object):
+
+    """
+        Attribute computed on first access by the loader method of the
+        instance, which sets it (and possibly others) in the instance dict.
+        Being a non-data descriptor, the stored value takes over from then on
+        and can be reassigned as any plain attribute.
+    """
+
+    def __init__(self, name, loader):
+        self.name = name
+        self.loader = loader
+
+    def __get__(self, obj, objType=None):
+        if obj is None:
+            return self
+        getattr(obj, self.loader)()
+        return obj.__dict__[self.name]
+
+
+class ResultCache(object):
+
+    """
+        Per-user cache of files made by AmberTools programs, one file per
+        entry named by a key built from the normalised content of the input
+        file, the program that made it (see exeStamp) and every option that
+        changes the result, so the same job run
+        from any directory, with any basename, gets it back. Entries are
+        written aside and renamed into place, which is safe with many
+        concurrent runs, and the least recently used are removed once the
+        cache is larger than maxSize bytes.
+    """
+
+    def __init__(self, cacheDir=None, maxSize=resultCacheMaxSize):
+        self.cacheDir = cacheDir or getCacheDir('results')
+        self.maxSize = maxSize
+
+    def getKey(self, fileName, *options):
+        sha = hashlib.sha1()
+        f = open(fileName, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        for line in data.splitlines():  # ignore line ends and trailing blanks
+            sha.update(line.rstrip() + b'\n')
+        sha.update(repr(options).encode('utf-8'))
+        return sha.hexdigest()
+
+    def getPath(self, key, ext):
+        return os.path.join(self.cacheDir, key + ext)
+
+    def fetch(self, key, ext, fileName):
+        """
+            Copy the entry to fileName; False if there is no such entry
+        """
+        path = self.getPath(key, ext)
+        try:
+            copyfile(path, fileName)
+        except (IOError, OSError):
+            return False
+        markCacheUse(path)
+        return True
+
+    def store(self, key, ext, fileName):
+        fd, tmpName = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=self.cacheDir)
+        os.close(fd)
+        try:
+            copyfile(fileName, tmpName)
+            os.rename(tmpName, self.getPath(key, ext))
+        except:
+            if os.path.exists(tmpName):
+                os.remove(tmpName)
+            raise
+        pruneCache(self.cacheDir, self.maxSize)
+
+
+def getTopAllocations(snapshot1, snapshot2):
+    '''[[file:line, size diff, count diff], ...] of the memProfileTop
+       sites growing most from snapshot1 to snapshot2, leaving out the
+       allocations of tracemalloc itself and of the import machinery'''
+    filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+               tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+    snapshot1 = snapshot1.filter_traces(filters)
+    snapshot2 = snapshot2.filter_traces(filters)
+    diff = snapshot2.compare_to(snapshot1, 'lineno')
+    top = []
+    for stat in diff[:memProfileTop]:
+        frame = stat.traceback[0]
+        top.append(['%s:%i' % (os.path.basename(frame.filename), frame.lineno),
+                    stat.size_diff, stat.count_diff])
+    return top
+
+
+def timedStage(method):
+    '''decorator recording each call of method as a stage (see AbstractTopol.timeStage)'''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.timeStage(method.__name__) as stage:
+            result = method(self, *args, **kwargs)
+            if result is True:  # exec* methods return True when they fail
+                stage['ok'] = False
+            return result
+    return wrapper
+
+
+def getUsage():
+    '''(cpu, maxRss, childCpu, childMaxRss) of this process and of its
+       finished children, in sec. and KB; Nones without the resource module'''
+    if resource is None:
+        return None, None, None, None
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (own.ru_utime + own.ru_stime, own.ru_maxrss,
+            children.ru_utime + children.ru_stime, children.ru_maxrss)
+
+
 class AbstractTopol(object):
 
     """
@@ -546,6 +1277,11 @@ class AbstractTopol(object):
         if self.__class__ is AbstractTopol:
             raise TypeError("Attempt to create istance of abstract class AbstractTopol")
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('prmtopReader', None)  # made again from the prmtop if needed
+        return state
+
     def printDebug(self, text=''):
         if self.debug:
             print('DEBUG: %s' % text)
@@ -568,6 +1304,84 @@ class AbstractTopol(object):
             print(text)
             print(10 * '+' + 'end_quote' + 61 * '+')
 
+    @contextmanager
+    def timeStage(self, name):
+        """
+            Append to self.stages a record of the stage run in the with block:
+            start (sec. since the first stage), wall time, CPU time and max RSS
+            of this process and of its finished child processes (as
+            resource.getrusage). Stages nest, depth telling how deep. Own CPU
+            and RSS are for the whole process, so they mix the stages of
+            ACTopol objects run in threads of the same process.
+            While tracemalloc is tracing ('--memprofile') it also records the
+            traced memory at start and end, its peak within the stage and the
+            top allocation sites of the stage (see printMemProfile)
+        """
+        if getattr(self, 'stages', None) is None:
+            self.stages = []
+        if getattr(self, 'stagesStart', None) is None:
+            self.stagesStart = monotonic()
+        memProfile = tracemalloc is not None and tracemalloc.is_tracing()
+        if memProfile:
+            memStart = self.foldMemPeak()
+            snapshot = tracemalloc.take_snapshot()
+        depth = len([st for st in self.stages if 'wall' not in st])
+        stage = {'stage': name, 'depth': depth, 'start': round(monotonic() - self.stagesStart, 4)}
+        if memProfile:
+            stage.update(memStart=memStart, memPeak=memStart)
+        self.stages.append(stage)
+        t0 = monotonic()
+        cpu0, _rss, childCpu0, _childRss = getUsage()
+        ok = False
+        try:
+            yield stage
+            ok = True
+        finally:
+            if memProfile:
+                stage['memEnd'] = self.foldMemPeak()  # while the stage is still open
+            cpu, rss, childCpu, childRss = getUsage()
+            stage['wall'] = round(monotonic() - t0, 4)
+            stage.setdefault('ok', ok)
+            if cpu is not None:
+                stage.update(cpu=round(cpu - cpu0, 4), maxRss=rss,
+                             childCpu=round(childCpu - childCpu0, 4), childMaxRss=childRss)
+            if memProfile:
+                stage['memTop'] = getTopAllocations(snapshot, tracemalloc.take_snapshot())
+                del snapshot
+
+    def foldMemPeak(self):
+        """
+            Fold the tracemalloc peak since the last call into the open
+            stages and start a new peak; returns the traced memory now
+        """
+        current, peak = tracemalloc.get_traced_memory()
+        for stage in self.stages:
+            if 'wall' not in stage and 'memPeak' in stage:
+                stage['memPeak'] = max(stage['memPeak'], peak)
+        if hasattr(tracemalloc, 'reset_peak'):  # python 3.9
+            tracemalloc.reset_peak()
+        return current
+
+    def printMemProfile(self):
+        """
+            Print the memory recorded by timeStage for each stage, in MB:
+            traced at start and end, peak, and the top allocation sites
+        """
+        stages = [st for st in getattr(self, 'stages', None) or [] if 'memTop' in st]
+        if not stages:
+            return
+        mb = 1024.0 ** 2
+        print("==> Memory profile (tracemalloc, MB)")
+        print("%-40s %9s %9s %9s" % ('stage', 'start', 'end', 'peak'))
+        for stage in stages:
+            print("%-40s %9.1f %9.1f %9.1f" % ('  ' * stage['depth'] + stage['stage'],
+                                               stage['memStart'] / mb, stage['memEnd'] / mb,
+                                               stage['memPeak'] / mb))
+            for site, size, count in stage['memTop']:
+                print("%-40s %+9.1f MB in %+i blocks" % ('  ' * stage['depth'] + '    ' + site,
+                                                        size / mb, count))
+
+    @timedStage
     def guessCharge(self):
         """
             Guess the charge of a system based on antechamber
@@ -576,12 +1390,10 @@ class AbstractTopol(object):
         done = False
         error = False
         charge = self.chargeVal
-        localDir = os.path.abspath('.')
         if not os.path.exists(self.tmpDir):
             os.mkdir(self.tmpDir)
         if not os.path.exists(os.path.join(self.tmpDir, self.inputFile)):
             copy2(self.absInputFile, self.tmpDir)
-        os.chdir(self.tmpDir)
 
         if self.chargeType == 'user':
             if self.ext == '.mol2':
@@ -599,9 +1411,9 @@ class AbstractTopol(object):
                 cmd = '%s -ipdb %s -omol2 %s.mol2' % (self.babelExe, self.inputFile,
                                                       self.baseName)
                 self.printDebug("guessCharge: " + cmd)
-                out = _getoutput(cmd)
+                out = self.execTimed(cmd, cwd=self.tmpDir)
                 self.printDebug(out)
-                mol2FileForGuessCharge = os.path.abspath(self.baseName + ".mol2")
+                mol2FileForGuessCharge = os.path.join(self.tmpDir, self.baseName + ".mol2")
                 in_mol = 'mol2'
             else:
                 in_mol = self.ext[1:]
@@ -616,9 +1428,9 @@ class AbstractTopol(object):
                 cmd = cmd.replace('-pf y', '-pf n')
                 print(cmd)
 
-            log = _getoutput(cmd).strip()
+            log = self.execTimed(cmd, cwd=self.tmpDir).strip()
 
-            if os.path.exists('tmp'):
+            if os.path.exists(os.path.join(self.tmpDir, 'tmp')):
                 charge = self.readMol2TotalCharge('tmp')
             else:
                 try:
@@ -628,7 +1440,6 @@ class AbstractTopol(object):
 
             if error:
                 self.printError("guessCharge failed")
-                os.chdir(localDir)
                 self.printQuoted(log)
                 self.printMess("Trying with net charge = 0 ...")
 #                self.chargeVal = 0
@@ -643,50 +1454,28 @@ class AbstractTopol(object):
                 sys.exit(1)
         self.chargeVal = str(charge2)
         self.printMess("... charge set to %i" % charge2)
-        os.chdir(localDir)
 
+    @timedStage
     def setResNameCheckCoords(self):
         """Set a 3 letter residue name
            and check coords duplication
         """
         exit_ = False
-        localDir = os.path.abspath('.')
-        if not os.path.exists(self.tmpDir):
-            os.mkdir(self.tmpDir)
-        # if not os.path.exists(os.path.join(tmpDir, self.inputFile)):
-        copy2(self.absInputFile, self.tmpDir)
-        os.chdir(self.tmpDir)
-
-        exten = self.ext[1:]
-        if self.ext == '.pdb':
-            tmpFile = open(self.inputFile, 'r')
-        else:
-            if exten == 'mol':
-                exten = 'mdl'
-            cmd = '%s -i %s -fi %s -o tmp -fo ac -pf y' % \
-                (self.acExe, self.inputFile, exten)
-            self.printDebug(cmd)
-            out = _getoutput(cmd)
-            if not out.isspace():
-                self.printDebug(out)
-            try:
-                tmpFile = open('tmp', 'r')
-            except:
-                rmtree(self.tmpDir)
-                raise
+        try:
+            atoms = readInputAtoms(self.absInputFile)
+        except (IOError, ValueError, IndexError) as e:
+            raise Exception("cannot read input file '%s': %s" % (self.inputFile, e))
 
-        tmpData = tmpFile.readlines()
         residues = set()
         coords = {}
-        for line in tmpData:
-            if 'ATOM  ' in line or 'HETATM' in line:
-                residues.add(line[17:20])
-                at = line[0:17]
-                cs = line[30:54]
-                if cs in coords:
-                    coords[cs].append(at)
-                else:
-                    coords[cs] = [at]
+        for id_, (name, resName, xyz, _charge) in enumerate(atoms):
+            residues.add(resName[:3])  # as antechamber, e.g. ALA1, ALA2 -> ALA
+            at = 'ATOM%7i  %-4s' % (id_ + 1, name)
+            cs = '%8.3f%8.3f%8.3f' % xyz
+            if cs in coords:
+                coords[cs].append(at)
+            else:
+                coords[cs] = [at]
         # self.printDebug(coords)
 
         if len(residues) > 1:
@@ -697,32 +1486,23 @@ class AbstractTopol(object):
         dups = ""
         shortd = ""
         longd = ""
-        longSet = set()
-        id_ = 0
         items = list(coords.items())
-        l = len(items)
         for item in items:
-            id_ += 1
             if len(item[1]) > 1:  # if True means atoms with same coordinates
                 for i in item[1]:
                     dups += "%s %s\n" % (i, item[0])
 
-#        for i in xrange(0,len(data),f):
-#            fdata += (data[i:i+f])+' '
-
-            for id2 in range(id_, l):
-                item2 = items[id2]
-                c1 = list(map(float, [item[0][i:i + 8] for i in range(0, 24, 8)]))
-                c2 = list(map(float, [item2[0][i:i + 8] for i in range(0, 24, 8)]))
-                dist2 = self.distance(c1, c2)
-                if dist2 < minDist2:
-                    dist = math.sqrt(dist2)
-                    shortd += "%8.5f       %s %s\n" % (dist, item[1], item2[1])
-                if dist2 < maxDist2:  # and not longOK:
-                    longSet.add(str(item[1]))
-                    longSet.add(str(item2[1]))
-            if str(item[1]) not in longSet and l > 1:
-                longd += "%s\n" % item[1]
+        points = [tuple(map(float, [cs[i:i + 8] for i in range(0, 24, 8)])) for cs, ats in items]
+        hasNeighbour = [False] * len(items)
+        for id1, id2, dist2 in findClosePairs(points, maxDist):
+            if dist2 < minDist2:
+                dist = math.sqrt(dist2)
+                shortd += "%8.5f       %s %s\n" % (dist, items[id1][1], items[id2][1])
+            hasNeighbour[id1] = hasNeighbour[id2] = True
+        if len(items) > 1:
+            for item, near in zip(items, hasNeighbour):
+                if not near:
+                    longd += "%s\n" % item[1]
 
         if dups:
             self.printError("Atoms with same coordinates in '%s'!" % self.inputFile)
@@ -744,7 +1524,6 @@ class AbstractTopol(object):
                 self.printWarn("You chose to proceed anyway with '-f' option. GOOD LUCK!")
             else:
                 self.printError("Use '-f' option if you want to proceed anyway. Aborting ...")
-                rmtree(self.tmpDir)
                 sys.exit(1)
 
         resname = list(residues)[0].strip()
@@ -791,44 +1570,29 @@ class AbstractTopol(object):
 
         self.resName = newresname
 
-        os.chdir(localDir)
         self.printDebug("setResNameCheckCoords done")
 
     def distance(self, c1, c2):
         # print c1, c2
-        dist2 = (c1[0] - c2[0]) ** 2 + (c1[1] - c2[1]) ** 2 + (c1[0] - c2[0]) ** 2 + \
-                (c1[2] - c2[2]) ** 2
+        dist2 = (c1[0] - c2[0]) ** 2 + (c1[1] - c2[1]) ** 2 + (c1[2] - c2[2]) ** 2
         # dist2 = math.sqrt(dist2)
         return dist2
 
     def readMol2TotalCharge(self, mol2File):
-        """Reads the charges in given mol2 file and returns the total
+        """Reads the charges in given mol2 file (relative to tmpDir)
+           and returns the total
         """
         charge = 0.0
-        ll = []
-        cmd = '%s -i %s -fi mol2 -o tmp -fo mol2 -c wc -cf tmp.crg -pf y' % \
-            (self.acExe, mol2File)
-        if self.debug:
-            self.printMess("Debugging...")
-            cmd = cmd.replace('-pf y', '-pf n')
-
-        self.printDebug(cmd)
-
-        log = _getoutput(cmd)
-
-        if os.path.exists('tmp.crg'):
-            tmpFile = open('tmp.crg', 'r')
-            tmpData = tmpFile.readlines()
-            for line in tmpData:
-                ll += line.split()
-            charge = sum(map(float, ll))
-        if not log.isspace() and self.debug:
-            self.printQuoted(log)
+        try:
+            charge = sum([at[3] for at in readMol2Atoms(os.path.join(self.tmpDir, mol2File))])
+        except (IOError, ValueError, IndexError) as e:
+            self.printWarn("cannot read charges from '%s': %s" % (mol2File, e))
 
         self.printDebug("readMol2TotalCharge: " + str(charge))
 
         return charge
 
+    @timedStage
     def execAntechamber(self, chargeType=None, atomType=None):
         """ AmaberTools 1.3
             To call Antechamber and execute it
@@ -900,8 +1664,6 @@ Usage: antechamber -i  input file name
         Write out charge   wc       9  |  Delete Charge      dc     10
         ----------------------------------------------------------------
 a        """
-        global pid
-
         self.printMess("Executing Antechamber...")
 
         self.makeDir()
@@ -929,55 +1691,114 @@ a        """
 
         self.printDebug(cmd)
 
-        if os.path.exists(self.acMol2FileName) and not self.force:
+        acMol2File = self.homePath(self.acMol2FileName)
+
+        if self.acCache:
+            acKey = self.acCache.getKey(self.homePath(self.inputFile), exeStamp(self.acExe), exten, ct,
+                                        str(self.chargeVal), str(self.multiplicity),
+                                        self.qFlag, at, self.ekFlag)
+
+        if os.path.exists(acMol2File) and not self.force:
             self.printMess("AC output file present... doing nothing")
+        elif self.acCache and not self.force and \
+                self.acCache.fetch(acKey, '.mol2', acMol2File):
+            self.printMess("AC output file found in cache '%s'" % self.acCache.cacheDir)
+            self.acLog = ''
         else:
             try:
-                os.remove(self.acMol2FileName)
+                os.remove(acMol2File)
             except:
                 pass
-            signal.signal(signal.SIGALRM, self.signal_handler)
-            signal.alarm(self.timeTol)
-            p = sub.Popen(cmd, shell=True, stderr=sub.STDOUT, stdout=sub.PIPE)
-            pid = p.pid
-
-            out = str(p.communicate()[0].decode())  # p.stdout.read()
-            self.acLog = out
+            startTime = time.time()
+            self.acLog = self.execTimed(cmd)
+            self.setQmTime(startTime)
+            if self.acCache and os.path.exists(acMol2File):
+                try:
+                    self.acCache.store(acKey, '.mol2', acMol2File)
+                except (IOError, OSError) as e:
+                    self.printWarn("AC output file not cached: %s" % e)
 
-        if os.path.exists(self.acMol2FileName):
+        if os.path.exists(acMol2File):
             self.printMess("* Antechamber OK *")
         else:
             self.printQuoted(self.acLog)
             return True
 
-    def signal_handler(self, _signum, _frame):  # , pid = 0):
-        global pid
-        pids = self.job_pids_family(pid)
-        self.printDebug("PID: %s, PIDS: %s" % (pid, pids))
-        self.printMess("Timed out! Process %s killed, max exec time (%ss) exceeded"
-                       % (pids, self.timeTol))
-        # os.system('kill -15 %s' % pids)
-        for i in pids.split():
-            os.kill(int(i), 15)
-        raise Exception("Semi-QM taking too long to finish... aborting!")
-
-    def job_pids_family(self, jpid):
-        '''INTERNAL: Return all job processes (PIDs)'''
-        pid = repr(jpid)
-        dict_pids = {}
-        pids = [pid]
-        cmd = "ps -A -o uid,pid,ppid|grep %i" % os.getuid()
-        out = _getoutput(cmd).split('\n')  # getoutput("ps -A -o uid,pid,ppid|grep %i" % os.getuid()).split('\n')
-        for item in out:
-            vec = item.split()
-            dict_pids[vec[2]] = vec[1]
-        while 1:
+    def setQmTime(self, startTime):
+        """
+            Add to the running stage the wall time of the semi-QM program
+            antechamber ran since startTime (a time.time()), taken from the
+            mtimes of its input and output files
+        """
+        for qprog in ('sqm', 'mopac', 'divcon'):
+            qmIn = self.homePath('%s.in' % qprog)
+            qmOut = self.homePath('%s.out' % qprog)
+            if os.path.exists(qmIn) and os.path.exists(qmOut) and \
+                    os.path.getmtime(qmIn) >= int(startTime):
+                qmWall = max(0.0, os.path.getmtime(qmOut) - os.path.getmtime(qmIn))
+                for stage in reversed(self.stages):
+                    if 'wall' not in stage:
+                        stage['qprog'] = qprog
+                        stage['qmWall'] = round(qmWall, 4)
+                        break
+                return
+
+    def execTimed(self, cmd, cwd=None):
+        """
+            Run cmd in cwd (absHomeDir if not given), in a process group of
+            its own, and return its output. If the job deadline (timeTol
+            seconds from guessCharge on) passes, the whole group (e.g.
+            antechamber and the sqm it started) is sent SIGTERM and, if
+            still there killGrace seconds later, SIGKILL
+        """
+        tool = os.path.basename(cmd.split()[0])
+        deadline = self.deadline or monotonic() + self.timeTol
+        timeLeft = deadline - monotonic()
+        if timeLeft <= 0:
+            raise Exception("%s: Semi-QM taking too long to finish... aborting!" % tool)
+        if verList[0] == 3:
+            groupKw = dict(start_new_session=True)
+        else:
+            groupKw = dict(preexec_fn=os.setsid)
+        p = sub.Popen(cmd, shell=True, cwd=cwd or self.absHomeDir, stderr=sub.STDOUT,
+                      stdout=sub.PIPE, **groupKw)
+        timedOut = []
+
+        def killGroup(sig):
             try:
-                pid = dict_pids[pid]
-                pids.append(pid)
-            except KeyError:
-                break
-        return ' '.join(pids)
+                os.killpg(p.pid, sig)
+            except OSError:  # group already gone
+                return False
+            return True
+
+        def timeOut():
+            self.printMess("Timed out! %s (process group %s) terminated, max exec time (%ss) exceeded"
+                           % (tool, p.pid, self.timeTol))
+            timedOut.append(monotonic())
+            killGroup(signal.SIGTERM)
+
+        timers = [threading.Timer(timeLeft, timeOut),
+                  threading.Timer(timeLeft + killGrace, killGroup, [signal.SIGKILL])]
+        for timer in timers:
+            timer.daemon = True
+            timer.start()
+        try:
+            out = p.communicate()[0]
+        except BaseException:  # e.g. KeyboardInterrupt, leave no orphans behind
+            killGroup(signal.SIGKILL)
+            raise
+        finally:
+            for timer in timers:
+                timer.cancel()
+        if timedOut:
+            # the leader is gone, give the rest of the group (e.g. sqm) its grace too
+            while killGroup(0) and monotonic() < timedOut[0] + killGrace:
+                time.sleep(0.1)
+            if killGroup(signal.SIGKILL):
+                self.printDebug("%s (process group %s) still there %ss after SIGTERM, killed"
+                               % (tool, p.pid, killGrace))
+            raise Exception("%s: Semi-QM taking too long to finish... aborting!" % tool)
+        return str(out.decode())
 
     def delOutputFiles(self):
         delFiles = ['mopac.in', 'tleap.in', 'sleap.in', 'fixbo.log',
@@ -993,16 +1814,16 @@ a        """
                     os.remove(file_)
 
     def checkXyzAndTopFiles(self):
-        fileXyz = self.acXyzFileName
-        fileTop = self.acTopFileName
+        fileXyz = self.homePath(self.acXyzFileName)
+        fileTop = self.homePath(self.acTopFileName)
         if os.path.exists(fileXyz) and os.path.exists(fileTop):
             # self.acXyz = fileXyz
             # self.acTop = fileTop
             return True
         return False
 
+    @timedStage
     def execSleap(self):
-        global pid
         self.makeDir()
 
         if self.ext == '.mol2':
@@ -1019,7 +1840,7 @@ a        """
 
         sleapScpt = SLEAP_TEMPLATE % self.acParDict
 
-        fp = open('sleap.in', 'w')
+        fp = open(self.homePath('sleap.in'), 'w')
         fp.write(sleapScpt)
         fp.close()
 
@@ -1029,21 +1850,14 @@ a        """
             self.printMess("Topologies files already present... doing nothing")
         else:
             try:
-                os.remove(self.acTopFileName)
-                os.remove(self.acXyzFileName)
+                os.remove(self.homePath(self.acTopFileName))
+                os.remove(self.homePath(self.acXyzFileName))
             except:
                 pass
             self.printMess("Executing Sleap...")
             self.printDebug(cmd)
 
-            p = sub.Popen(cmd, shell=True, stderr=sub.STDOUT, stdout=sub.PIPE)
-            pid = p.pid
-            signal.signal(signal.SIGALRM, self.signal_handler)
-            signal.alarm(self.timeTol)
-
-            out = str(p.communicate()[0].decode())  # p.stdout.read()
-
-            self.sleapLog = out
+            self.sleapLog = self.execTimed(cmd)
             self.checkLeapLog(self.sleapLog)
 
             if self.checkXyzAndTopFiles():
@@ -1052,6 +1866,7 @@ a        """
                 self.printQuoted(self.sleapLog)
                 return True
 
+    @timedStage
     def execTleap(self):
 
         fail = False
@@ -1080,7 +1895,7 @@ a        """
 
         tleapScpt = TLEAP_TEMPLATE % self.acParDict
 
-        fp = open('tleap.in', 'w')
+        fp = open(self.homePath('tleap.in'), 'w')
         fp.write(tleapScpt)
         fp.close()
 
@@ -1090,13 +1905,13 @@ a        """
             self.printMess("Topologies files already present... doing nothing")
         else:
             try:
-                os.remove(self.acTopFileName)
-                os.remove(self.acXyzFileName)
+                os.remove(self.homePath(self.acTopFileName))
+                os.remove(self.homePath(self.acXyzFileName))
             except:
                 pass
             self.printMess("Executing Tleap...")
             self.printDebug(cmd)
-            self.tleapLog = _getoutput(cmd)
+            self.tleapLog = self.execTimed(cmd)
             self.checkLeapLog(self.tleapLog)
 
         if self.checkXyzAndTopFiles():
@@ -1132,12 +1947,14 @@ a        """
             return aFileF
         return None
 
+    @timedStage
     def execParmchk(self):
 
         self.makeDir()
         cmd = '%s -i %s -f mol2 -o %s' % (self.parmchkExe, self.acMol2FileName,
                                           self.acFrcmodFileName)
 
+        parmHash = None  # parm file given with '-p', a part of the cache key
         if self.atomType == 'amber':
             gaffFile = self.locateDat('gaff.dat')
             parm99file = self.locateDat('parm99.dat')
@@ -1149,12 +1966,30 @@ a        """
             # parm10file = self.locateDat('parm10.dat') # PARM99 + frcmod.ff99SB + frcmod.parmbsc0 in AmberTools 1.4
 
             cmd += ' -p %s' % parm99gaffff99SBFile  # Ignoring parm10.dat and BSC0
+            parmHash = fileHash(parm99gaffff99SBFile)
 
-        self.parmchkLog = _getoutput(cmd)
+        acMol2File = self.homePath(self.acMol2FileName)
+        acFrcmodFile = self.homePath(self.acFrcmodFileName)
+        if self.acCache and os.path.exists(acMol2File):
+            frcmodKey = self.acCache.getKey(acMol2File, exeStamp(self.parmchkExe), self.atomType,
+                                            parmHash)
+        else:
+            frcmodKey = None
+        if frcmodKey and not self.force and \
+                self.acCache.fetch(frcmodKey, '.frcmod', acFrcmodFile):
+            self.printMess("Parmchk output file found in cache '%s'" % self.acCache.cacheDir)
+            self.parmchkLog = ''
+        else:
+            self.parmchkLog = _getoutput(cmd, cwd=self.absHomeDir)
+            if frcmodKey and os.path.exists(acFrcmodFile):
+                try:
+                    self.acCache.store(frcmodKey, '.frcmod', acFrcmodFile)
+                except (IOError, OSError) as e:
+                    self.printWarn("Parmchk output file not cached: %s" % e)
 
         self.printDebug(cmd)
 
-        if os.path.exists(self.acFrcmodFileName):
+        if os.path.exists(acFrcmodFile):
             check = self.checkFrcmod()
             if check:
                 self.printWarn("Couldn't determine all parameters:")
@@ -1167,7 +2002,7 @@ a        """
 
     def checkFrcmod(self):
         check = ""
-        frcmodContent = open(self.acFrcmodFileName, 'r').readlines()
+        frcmodContent = open(self.homePath(self.acFrcmodFileName), 'r').readlines()
         for line in frcmodContent:
             if "ATTN, need revision" in line:
                 check += line
@@ -1179,6 +2014,7 @@ a        """
                 self.printError("convert pdb to mol2 via babel failed")
                 return True
 
+    @timedStage
     def execBabel(self):
 
         self.makeDir()
@@ -1186,11 +2022,11 @@ a        """
         cmd = '%s -ipdb %s -omol2 %s.mol2' % (self.babelExe, self.inputFile,
                                               self.baseName)
         self.printDebug(cmd)
-        self.babelLog = _getoutput(cmd)
+        self.babelLog = _getoutput(cmd, cwd=self.absHomeDir)
         self.ext = '.mol2'
         self.inputFile = self.baseName + self.ext
         self.acParDict['ext'] = 'mol2'
-        if os.path.exists(self.inputFile):
+        if os.path.exists(self.homePath(self.inputFile)):
             self.printMess("* Babel OK *")
         else:
             self.printQuoted(self.babelLog)
@@ -1198,35 +2034,41 @@ a        """
 
     def makeDir(self):
 
-        os.chdir(self.rootDir)
-        self.absHomeDir = os.path.abspath(self.homeDir)
-        if not os.path.exists(self.homeDir):
-            os.mkdir(self.homeDir)
-        os.chdir(self.homeDir)
-        copy2(self.absInputFile, '.')
+        if not os.path.exists(self.absHomeDir):
+            os.mkdir(self.absHomeDir)
+        copy2(self.absInputFile, self.absHomeDir)
 
         return True
 
+    def homePath(self, fileName):
+        """Path of fileName in absHomeDir, where all the tools run"""
+        return os.path.join(self.absHomeDir, fileName)
+
     def createACTopol(self):
         """
             If successful, Amber Top and Xyz files will be generated
         """
         # sleap = False
-        if self.engine == 'sleap':
-            if self.execSleap():
-                self.printError("Sleap failed")
-                self.printMess("... trying Tleap")
+        if self.deadline is None:
+            self.deadline = monotonic() + self.timeTol
+        try:
+            if self.engine == 'sleap':
+                if self.execSleap():
+                    self.printError("Sleap failed")
+                    self.printMess("... trying Tleap")
+                    if self.execTleap():
+                        self.printError("Tleap failed")
+            if self.engine == 'tleap':
                 if self.execTleap():
                     self.printError("Tleap failed")
-        if self.engine == 'tleap':
-            if self.execTleap():
-                self.printError("Tleap failed")
-                if self.extOld == '.pdb':
-                    self.printMess("... trying Sleap")
-                    self.ext = self.extOld
-                    self.inputFile = self.baseName + self.ext
-                    if self.execSleap():
-                        self.printError("Sleap failed")
+                    if self.extOld == '.pdb':
+                        self.printMess("... trying Sleap")
+                        self.ext = self.extOld
+                        self.inputFile = self.baseName + self.ext
+                        if self.execSleap():
+                            self.printError("Sleap failed")
+        finally:
+            self.writeRunReport()
         if not self.debug:
             self.delOutputFiles()
 
@@ -1234,19 +2076,47 @@ a        """
         """
             Create molTop obj
         """
-        self.topFileData = open(self.acTopFileName, 'r').readlines()
-        self.molTopol = MolTopol(self, verbose=self.verbose, debug=self.debug,
-                                 gmx45=self.gmx45, disam=self.disam, direct=self.direct,
-                                 is_sorted=self.sorted, chiral=self.chiral)
-        if self.outTopols:
-            if 'cns' in self.outTopols:
-                self.molTopol.writeCnsTopolFiles()
-            if 'gmx' in self.outTopols:
-                self.molTopol.writeGromacsTopolFiles()
-            if 'charmm' in self.outTopols:
-                self.writeCharmmTopolFiles()
-        self.pickleSave()
-
+        try:
+            self.topFileData = open(self.homePath(self.acTopFileName), 'r').readlines()
+            self.molTopol = MolTopol(self, verbose=self.verbose, debug=self.debug,
+                                     gmx45=self.gmx45, disam=self.disam, direct=self.direct,
+                                     is_sorted=self.sorted, chiral=self.chiral)
+            if self.outTopols:
+                if 'cns' in self.outTopols:
+                    self.molTopol.writeCnsTopolFiles()
+                if 'gmx' in self.outTopols:
+                    self.molTopol.writeGromacsTopolFiles()
+                if 'charmm' in self.outTopols:
+                    self.writeCharmmTopolFiles()
+            self.pickleSave()
+        finally:
+            self.writeRunReport()
+
+    def writeRunReport(self):
+        """
+            Write the stages recorded so far (see timeStage) to
+            <basename>.acpype/run_report.json
+        """
+        report = {'input': self.absInputFile, 'basename': self.baseName,
+                  'chargeType': self.chargeType, 'atomType': self.atomType,
+                  'engine': self.engine, 'stages': self.stages}
+        if self.stagesStart is not None:
+            report['wall'] = round(monotonic() - self.stagesStart, 4)
+        usage = getUsage()
+        if usage[0] is not None:
+            report.update(cpu=round(usage[0], 4), maxRss=usage[1],
+                          childCpu=round(usage[2], 4), childMaxRss=usage[3])
+        reportFile = self.homePath('run_report.json')
+        try:
+            if not os.path.exists(self.absHomeDir):
+                os.mkdir(self.absHomeDir)
+            with open(reportFile, 'w') as f:
+                json.dump(report, f, indent=1, sort_keys=True)
+            self.printDebug("run report written to '%s'" % reportFile)
+        except (IOError, OSError) as e:
+            self.printWarn("run report not written: %s" % e)
+
+    @timedStage
     def pickleSave(self):
         """
             To restore:
@@ -1258,7 +2128,7 @@ a        """
         """
         pklFile = self.baseName + ".pkl"
         dumpFlag = False
-        if not os.path.exists(pklFile):
+        if not os.path.exists(self.homePath(pklFile)):
             mess = "Writing pickle file %s" % pklFile
             dumpFlag = True
         elif self.force:
@@ -1268,51 +2138,37 @@ a        """
             mess = "Pickle file %s already present... doing nothing" % pklFile
         self.printMess(mess)
         if dumpFlag:
-            with open(pklFile, "wb") as f:  # for python 2.6 or higher
+            with open(self.homePath(pklFile), "wb") as f:  # for python 2.6 or higher
                 # f = open(pklFile, "wb")
                 if verList[0] == 3:
                     pickle.dump(self, f, protocol=2, fix_imports=True)
                 else:
                     pickle.dump(self, f, protocol=2)
 
+    def getPrmtopReader(self):
+        """
+            Index self.topFileData once; rebuilt only if topFileData is replaced.
+            With memory mapped or cached input topFileData is None and the
+            reader is the one set by MolTopol (or, once unpickled, a memory
+            mapped one)
+        """
+        reader = getattr(self, 'prmtopReader', None)
+        if reader is None and self.topFileData is None:
+            reader = MmapPrmtopReader(self.topFileName)
+            self.prmtopReader = reader
+        elif reader is None or reader.lines is not self.topFileData:
+            if len(self.topFileData) == 0:
+                raise Exception("PRMTOP file empty?")
+            reader = PrmtopReader(self.topFileData)
+            self.prmtopReader = reader
+            self.printDebug("prmtop indexed: %i sections" % len(reader.sections))
+        return reader
+
     def getFlagData(self, flag):
         """
             For a given acFileTop flag, return a list of the data related
         """
-        block = False
-        tFlag = '%FLAG ' + flag
-        data = ''
-
-        if len(self.topFileData) == 0:
-            raise Exception("PRMTOP file empty?")
-
-        for rawLine in self.topFileData:
-            line = rawLine[:-1]
-            if tFlag in line:
-                block = True
-                continue
-            if block and '%FLAG ' in line:
-                break
-            if block:
-                if '%FORMAT' in line:
-                    line = line.strip().strip('%FORMAT()').split('.')[0]
-                    for c in line:
-                        if c.isalpha():
-                            f = int(line.split(c)[1])
-                            break
-                    continue
-                data += line
-        # data need format
-        sdata = [data[i:i + f].strip() for i in range(0, len(data), f)]
-        if '+' and '.' in data:  # it's a float
-            ndata = list(map(float, sdata))
-        elif flag != 'RESIDUE_LABEL':
-            try:  # try if it's integer
-                ndata = list(map(int, sdata))
-            except:  # it's string
-                ndata = sdata
-        else:
-            ndata = sdata
+        ndata = self.getPrmtopReader().getSection(flag)
         if flag == 'AMBER_ATOM_TYPE':
             nn = []
             ll = set()
@@ -1329,6 +2185,7 @@ a        """
             ndata = nn
         return ndata  # a list
 
+    @timedStage
     def getResidueLabel(self):
         """
             Get a 3 capital letters code from acFileTop
@@ -1344,26 +2201,20 @@ a        """
 
     def getCoords(self):
         """
-            For a given acFileXyz file, return a list of coords as:
-            [[x1,y1,z1],[x2,y2,z2], etc.]
+            Decode acFileXyz, returns (coords, velocities, box) as given by
+            decodeInpcrd: coords = [x1, y1, z1, x2, ...]
         """
-        if len(self.xyzFileData) == 0:
+        if self.xyzFileData is None:  # memory mapped input
+            buf = mapFile(self.xyzFileName)
+        else:
+            buf = ''.join(self.xyzFileData).encode('ascii')
+        if not buf:
             raise Exception("INPCRD file empty?")
-        data = ''
-        for rawLine in self.xyzFileData[2:]:
-            line = rawLine[:-1]
-            data += line
-        l = len(data)
-        ndata = list(map(float, [data[i:i + 12] for i in range(0, l, 12)]))
-
-        gdata = []
-        for i in range(0, len(ndata), 3):
-            gdata.append([ndata[i], ndata[i + 1], ndata[i + 2]])
-
+        coords, velocities, box = decodeInpcrd(buf)
         self.printDebug("getCoords done")
+        return coords, velocities, box
 
-        return gdata
-
+    @timedStage
     def getAtoms(self):
         """
             Set a list with all atoms objects build from dat in acFileTop
@@ -1371,6 +2222,8 @@ a        """
             Set also list atomTypes
             Set also resid
             Set also molTopol total charge
+            Atoms and atom types are stored as columns in self.topolArrays,
+            self.atoms only creates an Atom object when one is accessed
         """
         atomNameList = self.getFlagData('ATOM_NAME')
         atomTypeNameList = self.getFlagData('AMBER_ATOM_TYPE')
@@ -1381,25 +2234,18 @@ a        """
 #        self.printDebug('charge to be balanced: total %13.10f' % (totalCharge/qConv))
 
         resIds = self.getFlagData('RESIDUE_POINTER') + [0]
-        # to guess the resId of the last residue before ion or water
-#        for resTemp in self.residueLabel:
-#            if resTemp in ionOrWaterResNameList:
-#                lastSoluteResId = self.residueLabel.index(resTemp) - 1
-#                break
-        # print lastSoluteResId, self.residueLabel[lastSoluteResId]
         # uniqAtomTypeId = self.getFlagData('ATOM_TYPE_INDEX') # for LJ
-#        balanceChargeList = self.balanceCharges(chargeList)
-        coords = self.getCoords()
+        coords, velocities, box = self.getCoords()
+        if len(coords) != 3 * len(atomNameList):
+            raise Exception("INPCRD has %i atoms but PRMTOP has %i" % (len(coords) // 3, len(atomNameList)))
         ACOEFs, BCOEFs = self.getABCOEFs()
 
-        atoms = []
-        atomTypes = []
-        tmpList = []  # a list with unique atom types
+        ta = TopolArrays()
+        typeIds = {}  # atomTypeName: index in atom types columns
         totalCharge = 0.0
         countRes = 0
-        id_ = 0
         FirstNonSoluteId = None
-        for atomName in atomNameList:
+        for id_, atomName in enumerate(atomNameList):
             if atomName != atomName.upper():
                 self.printDebug("atom name '%s' HAS to be all UPPERCASE... Applying this here." %
                                 atomName)
@@ -1411,27 +2257,20 @@ a        """
             resName = self.residueLabel[resid]
             if resName in ionOrSolResNameList and not FirstNonSoluteId:
                 FirstNonSoluteId = id_
-                # print id_, resid, resName
             mass = massList[id_]
-            # charge = balanceChargeList[id_]
             charge = chargeList[id_]
-            chargeConverted = charge / qConv
             totalCharge += charge
-            coord = coords[id_]
-            ACOEF = ACOEFs[id_]
-            BCOEF = BCOEFs[id_]
-            atomType = AtomType(atomTypeName, mass, ACOEF, BCOEF)
-            if atomTypeName not in tmpList:
-                tmpList.append(atomTypeName)
-                atomTypes.append(atomType)
-            atom = Atom(atomName, atomType, id_ + 1, resid, mass, chargeConverted, coord)
-            atoms.append(atom)
-            id_ += 1
+            typeId = typeIds.get(atomTypeName)
+            if typeId is None:
+                typeId = len(ta.typeName)
+                typeIds[atomTypeName] = typeId
+                ta.addAtomType(atomTypeName, mass, ACOEFs[id_], BCOEFs[id_])
+            ta.addAtom(atomName, typeId, resid, mass, charge / qConv)
 
         balanceChargeList, balanceValue, balanceIds = self.balanceCharges(chargeList, FirstNonSoluteId)
 
         for id_ in balanceIds:
-            atoms[id_].charge = balanceValue / qConv
+            ta.charge[id_] = balanceValue / qConv
         # self.printDebug("atom ids and balanced charges: %s, %3f10" % (balanceIds, balanceValue/qConv))
 
         if atomTypeName[0].islower():
@@ -1442,36 +2281,56 @@ a        """
         self.printDebug('Balanced TotalCharge %13.10f' % float(sum(balanceChargeList) / qConv))
         self.totalCharge = int(totalCharge)
 
-        self.atoms = atoms
+        ta.coords = coords
+        ta.velocities = velocities
+
+        atomTypes = [ta.makeAtomType(i) for i in range(len(ta.typeName))]
+        self.topolArrays = ta
         self.atomTypes = atomTypes
+        self.atoms = LazyObjectList(ta.numAtoms(), lambda i: ta.makeAtom(i, atomTypes))
+        self.prmtopAtoms = self.atoms  # self.atoms may be sorted later on
 
-        self.pbc = None
-        if len(coords) == len(atoms) + 2:
-            self.pbc = [coords[-2], coords[-1]]
+        self.pbc = box
         self.printDebug("PBC = '%s" % self.pbc)
         self.printDebug("getAtoms done")
 
+    @timedStage
     def getBonds(self):
         uniqKbList = self.getFlagData('BOND_FORCE_CONSTANT')
         uniqReqList = self.getFlagData('BOND_EQUIL_VALUE')
         bondCodeHList = self.getFlagData('BONDS_INC_HYDROGEN')
         bondCodeNonHList = self.getFlagData('BONDS_WITHOUT_HYDROGEN')
         bondCodeList = bondCodeHList + bondCodeNonHList
-        bonds = []
-        for i in range(0, len(bondCodeList), 3):
-            idAtom1 = bondCodeList[i] // 3  # remember python starts with id 0
-            idAtom2 = bondCodeList[i + 1] // 3
-            bondTypeId = bondCodeList[i + 2] - 1
-            atom1 = self.atoms[idAtom1]
-            atom2 = self.atoms[idAtom2]
-            kb = uniqKbList[bondTypeId]
-            req = uniqReqList[bondTypeId]
-            atoms = [atom1, atom2]
-            bond = Bond(atoms, kb, req)
-            bonds.append(bond)
-        self.bonds = bonds
+        ta = self.topolArrays
+        ta.setBonds(bondCodeList, uniqKbList, uniqReqList)
+        atoms = self.prmtopAtoms
+        self.bonds = LazyObjectList(len(ta.kBond), lambda i: ta.makeBond(i, atoms))
         self.printDebug("getBonds done")
 
+    @timedStage
+    def getBondGraph(self):
+        """
+            Index of bonded neighbours, shared by getChirals,
+            sortAtomsForGromacs and getExcludedAtoms
+        """
+        if 'bonds' not in self.__dict__:  # parses them into topolArrays.bondAtoms
+            self.getBonds()
+        ta = self.topolArrays
+        self.bondGraph = BondGraph(ta.numAtoms(), ta.bondAtoms)
+        self.printDebug("getBondGraph done")
+
+    def loadTopolArrays(self):
+        """
+            Parse atoms and bonded terms into self.topolArrays if not done
+            yet, and return it; writers read its columns, not Atom objects
+        """
+        for attr, loader in (('atoms', 'getAtoms'), ('bonds', 'getBonds'),
+                             ('angles', 'getAngles'), ('properDihedrals', 'getDihedrals')):
+            if attr not in self.__dict__:
+                getattr(self, loader)()
+        return self.topolArrays
+
+    @timedStage
     def getAngles(self):
         uniqKtList = self.getFlagData('ANGLE_FORCE_CONSTANT')
         uniqTeqList = self.getFlagData('ANGLE_EQUIL_VALUE')
@@ -1479,23 +2338,13 @@ a        """
         angleCodeHList = self.getFlagData('ANGLES_INC_HYDROGEN')
         angleCodeNonHList = self.getFlagData('ANGLES_WITHOUT_HYDROGEN')
         angleCodeList = angleCodeHList + angleCodeNonHList
-        angles = []
-        for i in range(0, len(angleCodeList), 4):
-            idAtom1 = angleCodeList[i] // 3  # remember python starts with id 0
-            idAtom2 = angleCodeList[i + 1] // 3
-            idAtom3 = angleCodeList[i + 2] // 3
-            angleTypeId = angleCodeList[i + 3] - 1
-            atom1 = self.atoms[idAtom1]
-            atom2 = self.atoms[idAtom2]
-            atom3 = self.atoms[idAtom3]
-            kt = uniqKtList[angleTypeId]
-            teq = uniqTeqList[angleTypeId]  # angle given in rad in prmtop
-            atoms = [atom1, atom2, atom3]
-            angle = Angle(atoms, kt, teq)
-            angles.append(angle)
-        self.angles = angles
+        ta = self.topolArrays
+        ta.setAngles(angleCodeList, uniqKtList, uniqTeqList)
+        atoms = self.prmtopAtoms
+        self.angles = LazyObjectList(len(ta.kTheta), lambda i: ta.makeAngle(i, atoms))
         self.printDebug("getAngles done")
 
+    @timedStage
     def getDihedrals(self):
         """
             Get dihedrals (proper and imp), condensed list of prop dih and
@@ -1508,58 +2357,22 @@ a        """
         dihCodeHList = self.getFlagData('DIHEDRALS_INC_HYDROGEN')
         dihCodeNonHList = self.getFlagData('DIHEDRALS_WITHOUT_HYDROGEN')
         dihCodeList = dihCodeHList + dihCodeNonHList
-        properDih = []
-        improperDih = []
-        condProperDih = []  # list of dihedrals condensed by the same quartet
-        # atomPairs = []
-        atomPairs = set()
-        for i in range(0, len(dihCodeList), 5):
-            idAtom1 = dihCodeList[i] // 3  # remember python starts with id 0
-            idAtom2 = dihCodeList[i + 1] // 3
-            # 3 and 4 indexes can be negative: if id3 < 0, end group interations
-            # in amber are to be ignored; if id4 < 0, dihedral is improper
-            idAtom3raw = dihCodeList[i + 2] // 3  # can be negative -> exclude from 1-4vdw
-            idAtom4raw = dihCodeList[i + 3] // 3  # can be negative -> Improper
-            idAtom3 = abs(idAtom3raw)
-            idAtom4 = abs(idAtom4raw)
-            dihTypeId = dihCodeList[i + 4] - 1
-            atom1 = self.atoms[idAtom1]
-            atom2 = self.atoms[idAtom2]
-            atom3 = self.atoms[idAtom3]
-            atom4 = self.atoms[idAtom4]
-            kPhi = uniqKpList[dihTypeId]  # already divided by IDIVF
-            period = int(uniqPeriodList[dihTypeId])  # integer
-            phase = uniqPhaseList[dihTypeId]  # angle given in rad in prmtop
-            if phase == kPhi == 0:
-                period = 0  # period is set to 0
-            atoms = [atom1, atom2, atom3, atom4]
-            dihedral = Dihedral(atoms, kPhi, period, phase)
-            if idAtom4raw > 0:
-                try:
-                    atomsPrev = properDih[-1].atoms
-                except:
-                    atomsPrev = []
-                properDih.append(dihedral)
-                if idAtom3raw < 0 and atomsPrev == atoms:
-                    condProperDih[-1].append(dihedral)
-                else:
-                    condProperDih.append([dihedral])
-                pair = (atom1, atom4)
-                # if atomPairs.count(pair) == 0 and idAtom3raw > 0:
-                if idAtom3raw > 0:
-                    atomPairs.add(pair)
-            else:
-                improperDih.append(dihedral)
-        try:
-            atomPairs = sorted(atomPairs)
-        except:
-            pass
+        ta = self.topolArrays
+        ta.setDihedrals(dihCodeList, uniqKpList, uniqPeriodList, uniqPhaseList)
+        atoms = self.prmtopAtoms
+        dihedrals = LazyObjectList(len(ta.kPhi), lambda i: ta.makeDihedral(i, atoms))
+        properDih = LazyObjectList(len(ta.properIds), lambda i: dihedrals[ta.properIds[i]])
+        start = ta.condensedStart
         self.properDihedrals = properDih
-        self.improperDihedrals = improperDih
-        self.condensedProperDihedrals = condProperDih  # [[],[],...]
-        self.atomPairs = atomPairs  # set((atom1, atom2), ...)
+        self.improperDihedrals = LazyObjectList(len(ta.improperIds),
+                                                lambda i: dihedrals[ta.improperIds[i]])
+        self.condensedProperDihedrals = LazyObjectList(len(start) - 1,
+                                                       lambda i: properDih[start[i]:start[i + 1]])  # [[],[],...]
+        self.atomPairs = LazyObjectList(len(ta.pairAtoms) // 2,
+                                        lambda i: ta.makePair(i, atoms))  # [(atom1, atom2), ...]
         self.printDebug("getDihedrals done")
 
+    @timedStage
     def getChirals(self):
         """
             Get chiral atoms, its 4 neighbours and improper dihedral angle
@@ -1569,24 +2382,23 @@ a        """
             # print (self.obchiralExe, os.getcwd())
             cmd = '%s %s' % (self.obchiralExe, self.inputFile)
             # print(cmd)
-            out = map(int, re.findall('Atom (\d+) Is', _getoutput(cmd)))
+            out = map(int, re.findall('Atom (\d+) Is', _getoutput(cmd, cwd=self.absHomeDir)))
             # print("*%s*" % out)
             chiralGroups = []
+            atoms = self.prmtopAtoms
+            graph = self.bondGraph
             for id_ in out:
-                atChi = self.atoms[id_ - 1]
-                quad = []
-                for bb in self.bonds:
-                    bAts = bb.atoms[:]
-                    if atChi in bAts:
-                        bAts.remove(atChi)
-                        quad.append(bAts[0])
+                atChi = atoms[id_ - 1]
+                quad = [atoms[i] for i in graph.getNeighbours(id_ - 1)]
                 if len(quad) != 4:
                     if self.chiral:
                         self.printWarn("Atom %s has less than 4 connections to 4 different atoms. It's NOT Chiral!" % atChi)
                     continue
-                v1, v2, v3, v4 = [x.coords for x in quad]
-                chiralGroups.append((atChi, quad, imprDihAngle(v1, v2, v3, v4)))
-            self.chiralGroups = chiralGroups
+                chiralGroups.append((atChi, quad))
+            # all improper angles in one go
+            angles = imprDihAngles([[x.coords for x in quad] for atChi, quad in chiralGroups])
+            self.chiralGroups = [(atChi, quad, float(angle))
+                                 for (atChi, quad), angle in zip(chiralGroups, angles)]
 
     def sortAtomsForGromacs(self):
         """
@@ -1597,58 +2409,64 @@ a        """
             Currently, atom mass < 1.2 is taken to denote a proton.  This behavior
             may be changed by modifying the 'is_hydrogen' function within.
 
+            Bonded atoms come from the bondGraph index and placed atoms are
+            kept in a bitmap, so it runs in O(atoms + bonds). The order and
+            charge groups go to topolArrays, no Atom object is made for them.
+
             JDC 2011-02-03
         """
 
-        # Build dictionary of bonded atoms.
-        bonded_atoms = dict()
-        for atom in self.atoms:
-            bonded_atoms[atom] = list()
-        for bond in self.bonds:
-            [atom1, atom2] = bond.atoms
-            bonded_atoms[atom1].append(atom2)
-            bonded_atoms[atom2].append(atom1)
+        ta = self.topolArrays
+        numAtoms = ta.numAtoms()
+        # neighbours of atom i are neighbours[start[i]:start[i + 1]]
+        start = self.bondGraph.start
+        neighbours = self.bondGraph.neighbours
 
         # Define hydrogen and heavy atom classes.
-        def is_hydrogen(atom):
-            return (atom.mass < 1.2)
+        def is_hydrogen(mass):
+            return (mass < 1.2)
 
-        def is_heavy(atom):
-            return not is_hydrogen(atom)
+        hydrogen = bytearray([is_hydrogen(mass) for mass in ta.mass])
+        placed = bytearray(numAtoms)  # visited bitmap
 
         # Build list of sorted atoms, assigning charge groups by heavy atom.
-        sorted_atoms = list()
+        order = array('i')
+        cgnrs = array('i', [0]) * numAtoms
         cgnr = 1  # charge group number: each heavy atoms is assigned its own charge group
         # First pass: add heavy atoms, followed by the hydrogens bonded to them.
-        for atom in self.atoms:
-            if is_heavy(atom):
+        for i in range(numAtoms):
+            if not hydrogen[i]:
                 # Append heavy atom.
-                atom.cgnr = cgnr
-                sorted_atoms.append(atom)
+                cgnrs[i] = cgnr
+                order.append(i)
+                placed[i] = 1
                 # Append all hydrogens.
-                for bonded_atom in bonded_atoms[atom]:
-                    if is_hydrogen(bonded_atom) and not (bonded_atom in sorted_atoms):
+                for k in range(start[i], start[i + 1]):
+                    j = neighbours[k]
+                    if hydrogen[j] and not placed[j]:
                         # Append bonded hydrogen.
-                        bonded_atom.cgnr = cgnr
-                        sorted_atoms.append(bonded_atom)
+                        cgnrs[j] = cgnr
+                        order.append(j)
+                        placed[j] = 1
                 cgnr += 1
 
         # Second pass: Add any remaining atoms.
-        if len(sorted_atoms) < len(self.atoms):
-            for atom in self.atoms:
-                if not (atom in sorted_atoms):
-                    atom.cgnr = cgnr
-                    sorted_atoms.append(atom)
+        if len(order) < numAtoms:
+            for i in range(numAtoms):
+                if not placed[i]:
+                    cgnrs[i] = cgnr
+                    order.append(i)
                     cgnr += 1
 
-        # Replace current list of atoms with sorted list.
-        self.atoms = sorted_atoms
-
-        # Renumber atoms in sorted list, starting from 1.
-        for (index, atom) in enumerate(self.atoms):
-            atom.id = index + 1
-
-        return
+        # Sorted list of atoms, renumbered from 1 (see TopolArrays.makeAtom).
+        ta.setOrder(order, cgnrs)
+        prmtopAtoms = self.prmtopAtoms
+        self.atoms = LazyObjectList(numAtoms, lambda k: prmtopAtoms[order[k]])
+        # Atom objects already made get their new id and charge group
+        for i, atom in enumerate(getattr(prmtopAtoms, 'cache', prmtopAtoms)):
+            if atom is not None:
+                atom.id = ta.atomIds[i]
+                atom.cgnr = cgnrs[i]
 
     def setAtomPairs(self):
         """
@@ -1669,23 +2487,18 @@ a        """
     def getExcludedAtoms(self):
         """
             Returns a list of atoms with a list of its excluded atoms up to 3rd
-            neighbour.
+            neighbour (the ones after it, as in EXCLUDED_ATOMS_LIST), taken
+            from the 1-2, 1-3 and 1-4 shells of the bondGraph.
             It's implicitly indexed, i.e., a sequence of atoms in position n in
             the excludedAtomsList corresponds to atom n (self.atoms) and so on.
             NOT USED
         """
-        excludedAtomsIdList = self.getFlagData('EXCLUDED_ATOMS_LIST')
-        numberExcludedAtoms = self.getFlagData('NUMBER_EXCLUDED_ATOMS')
-        atoms = self.atoms
-        interval = 0
+        atoms = self.prmtopAtoms
+        graph = self.bondGraph
         excludedAtomsList = []
-        for number in numberExcludedAtoms:
-            temp = excludedAtomsIdList[interval:interval + number]
-            if temp == [0]:
-                excludedAtomsList.append([])
-            else:
-                excludedAtomsList.append([atoms[a - 1] for a in temp])
-            interval += number
+        for i in range(len(atoms)):
+            excluded = sorted([j for shell in graph.getShells(i) for j in shell if j > i])
+            excludedAtomsList.append([atoms[j] for j in excluded])
         self.excludedAtoms = excludedAtomsList
         self.printDebug("getExcludedAtoms")
 
@@ -1748,11 +2561,13 @@ a        """
 
     def setProperDihedralsCoef(self):
         """
-            It takes self.condensedProperDihedrals and returns
-            self.properDihedralsCoefRB, a reduced list of quartet atoms + RB.
+            It takes the condensed proper dihedrals (from the topolArrays
+            columns) and returns self.properDihedralsCoefRB, a reduced list
+            of quartet atoms + RB.
             Coeficients ready for GMX (multiplied by 4.184)
 
-            self.properDihedralsCoefRB = [ [atom1,..., atom4], C[0:5] ]
+            self.properDihedralsCoefRB = [ (i1,..., i4), C[0:5] ]
+            with i1... the prmtop indices of the atoms
 
             For proper dihedrals: a quartet of atoms may appear with more than
             one set of parameters and to convert to GMX they are treated as RBs.
@@ -1765,19 +2580,23 @@ a        """
         properDihedralsCoefRB = []
         properDihedralsAlphaGamma = []
         properDihedralsGmx45 = []
-        for item in self.condensedProperDihedrals:
+        ta = self.loadTopolArrays()
+        start = ta.condensedStart
+        for n in range(len(start) - 1):
             V = 6 * [0.0]
             C = 6 * [0.0]
-            for dih in item:
-                period = dih.period  # Pn
-                kPhi = dih.kPhi  # in rad
-                phaseRaw = dih.phase * radPi  # in degree
+            quad = ta.getDihedralAtoms(ta.properIds[start[n]])
+            for k in range(start[n], start[n + 1]):
+                dih = ta.properIds[k]
+                period = ta.period[dih]  # Pn
+                kPhi = ta.kPhi[dih]  # in rad
+                phaseRaw = ta.phase[dih] * radPi  # in degree
                 phase = int(phaseRaw)  # in degree
                 if period > 4 and not self.gmx45:
                     self.printError("Likely trying to convert ILDN to RB, use option '-r' for GMX45")
                     sys.exit(1)
                 if phase in [0, 180]:
-                    properDihedralsGmx45.append([item[0].atoms, phaseRaw, kPhi, period])
+                    properDihedralsGmx45.append([quad, phaseRaw, kPhi, period])
                     if not self.gmx45:
                         if kPhi > 0:
                             V[period] = 2 * kPhi * cal
@@ -1810,10 +2629,10 @@ a        """
                                 C[2] -= 4 * V[period]
                                 C[4] += 4 * V[period]
                 else:
-                    properDihedralsAlphaGamma.append([item[0].atoms, phaseRaw, kPhi, period])
+                    properDihedralsAlphaGamma.append([quad, phaseRaw, kPhi, period])
                     # print phaseRaw, kPhi, period
             if phase in [0, 180]:
-                properDihedralsCoefRB.append([item[0].atoms, C])
+                properDihedralsCoefRB.append([quad, C])
 
         # print properDihedralsCoefRB
         # print properDihedralsAlphaGamma
@@ -1824,6 +2643,7 @@ a        """
         self.properDihedralsAlphaGamma = properDihedralsAlphaGamma
         self.properDihedralsGmx45 = properDihedralsGmx45
 
+    @timedStage
     def writeCharmmTopolFiles(self):
 
         self.printMess("Writing CHARMM files\n")
@@ -1842,7 +2662,7 @@ a        """
         if self.debug:
             cmd = cmd.replace('-pf y', '-pf n')
             self.printDebug(cmd)
-        _log = _getoutput(cmd)
+        _log = _getoutput(cmd, cwd=self.absHomeDir)
 
     def writePdb(self, file_):
         """
@@ -1857,9 +2677,10 @@ a        """
         fbase = os.path.basename(file_)
         pdbFile.write("REMARK " + head % (fbase, date))
         id_ = 1
-        for atom in self.atoms:
+        ta = self.topolArrays
+        for i in ta.atomOrder():
             # id_ = self.atoms.index(atom) + 1
-            aName = atom.atomName
+            aName = ta.atomName[i]
             if len(aName) == 2:
                 aName = ' %s ' % aName
             elif len(aName) == 1:
@@ -1869,9 +2690,7 @@ a        """
                     s = l
                     break
             rName = self.residueLabel[0]
-            x = atom.coords[0]
-            y = atom.coords[1]
-            z = atom.coords[2]
+            x, y, z = ta.getCoord(i)
             line = "%-6s%5d %4s %3s Z%4d%s%8.3f%8.3f%8.3f%6.2f%6.2f%s%2s\n" % \
                 ('ATOM', id_, aName, rName, 1, 4 * ' ', x, y, z, 1.0, 0.0, 10 * ' ', s)
             pdbFile.write(line)
@@ -1988,64 +2807,79 @@ a        """
 
         self.writeMdpFiles()
 
+    @timedStage
     def setAtomType4Gromacs(self):
         """Atom types names in Gromacs TOP file are not case sensitive;
            this routine will append a '_' to lower case atom type.
            E.g.: CA and ca -> CA and ca_
+           (or drop ca for CA if both have the same LJ parameters).
+           Atoms are not copied: atomTypeNamesGromacs maps the changed names.
         """
         if self.disam:
             self.printMess("Disambiguating lower and uppercase atomtypes in GMX top file.\n")
             self.atomTypesGromacs = self.atomTypes
+            self.atomTypeNamesGromacs = {}
             self.atomsGromacs = self.atoms
             return
 
-        atNames = [at.atomTypeName for at in self.atomTypes]
-        # print atNames
-        delAtomTypes = []
-        modAtomTypes = []
-        atomTypesGromacs = []
         dictAtomTypes = {}
+        for at in self.atomTypes:
+            dictAtomTypes.setdefault(at.atomTypeName, at)
+        atomTypesGromacs = []
+        typeNamesGromacs = {}  # type name: its new name, only for the ones changed
         for at in self.atomTypes:
             atName = at.atomTypeName
-            dictAtomTypes[atName] = at
-            if atName.islower() and atName.upper() in atNames:
-                # print atName, atName.upper()
-                atUpper = self.atomTypes[atNames.index(atName.upper())]
-                # print at.atomTypeName,at.mass, at.ACOEF, at.BCOEF
-                # print atUpper.atomTypeName, atUpper.mass, atUpper.ACOEF, atUpper.BCOEF
-                if at.ACOEF is atUpper.ACOEF and at.BCOEF is at.BCOEF:
-                    delAtomTypes.append(atName)
+            atUpper = atName.islower() and dictAtomTypes.get(atName.upper())
+            if atUpper:
+                if at.ACOEF == atUpper.ACOEF and at.BCOEF == atUpper.BCOEF:
+                    typeNamesGromacs[atName] = atUpper.atomTypeName
                 else:
                     newAtName = atName + '_'
-                    modAtomTypes.append(atName)
-                    atomType = AtomType(newAtName, at.mass, at.ACOEF, at.BCOEF)
-                    atomTypesGromacs.append(atomType)
-                    dictAtomTypes[newAtName] = atomType
+                    typeNamesGromacs[atName] = newAtName
+                    atomTypesGromacs.append(AtomType(newAtName, at.mass, at.ACOEF, at.BCOEF))
             else:
                 atomTypesGromacs.append(at)
 
-        atomsGromacs = []
-        for a in self.atoms:
-            atName = a.atomType.atomTypeName
-            if atName in delAtomTypes:
-                atom = Atom(a.atomName, dictAtomTypes[atName.upper()], a.id,
-                            a.resid, a.mass, a.charge, a.coords)
-                atom.cgnr = a.cgnr
-                atomsGromacs.append(atom)
-            elif atName in modAtomTypes:
-                atom = Atom(a.atomName, dictAtomTypes[atName + '_'], a.id,
-                            a.resid, a.mass, a.charge, a.coords)
-                atom.cgnr = a.cgnr
-                atomsGromacs.append(atom)
-            else:
-                atomsGromacs.append(a)
-
         self.atomTypesGromacs = atomTypesGromacs
-        self.atomsGromacs = atomsGromacs
-        # print [i.atomTypeName for i in atomTypesGromacs]
-        # print modAtomTypes
-        # print delAtomTypes
+        self.atomTypeNamesGromacs = typeNamesGromacs
+        # atoms keep their types, the GMX writer renames them on the fly
+        self.atomsGromacs = self.atoms
 
+    def getMoleculeBlocks(self):
+        """
+            Split atoms, in their current order, into molecules: the shortest
+            runs of consecutive ids holding whole residues and whole connected
+            components of the bonded terms (molecules interleaved with each
+            other end up in the same run).
+            Returns [(firstId, lastId), ...]
+        """
+        ta = self.loadTopolArrays()
+        atomIds = ta.getAtomIds()
+        reach = array('i', range(1, ta.numAtoms() + 1))  # highest id joined to each id
+        resFirst = {}
+        for i in ta.atomOrder():
+            id_ = atomIds[i]
+            first = resFirst.setdefault(ta.resid[i], id_)
+            if id_ > reach[first - 1]:
+                reach[first - 1] = id_
+        for termAtoms, size in ((ta.bondAtoms, 2), (ta.angleAtoms, 3), (ta.dihedralAtoms, 4)):
+            for t in range(0, len(termAtoms), size):
+                ids = [atomIds[i] for i in termAtoms[t:t + size]]
+                first = min(ids)
+                last = max(ids)
+                if last > reach[first - 1]:
+                    reach[first - 1] = last
+        blocks = []
+        first = 1
+        last = 0
+        for id_ in range(1, len(reach) + 1):
+            last = max(last, reach[id_ - 1])
+            if id_ == last:
+                blocks.append((first, last))
+                first = id_ + 1
+        return blocks
+
+    @timedStage
     def writeGromacsTop(self, amb2gmx=False):
         if self.atomTypeSystem == 'amber':
             d2opls = dictAtomTypeAmb2OplsGmxCode
@@ -2273,7 +3107,6 @@ a        """
 
         # Dict of ions dealt by acpype emulating amb2gmx
         ionsDict = {'Na+': headNa, 'Cl-': headCl, 'K+': headK}
-        ionsSorted = []
 # NOTE: headWaterTip3p and headWaterSpce actually do the real thing
 #      so, skipping headTopWaterTip3p and headWaterTip3p
         # headTopWater = headTopWaterTip3p
@@ -2286,7 +3119,6 @@ a        """
         # topFile.write(headDefault)
         topText.append(headDefault)
 
-        nSolute = 0
         if not amb2gmx:
             topText.append(headItp % (itp, itp))
             otopText.append(headOpls)
@@ -2329,12 +3161,6 @@ a        """
             topText.append(headAtomtypes)
             topText += temp
             nWat = self.residueLabel.count('WAT')
-            for ion in ionsDict:
-                nIon = self.residueLabel.count(ion)
-                if nIon > 0:
-                    idIon = self.residueLabel.index(ion)
-                    ionsSorted.append((idIon, nIon, ion))
-            ionsSorted.sort()
         else:
             itpText.append(headAtomtypes)
             itpText += temp
@@ -2342,215 +3168,230 @@ a        """
             oitpText += otemp
         self.printDebug("GMX atomtypes done")
 
-        if len(self.atoms) > 3 * nWat + sum([x[1] for x in ionsSorted]):
-            nSolute = 1
-
         if nWat:
             # topText.append(headTopWater)
             self.printDebug("type of water '%s'" % headWater[43:48].strip())
 
-        if nSolute:
-            if amb2gmx:
-                topText.append(headMoleculetype % self.baseName)
-            else:
-                itpText.append(headMoleculetype % self.baseName)
-                oitpText.append(headMoleculetype % self.baseName)
+        typeNamesGromacs = self.atomTypeNamesGromacs
+        # atoms and bonded terms are read from the topolArrays columns, by
+        # prmtop index; atomIds gives their id in the output order
+        ta = self.loadTopolArrays()
+        atomIds = ta.getAtomIds()
+        order = ta.atomOrder()
+        atomNames = ta.atomName
+        typeNames = [typeNamesGromacs.get(name, name) for name in ta.typeName]
 
-        self.printDebug("atoms %i" % len(self.atoms))
-        qtot = 0.0
-        count = 1
-        temp = []
-        otemp = []
-        id2oplsATDict = {}
-        for atom in self.atomsGromacs:
-            resid = atom.resid
-            resname = self.residueLabel[resid]
-            if not self.direct:
-                if resname in list(ionsDict.keys()) + ['WAT']:
-                    break
-            aName = atom.atomName
-            aType = atom.atomType.atomTypeName
-            oItem = d2opls.get(aType, ['x', 0])
-            oplsAtName = oplsCode2AtomTypeDict.get(oItem[0], 'x')
-            id_ = atom.id
-            id2oplsATDict[id_] = oplsAtName
-            oaCode = 'opls_' + oItem[0]
-            cgnr = id_
+        def moleculeText(first, last, bonds, pairs, angles, dihsRB, dihsGmx45, dihsAlphaGamma, impDihs):
+            """
+                [ atoms ] and bonded sections of the moleculetype of atoms
+                with ids first to last, with atom ids, resnr and cgnr counted
+                from 1 within the molecule. bonds, pairs, angles and impDihs
+                are indices in their topolArrays columns.
+                Returns lines for GMX and for GMX OPLS
+            """
+            molText = []
+            omolText = []
+            shift = first - 1
+            resShift = ta.resid[order[first - 1]]
+            cgnrShift = shift
             if self.sorted:
-                cgnr = atom.cgnr  # JDC
-            charge = atom.charge
-            mass = atom.mass
-            omass = float(oItem[-1])
-            qtot += charge
-            resnr = resid + 1
-            line = "%6d %4s %5d %5s %5s %4d %12.6f %12.5f ; qtot %1.3f\n" % \
-                (id_, aType, resnr, resname, aName, cgnr, charge, mass, qtot)  # JDC
-            oline = "%6d %4s %5d %5s %5s %4d %12.6f %12.5f ; qtot % 3.3f  %-4s\n" % \
-                (id_, oaCode, resnr, resname, aName, cgnr, charge, omass, qtot, oplsAtName)  # JDC
-            count += 1
-            temp.append(line)
-            otemp.append(oline)
-        if temp:
-            if amb2gmx:
-                topText.append(headAtoms)
-                topText += temp
-            else:
-                itpText.append(headAtoms)
-                itpText += temp
-                oitpText.append(headAtoms)
-                oitpText += otemp
-        self.printDebug("GMX atoms done")
-
-        # remove bond of water
-        self.printDebug("bonds %i" % len(self.bonds))
-        temp = []
-        otemp = []
-        for bond in self.bonds:
-            res1 = self.residueLabel[bond.atoms[0].resid]
-            res2 = self.residueLabel[bond.atoms[0].resid]
-            if 'WAT' in [res1, res2]:
-                continue
-            a1Name = bond.atoms[0].atomName
-            a2Name = bond.atoms[1].atomName
-            id1 = bond.atoms[0].id
-            id2 = bond.atoms[1].id
-            oat1 = id2oplsATDict.get(id1)
-            oat2 = id2oplsATDict.get(id2)
-            line = "%6i %6i %3i %13.4e %13.4e ; %6s - %-6s\n" % (id1, id2, 1,
-                                                                 bond.rEq * 0.1, bond.kBond * 200 * cal, a1Name, a2Name)
-            oline = "%6i %6i %3i ; %13.4e %13.4e ; %6s - %-6s %6s - %-6s\n" % \
-                (id1, id2, 1, bond.rEq * 0.1, bond.kBond * 200 * cal, a1Name,
-                 a2Name, oat1, oat2)
-            temp.append(line)
-            otemp.append(oline)
-        temp.sort()
-        otemp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headBonds)
-                topText += temp
-            else:
-                itpText.append(headBonds)
-                itpText += temp
-                oitpText.append(headBonds)
-                oitpText += otemp
-        self.printDebug("GMX bonds done")
-
-        self.printDebug("atomPairs %i" % len(self.atomPairs))
-        temp = []
-        for pair in self.atomPairs:
-            # if not printed:
-            #    tmpFile.write(headPairs)
-            #    printed = True
-            a1Name = pair[0].atomName
-            a2Name = pair[1].atomName
-            id1 = pair[0].id
-            id2 = pair[1].id
-            # id1 = self.atoms.index(pair[0]) + 1
-            # id2 = self.atoms.index(pair[1]) + 1
-            line = "%6i %6i %6i ; %6s - %-6s\n" % (id1, id2, 1, a1Name,
-                                                   a2Name)
-            temp.append(line)
-        temp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headPairs)
-                topText += temp
-            else:
-                itpText.append(headPairs)
-                itpText += temp
-                oitpText.append(headPairs)
-                oitpText += temp
-        self.printDebug("GMX pairs done")
-
-        self.printDebug("angles %i" % len(self.angles))
-        temp = []
-        otemp = []
-        for angle in self.angles:
-            a1 = angle.atoms[0].atomName
-            a2 = angle.atoms[1].atomName
-            a3 = angle.atoms[2].atomName
-            id1 = angle.atoms[0].id
-            id2 = angle.atoms[1].id
-            id3 = angle.atoms[2].id
-            oat1 = id2oplsATDict.get(id1)
-            oat2 = id2oplsATDict.get(id2)
-            oat3 = id2oplsATDict.get(id3)
-            line = "%6i %6i %6i %6i %13.4e %13.4e ; %6s - %-6s - %-6s\n" % (id1, id2,
-                                                                            id3, 1, angle.thetaEq * radPi, 2 * cal * angle.kTheta, a1, a2, a3)
-            oline = "%6i %6i %6i %6i ; %13.4e %13.4e ; %6s - %-4s - %-6s %4s - %+4s - %-4s\n" % \
-                (id1, id2, id3, 1, angle.thetaEq * radPi, 2 * cal * angle.kTheta,
-                 a1, a2, a3, oat1, oat2, oat3)
-            temp.append(line)
-            otemp.append(oline)
-        temp.sort()
-        otemp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headAngles)
-                topText += temp
-            else:
-                itpText.append(headAngles)
-                itpText += temp
-                oitpText.append(headAngles)
-                oitpText += otemp
-        self.printDebug("GMX angles done")
-
-        self.setProperDihedralsCoef()
-        self.printDebug("properDihedralsCoefRB %i" % len(self.properDihedralsCoefRB))
-        self.printDebug("properDihedralsAlphaGamma %i" % len(self.properDihedralsAlphaGamma))
-        self.printDebug("properDihedralsGmx45 %i" % len(self.properDihedralsGmx45))
-        temp = []
-        otemp = []
-        if not self.gmx45:
-            for dih in self.properDihedralsCoefRB:
-                a1 = dih[0][0].atomName
-                a2 = dih[0][1].atomName
-                a3 = dih[0][2].atomName
-                a4 = dih[0][3].atomName
-                id1 = dih[0][0].id
-                id2 = dih[0][1].id
-                id3 = dih[0][2].id
-                id4 = dih[0][3].id
+                cgnrShift = ta.cgnr[order[first - 1]] - 1  # JDC
+            qtot = 0.0
+            count = 1
+            temp = []
+            otemp = []
+            id2oplsATDict = {}
+            for i in order[first - 1:last]:
+                resid = ta.resid[i]
+                resname = self.residueLabel[resid]
+                aName = atomNames[i]
+                aType = typeNames[ta.atomTypeId[i]]
+                oItem = d2opls.get(aType, ['x', 0])
+                oplsAtName = oplsCode2AtomTypeDict.get(oItem[0], 'x')
+                id_ = atomIds[i] - shift
+                id2oplsATDict[id_] = oplsAtName
+                oaCode = 'opls_' + oItem[0]
+                cgnr = id_
+                if self.sorted:
+                    cgnr = ta.cgnr[i] - cgnrShift  # JDC
+                charge = ta.charge[i]
+                mass = ta.mass[i]
+                omass = float(oItem[-1])
+                qtot += charge
+                resnr = resid - resShift + 1
+                line = "%6d %4s %5d %5s %5s %4d %12.6f %12.5f ; qtot %1.3f\n" % \
+                    (id_, aType, resnr, resname, aName, cgnr, charge, mass, qtot)  # JDC
+                oline = "%6d %4s %5d %5s %5s %4d %12.6f %12.5f ; qtot % 3.3f  %-4s\n" % \
+                    (id_, oaCode, resnr, resname, aName, cgnr, charge, omass, qtot, oplsAtName)  # JDC
+                count += 1
+                temp.append(line)
+                otemp.append(oline)
+            if temp:
+                molText.append(headAtoms)
+                molText += temp
+                omolText.append(headAtoms)
+                omolText += otemp
+
+            # remove bond of water
+            temp = []
+            otemp = []
+            for bond in bonds:
+                i1, i2 = ta.bondAtoms[2 * bond:2 * bond + 2]
+                res1 = self.residueLabel[ta.resid[i1]]
+                res2 = self.residueLabel[ta.resid[i1]]
+                if 'WAT' in [res1, res2]:
+                    continue
+                a1Name = atomNames[i1]
+                a2Name = atomNames[i2]
+                id1 = atomIds[i1] - shift
+                id2 = atomIds[i2] - shift
+                oat1 = id2oplsATDict.get(id1)
+                oat2 = id2oplsATDict.get(id2)
+                rEq = ta.rEq[bond]
+                kBond = ta.kBond[bond]
+                line = "%6i %6i %3i %13.4e %13.4e ; %6s - %-6s\n" % (id1, id2, 1,
+                                                                     rEq * 0.1, kBond * 200 * cal, a1Name, a2Name)
+                oline = "%6i %6i %3i ; %13.4e %13.4e ; %6s - %-6s %6s - %-6s\n" % \
+                    (id1, id2, 1, rEq * 0.1, kBond * 200 * cal, a1Name,
+                     a2Name, oat1, oat2)
+                temp.append(line)
+                otemp.append(oline)
+            temp.sort()
+            otemp.sort()
+            if temp:
+                molText.append(headBonds)
+                molText += temp
+                omolText.append(headBonds)
+                omolText += otemp
+
+            temp = []
+            for pair in pairs:
+                i1, i2 = ta.pairAtoms[2 * pair:2 * pair + 2]
+                a1Name = atomNames[i1]
+                a2Name = atomNames[i2]
+                id1 = atomIds[i1] - shift
+                id2 = atomIds[i2] - shift
+                line = "%6i %6i %6i ; %6s - %-6s\n" % (id1, id2, 1, a1Name,
+                                                       a2Name)
+                temp.append(line)
+            temp.sort()
+            if temp:
+                molText.append(headPairs)
+                molText += temp
+                omolText.append(headPairs)
+                omolText += temp
+
+            temp = []
+            otemp = []
+            for angle in angles:
+                i1, i2, i3 = ta.angleAtoms[3 * angle:3 * angle + 3]
+                a1 = atomNames[i1]
+                a2 = atomNames[i2]
+                a3 = atomNames[i3]
+                id1 = atomIds[i1] - shift
+                id2 = atomIds[i2] - shift
+                id3 = atomIds[i3] - shift
                 oat1 = id2oplsATDict.get(id1)
                 oat2 = id2oplsATDict.get(id2)
                 oat3 = id2oplsATDict.get(id3)
-                oat4 = id2oplsATDict.get(id4)
-                c0, c1, c2, c3, c4, c5 = dih[1]
-                line = \
-                    "%6i %6i %6i %6i %6i %10.5f %10.5f %10.5f %10.5f %10.5f %10.5f" % \
-                    (id1, id2, id3, id4, 3, c0, c1, c2, c3, c4, c5) \
-                    + " ; %6s-%6s-%6s-%6s\n" % (a1, a2, a3, a4)
-                oline = \
-                    "%6i %6i %6i %6i %6i ; %10.5f %10.5f %10.5f %10.5f %10.5f %10.5f" % \
-                    (id1, id2, id3, id4, 3, c0, c1, c2, c3, c4, c5) \
-                    + " ; %6s-%6s-%6s-%6s    %4s-%4s-%4s-%4s\n" % (a1, a2, a3, a4, oat1, oat2, oat3, oat4)
+                thetaEq = ta.thetaEq[angle]
+                kTheta = ta.kTheta[angle]
+                line = "%6i %6i %6i %6i %13.4e %13.4e ; %6s - %-6s - %-6s\n" % (id1, id2,
+                                                                                id3, 1, thetaEq * radPi, 2 * cal * kTheta, a1, a2, a3)
+                oline = "%6i %6i %6i %6i ; %13.4e %13.4e ; %6s - %-4s - %-6s %4s - %+4s - %-4s\n" % \
+                    (id1, id2, id3, 1, thetaEq * radPi, 2 * cal * kTheta,
+                     a1, a2, a3, oat1, oat2, oat3)
                 temp.append(line)
                 otemp.append(oline)
             temp.sort()
             otemp.sort()
             if temp:
-                if amb2gmx:
-                    topText.append(headProDih)
-                    topText += temp
-                else:
-                    itpText.append(headProDih)
-                    itpText += temp
-                    oitpText.append(headProDih)
-                    oitpText += otemp
-            self.printDebug("GMX proper dihedrals done")
-        else:
-            self.printMess("Writing GMX dihedrals for GMX 4.5.\n")
-            funct = 9  # 9
-            for dih in self.properDihedralsGmx45:
-                a1 = dih[0][0].atomName
-                a2 = dih[0][1].atomName
-                a3 = dih[0][2].atomName
-                a4 = dih[0][3].atomName
-                id1 = dih[0][0].id
-                id2 = dih[0][1].id
-                id3 = dih[0][2].id
-                id4 = dih[0][3].id
+                molText.append(headAngles)
+                molText += temp
+                omolText.append(headAngles)
+                omolText += otemp
+
+            temp = []
+            otemp = []
+            if not self.gmx45:
+                for dih in dihsRB:
+                    i1, i2, i3, i4 = dih[0]
+                    a1 = atomNames[i1]
+                    a2 = atomNames[i2]
+                    a3 = atomNames[i3]
+                    a4 = atomNames[i4]
+                    id1 = atomIds[i1] - shift
+                    id2 = atomIds[i2] - shift
+                    id3 = atomIds[i3] - shift
+                    id4 = atomIds[i4] - shift
+                    oat1 = id2oplsATDict.get(id1)
+                    oat2 = id2oplsATDict.get(id2)
+                    oat3 = id2oplsATDict.get(id3)
+                    oat4 = id2oplsATDict.get(id4)
+                    c0, c1, c2, c3, c4, c5 = dih[1]
+                    line = \
+                        "%6i %6i %6i %6i %6i %10.5f %10.5f %10.5f %10.5f %10.5f %10.5f" % \
+                        (id1, id2, id3, id4, 3, c0, c1, c2, c3, c4, c5) \
+                        + " ; %6s-%6s-%6s-%6s\n" % (a1, a2, a3, a4)
+                    oline = \
+                        "%6i %6i %6i %6i %6i ; %10.5f %10.5f %10.5f %10.5f %10.5f %10.5f" % \
+                        (id1, id2, id3, id4, 3, c0, c1, c2, c3, c4, c5) \
+                        + " ; %6s-%6s-%6s-%6s    %4s-%4s-%4s-%4s\n" % (a1, a2, a3, a4, oat1, oat2, oat3, oat4)
+                    temp.append(line)
+                    otemp.append(oline)
+                temp.sort()
+                otemp.sort()
+                if temp:
+                    molText.append(headProDih)
+                    molText += temp
+                    omolText.append(headProDih)
+                    omolText += otemp
+            else:
+                funct = 9  # 9
+                for dih in dihsGmx45:
+                    i1, i2, i3, i4 = dih[0]
+                    a1 = atomNames[i1]
+                    a2 = atomNames[i2]
+                    a3 = atomNames[i3]
+                    a4 = atomNames[i4]
+                    id1 = atomIds[i1] - shift
+                    id2 = atomIds[i2] - shift
+                    id3 = atomIds[i3] - shift
+                    id4 = atomIds[i4] - shift
+                    ph = dih[1]  # phase already in degree
+                    kd = dih[2] * cal  # kPhi PK
+                    pn = dih[3]  # .period
+                    line = "%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
+                        (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
+                    oline = "%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
+                        (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
+                    temp.append(line)
+                    otemp.append(oline)
+                temp.sort()
+                otemp.sort()
+                if temp:
+                    molText.append(headProDihGmx45)
+                    molText += temp
+                    omolText.append(headProDihGmx45)
+                    omolText += otemp
+
+            # for properDihedralsAlphaGamma
+            if self.gmx45:
+                funct = 4  # 4
+            else:
+                funct = 1
+            temp = []
+            otemp = []
+            for dih in dihsAlphaGamma:
+                i1, i2, i3, i4 = dih[0]
+                a1 = atomNames[i1]
+                a2 = atomNames[i2]
+                a3 = atomNames[i3]
+                a4 = atomNames[i4]
+                id1 = atomIds[i1] - shift
+                id2 = atomIds[i2] - shift
+                id3 = atomIds[i3] - shift
+                id4 = atomIds[i4] - shift
                 ph = dih[1]  # phase already in degree
                 kd = dih[2] * cal  # kPhi PK
                 pn = dih[3]  # .period
@@ -2563,111 +3404,149 @@ a        """
             temp.sort()
             otemp.sort()
             if temp:
-                if amb2gmx:
-                    topText.append(headProDihGmx45)
-                    topText += temp
-                else:
-                    itpText.append(headProDihGmx45)
-                    itpText += temp
-                    oitpText.append(headProDihGmx45)
-                    oitpText += otemp
+                molText.append(headProDihAlphaGamma)
+                molText += temp
+                omolText.append(headProDihAlphaGamma)
+                omolText += otemp
+
+            temp = []
+            otemp = []
+            for dih in impDihs:
+                i1, i2, i3, i4 = ta.getDihedralAtoms(dih)
+                a1 = atomNames[i1]
+                a2 = atomNames[i2]
+                a3 = atomNames[i3]
+                a4 = atomNames[i4]
+                id1 = atomIds[i1] - shift
+                id2 = atomIds[i2] - shift
+                id3 = atomIds[i3] - shift
+                id4 = atomIds[i4] - shift
+                kd = ta.kPhi[dih] * cal
+                pn = ta.period[dih]
+                ph = ta.phase[dih] * radPi
+                line = "%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
+                    (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
+                oline = "%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
+                    (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
+                temp.append(line)
+                otemp.append(oline)
+            temp.sort()
+            otemp.sort()
+            if temp:
+                molText.append(headImpDih)
+                molText += temp
+                omolText.append(headImpDih)
+                omolText += otemp
+            return molText, omolText
 
-        # for properDihedralsAlphaGamma
+        self.setProperDihedralsCoef()
+        self.printDebug("atoms %i" % len(self.atoms))
+        self.printDebug("bonds %i" % len(self.bonds))
+        self.printDebug("atomPairs %i" % len(self.atomPairs))
+        self.printDebug("angles %i" % len(self.angles))
+        self.printDebug("properDihedralsCoefRB %i" % len(self.properDihedralsCoefRB))
+        self.printDebug("properDihedralsAlphaGamma %i" % len(self.properDihedralsAlphaGamma))
+        self.printDebug("properDihedralsGmx45 %i" % len(self.properDihedralsGmx45))
+        self.printDebug("improperDihedrals %i" % len(self.improperDihedrals))
         if self.gmx45:
-            funct = 4  # 4
+            self.printMess("Writing GMX dihedrals for GMX 4.5.\n")
+
+        numAtoms = ta.numAtoms()
+        if amb2gmx:
+            blocks = self.getMoleculeBlocks()
         else:
-            funct = 1
-        temp = []
-        otemp = []
-        for dih in self.properDihedralsAlphaGamma:
-            a1 = dih[0][0].atomName
-            a2 = dih[0][1].atomName
-            a3 = dih[0][2].atomName
-            a4 = dih[0][3].atomName
-            id1 = dih[0][0].id
-            id2 = dih[0][1].id
-            id3 = dih[0][2].id
-            id4 = dih[0][3].id
-            ph = dih[1]  # phase already in degree
-            kd = dih[2] * cal  # kPhi PK
-            pn = dih[3]  # .period
-            line = "%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-            oline = "%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-            temp.append(line)
-            otemp.append(oline)
-        temp.sort()
-        otemp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headProDihAlphaGamma)
-                topText += temp
+            blocks = [(1, numAtoms)]
+        blockOf = array('i', [0]) * numAtoms
+        for i, (first, last) in enumerate(blocks):
+            blockOf[first - 1:last] = array('i', [i]) * (last - first + 1)
+
+        def split(terms, getAtom):
+            """terms by block of their first atom (a prmtop index)"""
+            parts = [[] for i in range(len(blocks))]
+            for term in terms:
+                parts[blockOf[atomIds[getAtom(term)] - 1]].append(term)
+            return parts
+
+        termsByBlock = list(zip(split(range(len(ta.kBond)), lambda t: ta.bondAtoms[2 * t]),
+                                split(range(len(ta.pairAtoms) // 2), lambda t: ta.pairAtoms[2 * t]),
+                                split(range(len(ta.kTheta)), lambda t: ta.angleAtoms[3 * t]),
+                                split(self.properDihedralsCoefRB, lambda t: t[0][0]),
+                                split(self.properDihedralsGmx45, lambda t: t[0][0]),
+                                split(self.properDihedralsAlphaGamma, lambda t: t[0][0]),
+                                split(ta.improperIds, lambda t: ta.dihedralAtoms[4 * t])))
+
+        # one moleculetype per distinct molecule, water and ions known by
+        # amb2gmx use the templates above unless converting directly
+        species = []  # [name, text, otext, firstBlock]
+        speciesIds = {}  # text or template resname: index in species
+        molecules = []  # [speciesIndex, count] for consecutive molecules
+        for i, (first, last) in enumerate(blocks):
+            resid = ta.resid[order[first - 1]]
+            resname = self.residueLabel[resid]
+            if amb2gmx and not self.direct and resid == ta.resid[order[last - 1]] and \
+                    (resname in ionsDict or resname == 'WAT'):
+                key = resname
+                if key not in speciesIds:
+                    name = resname.upper()
+                    text = [ionsDict.get(resname, headWater)]
+                    speciesIds[key] = len(species)
+                    species.append([name, text, [], None])
             else:
-                itpText.append(headProDihAlphaGamma)
-                itpText += temp
-                oitpText.append(headProDihAlphaGamma)
-                oitpText += otemp
-        self.printDebug("GMX special proper dihedrals done")
-
-        self.printDebug("improperDihedrals %i" % len(self.improperDihedrals))
-        temp = []
-        otemp = []
-        for dih in self.improperDihedrals:
-            a1 = dih.atoms[0].atomName
-            a2 = dih.atoms[1].atomName
-            a3 = dih.atoms[2].atomName
-            a4 = dih.atoms[3].atomName
-            id1 = dih.atoms[0].id
-            id2 = dih.atoms[1].id
-            id3 = dih.atoms[2].id
-            id4 = dih.atoms[3].id
-            kd = dih.kPhi * cal
-            pn = dih.period
-            ph = dih.phase * radPi
-            line = "%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-            oline = "%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-            temp.append(line)
-            otemp.append(oline)
-        temp.sort()
-        otemp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headImpDih)
-                topText += temp
+                text, otext = moleculeText(first, last, *termsByBlock[i])
+                key = ''.join(text)
+                if key not in speciesIds:
+                    speciesIds[key] = len(species)
+                    species.append([None, text, otext, i])
+            idx = speciesIds[key]
+            if molecules and molecules[-1][0] == idx:
+                molecules[-1][1] += 1
             else:
-                itpText.append(headImpDih)
-                itpText += temp
-                oitpText.append(headImpDih)
-                oitpText += otemp
-        self.printDebug("GMX improper dihedrals done")
-
-        if not self.direct:
-            for ion in ionsSorted:
-                topText.append(ionsDict[ion[2]])
-
-            if nWat:
-                topText.append(headWater)
+                molecules.append([idx, 1])
+        self.printDebug("molecules %i, moleculetypes %i" % (len(blocks), len(species)))
+
+        molSpecies = [sp for sp in species if sp[0] is None]
+        usedNames = set([sp[0] for sp in species if sp[0]])
+        for n, sp in enumerate(molSpecies):
+            first, last = blocks[sp[3]]
+            if n == 0:  # the solute keeps the basename, as in every other mode
+                name = self.baseName
+            elif ta.resid[order[first - 1]] == ta.resid[order[last - 1]]:
+                name = self.residueLabel[ta.resid[order[first - 1]]]
+            else:
+                name = '%s_%i' % (self.baseName, n + 1)
+            uniqName = name
+            count = 1
+            while uniqName in usedNames:
+                count += 1
+                uniqName = '%s_%i' % (name, count)
+            usedNames.add(uniqName)
+            sp[0] = uniqName
+
+        for name, text, otext, firstBlock in species:
+            if firstBlock is None:  # amb2gmx template, it has its own header
+                topText += text
+            elif amb2gmx:
+                topText.append(headMoleculetype % name)
+                topText += text
+            else:
+                itpText.append(headMoleculetype % name)
+                itpText += text
+                oitpText.append(headMoleculetype % name)
+                oitpText += otext
+        self.printDebug("GMX moleculetypes done")
 
         topText.append(headSystem % (self.baseName))
         topText.append(headMols)
         otopText.append(headSystem % (self.baseName))
         otopText.append(headMols)
 
-        if nSolute > 0:
-            topText.append(" %-16s %-6i\n" % (self.baseName, nSolute))
-            otopText.append(" %-16s %-6i\n" % (self.baseName, nSolute))
+        for idx, count in molecules:
+            line = " %-16s %-6i\n" % (species[idx][0], count)
+            topText.append(line)
+            if species[idx][3] is not None:
+                otopText.append(line)
 
-        if not self.direct:
-            for ion in ionsSorted:
-                topText.append(" %-16s %-6i\n" % (ion[2].upper(), ion[1]))
-
-            if nWat:
-                topText.append(" %-16s %-6i\n" % ('WAT', nWat))
-
-        gmxDir = os.path.abspath('.')
+        gmxDir = self.absHomeDir
         topFileName = os.path.join(gmxDir, top)
         topFile = open(topFileName, 'w')
         topFile.writelines(topText)
@@ -2683,22 +3562,24 @@ a        """
             otopFile = open(otopFileName, 'w')
             otopFile.writelines(otopText)
 
+    @timedStage
     def writeGroFile(self):
         # print "Writing GROMACS GRO file\n"
         self.printDebug("writing GRO file")
         gro = self.baseName + '_GMX.gro'
-        gmxDir = os.path.abspath('.')
+        gmxDir = self.absHomeDir
         groFileName = os.path.join(gmxDir, gro)
         groFile = open(groFileName, 'w')
         groFile.write(head % (gro, date))
         groFile.write(" %i\n" % len(self.atoms))
+        ta = self.topolArrays
+        coords = scaleCoords(ta.coords, 0.1)  # in nm
         count = 1
-        for atom in self.atoms:
-            coords = [c * 0.1 for c in atom.coords]
-            resid = atom.resid
+        for i in ta.atomOrder():
+            resid = ta.resid[i]
             line = "%5d%5s%5s%5d%8.3f%8.3f%8.3f\n" % \
-                   (resid + 1, self.residueLabel[resid], atom.atomName,
-                    count, coords[0], coords[1], coords[2])
+                   (resid + 1, self.residueLabel[resid], ta.atomName[i],
+                    count, coords[3 * i], coords[3 * i + 1], coords[3 * i + 2])
             count += 1
             if count == 100000:
                 count = 0
@@ -2727,12 +3608,15 @@ a        """
                     (boxX, v22, v33, v21, v31, v12, v32, v13, v23)
         else:
             self.printDebug("Box size estimated")
-            X = [a.coords[0] * 0.1 for a in self.atoms]
-            Y = [a.coords[1] * 0.1 for a in self.atoms]
-            Z = [a.coords[2] * 0.1 for a in self.atoms]
-            boxX = max(X) - min(X)  # + 2.0 # 2.0 is double of rlist
-            boxY = max(Y) - min(Y)  # + 2.0
-            boxZ = max(Z) - min(Z)  # + 2.0
+            if np is not None:
+                boxX, boxY, boxZ = np.ptp(coords.reshape(-1, 3), axis=0)
+            else:
+                X = coords[0::3]
+                Y = coords[1::3]
+                Z = coords[2::3]
+                boxX = max(X) - min(X)  # + 2.0 # 2.0 is double of rlist
+                boxY = max(Y) - min(Y)  # + 2.0
+                boxZ = max(Z) - min(Z)  # + 2.0
             text = "%11.5f %11.5f %11.5f\n" % (boxX, boxY, boxZ)
         groFile.write(text)
 
@@ -2749,15 +3633,16 @@ nsteps                   = 500
 integrator               = md
 nsteps                   = 1000
 """.format(base=self.baseName)
-        emMdpFile = open('em.mdp', 'w')
-        mdMdpFile = open('md.mdp', 'w')
+        emMdpFile = open(os.path.join(self.absHomeDir, 'em.mdp'), 'w')
+        mdMdpFile = open(os.path.join(self.absHomeDir, 'md.mdp'), 'w')
         emMdpFile.write(emMdp)
         mdMdpFile.write(mdMdp)
 
+    @timedStage
     def writeCnsTopolFiles(self):
         autoAngleFlag = True
         autoDihFlag = True
-        cnsDir = os.path.abspath('.')
+        cnsDir = self.absHomeDir
 
         pdb = self.baseName + '_NEW.pdb'
         par = self.baseName + '_CNS.par'
@@ -2787,15 +3672,21 @@ nsteps                   = 1000
         parFile.write("Remarks " + head % (par, date))
         parFile.write("\nset echo=false end\n")
 
+        # atoms and bonded terms from the topolArrays columns, by prmtop index
+        ta = self.loadTopolArrays()
+        atomNames = ta.atomName
+        atomTypes = [name + '_' for name in ta.getTypeNames()]
+
         parFile.write("\n{ Bonds: atomType1 atomType2 kb r0 }\n")
         lineSet = []
-        for bond in self.bonds:
-            a1Type = bond.atoms[0].atomType.atomTypeName + '_'
-            a2Type = bond.atoms[1].atomType.atomTypeName + '_'
+        for bond in range(len(ta.kBond)):
+            i1, i2 = ta.bondAtoms[2 * bond:2 * bond + 2]
+            a1Type = atomTypes[i1]
+            a2Type = atomTypes[i2]
             kb = 1000.0
             if not self.allhdg:
-                kb = bond.kBond
-            r0 = bond.rEq
+                kb = ta.kBond[bond]
+            r0 = ta.rEq[bond]
             line = "BOND %5s %5s %8.1f %8.4f\n" % (a1Type, a2Type, kb, r0)
             lineRev = "BOND %5s %5s %8.1f %8.4f\n" % (a2Type, a1Type, kb, r0)
             if line not in lineSet:
@@ -2806,14 +3697,12 @@ nsteps                   = 1000
 
         parFile.write("\n{ Angles: aType1 aType2 aType3 kt t0 }\n")
         lineSet = []
-        for angle in self.angles:
-            a1 = angle.atoms[0].atomType.atomTypeName + '_'
-            a2 = angle.atoms[1].atomType.atomTypeName + '_'
-            a3 = angle.atoms[2].atomType.atomTypeName + '_'
+        for angle in range(len(ta.kTheta)):
+            a1, a2, a3 = [atomTypes[i] for i in ta.angleAtoms[3 * angle:3 * angle + 3]]
             kt = 500.0
             if not self.allhdg:
-                kt = angle.kTheta
-            t0 = angle.thetaEq * radPi
+                kt = ta.kTheta[angle]
+            t0 = ta.thetaEq[angle] * radPi
             line = "ANGLe %5s %5s %5s %8.1f %8.2f\n" % (a1, a2, a3, kt, t0)
             lineRev = "ANGLe %5s %5s %5s %8.1f %8.2f\n" % (a3, a2, a1, kt, t0)
             if line not in lineSet:
@@ -2825,21 +3714,20 @@ nsteps                   = 1000
         parFile.write("\n{ Proper Dihedrals: aType1 aType2 aType3 aType4 kt per\
 iod phase }\n")
         lineSet = set()
-        for item in self.condensedProperDihedrals:
+        start = ta.condensedStart
+        for n in range(len(start) - 1):
             seq = ''
             id_ = 0
+            item = ta.properIds[start[n]:start[n + 1]]
             for dih in item:
                 # id_ = item.index(dih)
                 l = len(item)
-                a1 = dih.atoms[0].atomType.atomTypeName + '_'
-                a2 = dih.atoms[1].atomType.atomTypeName + '_'
-                a3 = dih.atoms[2].atomType.atomTypeName + '_'
-                a4 = dih.atoms[3].atomType.atomTypeName + '_'
+                a1, a2, a3, a4 = [atomTypes[i] for i in ta.getDihedralAtoms(dih)]
                 kp = 750.0
                 if not self.allhdg:
-                    kp = dih.kPhi
-                p = dih.period
-                ph = dih.phase * radPi
+                    kp = ta.kPhi[dih]
+                p = ta.period[dih]
+                ph = ta.phase[dih] * radPi
                 if l > 1:
                     if id_ == 0:
                         line = "DIHEdral %5s %5s %5s %5s  MULT %1i %7.3f %4i %8\
@@ -2858,16 +3746,13 @@ iod phase }\n")
         parFile.write("\n{ Improper Dihedrals: aType1 aType2 aType3 aType4 kt p\
 eriod phase }\n")
         lineSet = set()
-        for idh in self.improperDihedrals:
-            a1 = idh.atoms[0].atomType.atomTypeName + '_'
-            a2 = idh.atoms[1].atomType.atomTypeName + '_'
-            a3 = idh.atoms[2].atomType.atomTypeName + '_'
-            a4 = idh.atoms[3].atomType.atomTypeName + '_'
+        for idh in ta.improperIds:
+            a1, a2, a3, a4 = [atomTypes[i] for i in ta.getDihedralAtoms(idh)]
             kp = 750.0
             if not self.allhdg:
-                kp = idh.kPhi
-            p = idh.period
-            ph = idh.phase * radPi
+                kp = ta.kPhi[idh]
+            p = ta.period[idh]
+            ph = ta.phase[idh] * radPi
             line = "IMPRoper %5s %5s %5s %5s %13.1f %4i %8.2f\n" % (a1, a2, a3,
                                                                     a4, kp, p, ph)
             lineSet.add(line)
@@ -2923,50 +3808,39 @@ eriod phase }\n")
         topFile.write("\nGROUP\n")
 
         topFile.write("\n{ atomName  atomType  Charge }\n")
-        for at in self.atoms:
-            atName = at.atomName
-            atType = at.atomType.atomTypeName + '_'
-            charge = at.charge
+        for i in ta.atomOrder():
+            atName = atomNames[i]
+            atType = atomTypes[i]
+            charge = ta.charge[i]
             line = "ATOM %-5s TYPE= %-5s CHARGE= %8.4f END\n" % (atName, atType,
                                                                  charge)
             topFile.write(line)
 
         topFile.write("\n{ Bonds: atomName1  atomName2 }\n")
-        for bond in self.bonds:
-            a1Name = bond.atoms[0].atomName
-            a2Name = bond.atoms[1].atomName
+        for bond in range(len(ta.kBond)):
+            a1Name, a2Name = [atomNames[i] for i in ta.bondAtoms[2 * bond:2 * bond + 2]]
             line = "BOND %-5s %-5s\n" % (a1Name, a2Name)
             topFile.write(line)
 
         if not autoAngleFlag or 1:  # generating angles anyway
             topFile.write("\n{ Angles: atomName1 atomName2 atomName3}\n")
-            for angle in self.angles:
-                a1Name = angle.atoms[0].atomName
-                a2Name = angle.atoms[1].atomName
-                a3Name = angle.atoms[2].atomName
+            for angle in range(len(ta.kTheta)):
+                a1Name, a2Name, a3Name = [atomNames[i] for i in ta.angleAtoms[3 * angle:3 * angle + 3]]
                 line = "ANGLe %-5s %-5s %-5s\n" % (a1Name, a2Name, a3Name)
                 topFile.write(line)
 
         if not autoDihFlag or 1:  # generating angles anyway
             topFile.write("\n{ Proper Dihedrals: name1 name2 name3 name4 }\n")
-            for item in self.condensedProperDihedrals:
-                for dih in item:
-                    l = len(item)
-                    a1Name = dih.atoms[0].atomName
-                    a2Name = dih.atoms[1].atomName
-                    a3Name = dih.atoms[2].atomName
-                    a4Name = dih.atoms[3].atomName
-                    line = "DIHEdral %-5s %-5s %-5s %-5s\n" % (a1Name, a2Name,
-                                                               a3Name, a4Name)
-                    break
+            for n in range(len(start) - 1):
+                a1Name, a2Name, a3Name, a4Name = [atomNames[i] for i in
+                                                  ta.getDihedralAtoms(ta.properIds[start[n]])]
+                line = "DIHEdral %-5s %-5s %-5s %-5s\n" % (a1Name, a2Name,
+                                                           a3Name, a4Name)
                 topFile.write(line)
 
         topFile.write("\n{ Improper Dihedrals: aName1 aName2 aName3 aName4 }\n")
-        for dih in self.improperDihedrals:
-            a1Name = dih.atoms[0].atomName
-            a2Name = dih.atoms[1].atomName
-            a3Name = dih.atoms[2].atomName
-            a4Name = dih.atoms[3].atomName
+        for dih in ta.improperIds:
+            a1Name, a2Name, a3Name, a4Name = [atomNames[i] for i in ta.getDihedralAtoms(dih)]
             line = "IMPRoper %-5s %-5s %-5s %-5s\n" % (a1Name, a2Name, a3Name,
                                                        a4Name)
             topFile.write(line)
@@ -3060,9 +3934,9 @@ stop
         dictInp['CNS_ran'] = self.baseName + '_rand.pdb'
         line = inpData % dictInp
         inpFile.write(line)
-        if os.path.exists(self.obchiralExe):
+        if self.chiral and os.path.exists(self.obchiralExe):
             self.printDebug("chiralGroups %i" % len(self.chiralGroups))
-        else:
+        elif self.chiral:
             self.printDebug("No 'obchiral' to process chiral atoms. Consider installing http://openbabel.org")
 
 
@@ -3076,7 +3950,8 @@ class ACTopol(AbstractTopol):
                  multiplicity='1', atomType='gaff', force=False, basename=None,
                  debug=False, outTopol='all', engine='tleap', allhdg=False,
                  timeTol=36000, qprog='sqm', ekFlag=None, verbose=True,
-                 gmx45=False, disam=False, direct=False, is_sorted=False, chiral=False):
+                 gmx45=False, disam=False, direct=False, is_sorted=False, chiral=False,
+                 useCache=False):
 
         self.debug = debug
         self.verbose = verbose
@@ -3085,6 +3960,8 @@ class ACTopol(AbstractTopol):
         self.direct = direct
         self.sorted = is_sorted
         self.chiral = chiral
+        self.stages = []  # see timeStage
+        self.stagesStart = None
         self.inputFile = os.path.basename(inputFile)
         self.rootDir = os.path.abspath('.')
         self.absInputFile = os.path.abspath(inputFile)
@@ -3095,6 +3972,7 @@ class ACTopol(AbstractTopol):
         self.baseOriginal = baseOriginal
         self.baseName = base  # name of the input file without ext.
         self.timeTol = timeTol
+        self.deadline = None  # set before guessCharge, so its tools are timed too
         self.printDebug("Max execution time tolerance is %s" % elapsedTime(self.timeTol))
         self.ext = ext
         if ekFlag == '"None"' or ekFlag is None:
@@ -3103,11 +3981,15 @@ class ACTopol(AbstractTopol):
             self.ekFlag = '-ek %s' % ekFlag
         self.extOld = ext
         self.homeDir = self.baseName + '.acpype'
+        self.absHomeDir = os.path.join(self.rootDir, self.homeDir)
         self.chargeType = chargeType
         self.chargeVal = chargeVal
         self.multiplicity = multiplicity
         self.atomType = atomType
         self.force = force
+        self.acCache = None
+        if useCache:
+            self.acCache = ResultCache()
         self.engine = engine
         self.allhdg = allhdg
         self.acExe = ''
@@ -3141,6 +4023,7 @@ class ACTopol(AbstractTopol):
         self.acFrcmodFileName = acBase + '.frcmod'
         self.tmpDir = os.path.join(self.rootDir, '.acpype_tmp_%s' % os.path.basename(base))
         self.setResNameCheckCoords()
+        self.deadline = monotonic() + self.timeTol
         self.guessCharge()
         acMol2FileName = '%s_%s_%s.mol2' % (base, chargeType, atomType)
         self.acMol2FileName = acMol2FileName
@@ -3194,12 +4077,31 @@ class MolTopol(ACTopol):
         RETURN: molTopol obj or None
     """
 
+    residueLabel = LazyAttribute('residueLabel', 'getResidueLabel')
+    atoms = LazyAttribute('atoms', 'getAtoms')
+    prmtopAtoms = LazyAttribute('prmtopAtoms', 'getAtoms')
+    atomTypes = LazyAttribute('atomTypes', 'getAtoms')
+    topolArrays = LazyAttribute('topolArrays', 'getAtoms')
+    totalCharge = LazyAttribute('totalCharge', 'getAtoms')
+    atomTypeSystem = LazyAttribute('atomTypeSystem', 'getAtoms')
+    _atomTypeNameList = LazyAttribute('_atomTypeNameList', 'getAtoms')
+    pbc = LazyAttribute('pbc', 'getAtoms')
+    bonds = LazyAttribute('bonds', 'getBonds')
+    bondGraph = LazyAttribute('bondGraph', 'getBondGraph')
+    angles = LazyAttribute('angles', 'getAngles')
+    properDihedrals = LazyAttribute('properDihedrals', 'getDihedrals')
+    improperDihedrals = LazyAttribute('improperDihedrals', 'getDihedrals')
+    condensedProperDihedrals = LazyAttribute('condensedProperDihedrals', 'getDihedrals')
+    atomPairs = LazyAttribute('atomPairs', 'getDihedrals')
+    chiralGroups = LazyAttribute('chiralGroups', 'getChirals')
+    obchiralExe = LazyAttribute('obchiralExe', 'getObchiralExe')
+
     def __init__(self, acTopolObj=None, acFileXyz=None, acFileTop=None,
                  debug=False, basename=None, verbose=True, gmx45=False,
-                 disam=False, direct=False, is_sorted=False, chiral=False):
+                 disam=False, direct=False, is_sorted=False, chiral=False,
+                 useMmap=False, parseCache=False):
 
         self.chiral = chiral
-        self.obchiralExe = _getoutput('which obchiral') or ''
         self.allhdg = False
         self.debug = debug
         self.gmx45 = gmx45
@@ -3208,12 +4110,16 @@ class MolTopol(ACTopol):
         self.sorted = is_sorted
         self.verbose = verbose
         self.inputFile = acFileTop
+        self.absHomeDir = os.path.abspath('.')
         if acTopolObj:
+            self.absHomeDir = acTopolObj.absHomeDir
             if not acFileXyz:
-                acFileXyz = acTopolObj.acXyzFileName
+                acFileXyz = acTopolObj.homePath(acTopolObj.acXyzFileName)
             if not acFileTop:
-                acFileTop = acTopolObj.acTopFileName
+                acFileTop = acTopolObj.homePath(acTopolObj.acTopFileName)
             self._parent = acTopolObj
+            self.stages = acTopolObj.stages  # one run report for both
+            self.stagesStart = acTopolObj.stagesStart
             self.allhdg = self._parent.allhdg
             self.debug = self._parent.debug
             self.inputFile = self._parent.inputFile
@@ -3226,13 +4132,10 @@ class MolTopol(ACTopol):
 #             self.printError("no 'obchiral' executable, it won't work to store non-planar improper dihedrals!")
 #             self.printWarn("Consider installing http://openbabel.org")
 
-        self.xyzFileData = open(acFileXyz, 'r').readlines()
-        self.topFileData = open(acFileTop, 'r').readlines()
-        self.printDebug("prmtop and inpcrd files loaded")
+        self.loadFiles(acFileXyz, acFileTop, useMmap, parseCache)
 
 #        self.pointers = self.getFlagData('POINTERS')
 
-        self.getResidueLabel()
         if len(self.residueLabel) > 1:
             self.baseName = basename or os.path.splitext(os.path.basename(acFileTop))[0]  # 'solute'
         else:
@@ -3241,16 +4144,9 @@ class MolTopol(ACTopol):
             self.baseName = basename or acTopolObj.baseName
         self.printDebug("basename defined = '%s'" % self.baseName)
 
-        self.getAtoms()
-
-        self.getBonds()
-
-        self.getAngles()
-
-        self.getDihedrals()
-
-        self.getChirals()
-        if not os.path.exists(self.obchiralExe) and self.chiral:
+        # atoms, bonds, angles, dihedrals and chiralGroups are parsed on
+        # first access, so writers only pay for what they use
+        if self.chiral and not os.path.exists(self.obchiralExe):
             self.printError("no 'obchiral' executable, it won't work to store non-planar improper dihedrals!")
             self.printWarn("Consider installing http://openbabel.org")
         elif self.chiral and not self.chiralGroups:
@@ -3273,8 +4169,349 @@ class MolTopol(ACTopol):
             self.printMess("Sorting atoms for gromacs ordering.\n")
             self.sortAtomsForGromacs()
 
+    @timedStage
+    def loadFiles(self, acFileXyz, acFileTop, useMmap=False, parseCache=False):
+        """
+            Read (or memory map) acFileXyz and acFileTop; with parseCache the
+            prmtop sections come from the parse cache, the prmtop being read
+            only for the ones not there yet
+        """
+        self.xyzFileName = acFileXyz
+        self.topFileName = os.path.abspath(acFileTop)
+        if useMmap:
+            self.xyzFileData = None
+            self.topFileData = None
+
+            def makeReader():
+                return MmapPrmtopReader(acFileTop)
+            self.printDebug("prmtop and inpcrd files memory mapped")
+        else:
+            self.xyzFileData = open(acFileXyz, 'r').readlines()
+            self.topFileData = None if parseCache else open(acFileTop, 'r').readlines()
+
+            def makeReader():
+                return PrmtopReader(open(acFileTop, 'r').readlines())
+            self.printDebug("prmtop and inpcrd files loaded")
+        if parseCache:
+            cache = PrmtopCache()
+            try:
+                self.prmtopReader = CachedPrmtopReader(cache, cache.getKey(acFileTop), makeReader)
+                self.printDebug("prmtop sections read through the cache '%s'" % cache.cacheDir)
+            except (IOError, OSError) as e:
+                self.printWarn("prmtop parse cache not used: %s" % e)
+                self.prmtopReader = makeReader()
+                self.topFileData = self.prmtopReader.lines
+        elif useMmap:
+            self.prmtopReader = makeReader()
+
+    def getObchiralExe(self):
+        self.obchiralExe = _getoutput('which obchiral') or ''
+
+
+class LazyObjectList(object):
+
+    """
+        Read-only sequence creating its items with factory(index) on first
+        access and keeping them, so the same index always returns the same
+        object. It is pickled as a plain list.
+    """
+
+    def __init__(self, size, factory):
+        self.size = size
+        self.factory = factory
+        self.cache = [None] * size
+
+    def __len__(self):
+        return self.size
 
-class Atom(object):
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(self.size))]
+        if index < 0:
+            index += self.size
+        if not 0 <= index < self.size:
+            raise IndexError("LazyObjectList index out of range")
+        item = self.cache[index]
+        if item is None:
+            item = self.factory(index)
+            self.cache[index] = item
+        return item
+
+    def __iter__(self):
+        for i in range(self.size):
+            yield self[i]
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+class BondGraph(object):
+
+    """
+        Bonded neighbours of every atom in CSR layout, built once from the
+        bond atom indices (0-based, flat pairs): the neighbours of atom i are
+        neighbours[start[i]:start[i + 1]], in the order of the bonds.
+    """
+
+    def __init__(self, numAtoms, bondAtoms):
+        start = array('i', [0]) * (numAtoms + 1)
+        for i in bondAtoms:
+            start[i + 1] += 1
+        for i in range(numAtoms):
+            start[i + 1] += start[i]
+        fill = start[:-1]
+        neighbours = array('i', [0]) * len(bondAtoms)
+        for k in range(0, len(bondAtoms), 2):
+            i, j = bondAtoms[k], bondAtoms[k + 1]
+            neighbours[fill[i]] = j
+            fill[i] += 1
+            neighbours[fill[j]] = i
+            fill[j] += 1
+        self.start = start
+        self.neighbours = neighbours
+
+    def numAtoms(self):
+        return len(self.start) - 1
+
+    def getNeighbours(self, i):
+        return self.neighbours[self.start[i]:self.start[i + 1]]
+
+    def getDegree(self, i):
+        return self.start[i + 1] - self.start[i]
+
+    def getShells(self, i, depth=3):
+        """
+            [[1-2], [1-3], [1-4]] partners of atom i (for depth 3), each atom
+            in the shell of its shortest bond path from i
+        """
+        start = self.start
+        neighbours = self.neighbours
+        seen = set([i])
+        shell = [i]
+        shells = []
+        for _n in range(depth):
+            nextShell = []
+            for j in shell:
+                for k in neighbours[start[j]:start[j + 1]]:
+                    if k not in seen:
+                        seen.add(k)
+                        nextShell.append(k)
+            shells.append(nextShell)
+            shell = nextShell
+        return shells
+
+
+class TopolArrays(object):
+
+    """
+        Topology parsed from a prmtop as a structure of arrays: one typed
+        column (stdlib array) per attribute instead of one Python object per
+        atom, bond, angle and dihedral. Atom indices are 0-based and units
+        are the prmtop ones, but charges in units of the electron charge.
+        Columns expose the buffer protocol, e.g. with numpy:
+            numpy.frombuffer(ta.coords).reshape(-1, 3) * 0.1  # in nm
+        The GMX and CNS writers read these columns, so Atom, Bond, Angle
+        and Dihedral objects are only made for code using MolTopol.atoms,
+        .bonds and so on.
+    """
+
+    def __init__(self):
+        # atoms
+        self.atomName = []
+        self.atomTypeId = array('i')
+        self.resid = array('i')
+        self.mass = array('d')
+        self.charge = array('d')
+        self.coords = array('d')  # x1, y1, z1, x2, ... in Ang.
+        self.velocities = None  # same layout, only from restart files
+        self.order = None  # atom indices in output order, None if as in prmtop
+        self.atomIds = None  # 1-based output id of each atom, None if as in prmtop
+        self.cgnr = None  # charge group of each atom, set by sortAtomsForGromacs
+        # atom types
+        self.typeName = []
+        self.typeMass = array('d')
+        self.ACOEF = array('d')
+        self.BCOEF = array('d')
+        # bonded terms, atom indices in flat groups of 2, 3 and 4
+        self.bondAtoms = array('i')
+        self.kBond = array('d')
+        self.rEq = array('d')
+        self.angleAtoms = array('i')
+        self.kTheta = array('d')
+        self.thetaEq = array('d')  # rad
+        self.dihedralAtoms = array('i')
+        self.kPhi = array('d')
+        self.period = array('i')
+        self.phase = array('d')  # rad
+        self.properIds = array('i')  # indices of proper dihedrals
+        self.improperIds = array('i')  # indices of improper dihedrals
+        self.condensedStart = array('i')  # properIds[start[i]:start[i + 1]] share a quartet
+        self.pairAtoms = array('i')  # 1-4 pairs
+
+    def numAtoms(self):
+        return len(self.atomName)
+
+    def addAtomType(self, atomTypeName, mass, ACOEF, BCOEF):
+        self.typeName.append(atomTypeName)
+        self.typeMass.append(mass)
+        self.ACOEF.append(ACOEF)
+        self.BCOEF.append(BCOEF)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ('coords', 'velocities'):
+            if np is not None and isinstance(state[key], np.ndarray):
+                state[key] = array('d', state[key].tobytes())  # loadable without numpy
+        return state
+
+    def addAtom(self, atomName, atomTypeId, resid, mass, charge):
+        self.atomName.append(atomName)
+        self.atomTypeId.append(atomTypeId)
+        self.resid.append(resid)
+        self.mass.append(mass)
+        self.charge.append(charge)
+
+    def getCoord(self, i):
+        return [float(c) for c in self.coords[3 * i:3 * i + 3]]
+
+    def atomOrder(self):
+        if self.order is None:
+            return range(self.numAtoms())
+        return self.order
+
+    def getAtomIds(self):
+        if self.atomIds is None:
+            return array('i', range(1, self.numAtoms() + 1))
+        return self.atomIds
+
+    def setOrder(self, order, cgnr):
+        '''output order of the atoms (prmtop indices) and their charge groups'''
+        self.order = order
+        self.cgnr = cgnr
+        self.atomIds = array('i', [0]) * len(order)
+        for k, i in enumerate(order):
+            self.atomIds[i] = k + 1
+
+    def getTypeNames(self):
+        '''atom type name of each atom'''
+        return [self.typeName[t] for t in self.atomTypeId]
+
+    def getDihedralAtoms(self, i):
+        return tuple(self.dihedralAtoms[4 * i:4 * i + 4])
+
+    def setBonds(self, bondCodeList, uniqKbList, uniqReqList):
+        self.bondAtoms = array('i')
+        self.kBond = array('d')
+        self.rEq = array('d')
+        for i in range(0, len(bondCodeList), 3):
+            bondTypeId = bondCodeList[i + 2] - 1
+            self.bondAtoms.append(bondCodeList[i] // 3)  # remember python starts with id 0
+            self.bondAtoms.append(bondCodeList[i + 1] // 3)
+            self.kBond.append(uniqKbList[bondTypeId])
+            self.rEq.append(uniqReqList[bondTypeId])
+
+    def setAngles(self, angleCodeList, uniqKtList, uniqTeqList):
+        self.angleAtoms = array('i')
+        self.kTheta = array('d')
+        self.thetaEq = array('d')
+        for i in range(0, len(angleCodeList), 4):
+            angleTypeId = angleCodeList[i + 3] - 1
+            self.angleAtoms.append(angleCodeList[i] // 3)
+            self.angleAtoms.append(angleCodeList[i + 1] // 3)
+            self.angleAtoms.append(angleCodeList[i + 2] // 3)
+            self.kTheta.append(uniqKtList[angleTypeId])
+            self.thetaEq.append(uniqTeqList[angleTypeId])
+
+    def setDihedrals(self, dihCodeList, uniqKpList, uniqPeriodList, uniqPhaseList):
+        self.dihedralAtoms = array('i')
+        self.kPhi = array('d')
+        self.period = array('i')
+        self.phase = array('d')
+        self.properIds = array('i')
+        self.improperIds = array('i')
+        self.condensedStart = array('i')
+        self.pairAtoms = array('i')
+        pairs = set()
+        quadPrev = None
+        for i in range(0, len(dihCodeList), 5):
+            idAtom1 = dihCodeList[i] // 3
+            idAtom2 = dihCodeList[i + 1] // 3
+            # 3 and 4 indexes can be negative: if id3 < 0, end group interations
+            # in amber are to be ignored; if id4 < 0, dihedral is improper
+            idAtom3raw = dihCodeList[i + 2] // 3  # can be negative -> exclude from 1-4vdw
+            idAtom4raw = dihCodeList[i + 3] // 3  # can be negative -> Improper
+            quad = (idAtom1, idAtom2, abs(idAtom3raw), abs(idAtom4raw))
+            dihTypeId = dihCodeList[i + 4] - 1
+            kPhi = uniqKpList[dihTypeId]  # already divided by IDIVF
+            period = int(uniqPeriodList[dihTypeId])  # integer
+            phase = uniqPhaseList[dihTypeId]  # angle given in rad in prmtop
+            if phase == kPhi == 0:
+                period = 0  # period is set to 0
+            dihId = len(self.kPhi)
+            self.dihedralAtoms.extend(quad)
+            self.kPhi.append(kPhi)
+            self.period.append(period)
+            self.phase.append(phase)
+            if idAtom4raw > 0:
+                if not (idAtom3raw < 0 and quad == quadPrev):
+                    self.condensedStart.append(len(self.properIds))
+                self.properIds.append(dihId)
+                quadPrev = quad
+                pair = (quad[0], quad[3])
+                if idAtom3raw > 0 and pair not in pairs:
+                    pairs.add(pair)
+                    self.pairAtoms.extend(pair)
+            else:
+                self.improperIds.append(dihId)
+        self.condensedStart.append(len(self.properIds))
+
+    def makeAtomType(self, i):
+        return AtomType(self.typeName[i], self.typeMass[i], self.ACOEF[i], self.BCOEF[i])
+
+    def makeAtom(self, i, atomTypes):
+        atom = Atom(self.atomName[i], atomTypes[self.atomTypeId[i]], i + 1,
+                    self.resid[i], self.mass[i], self.charge[i], self.getCoord(i))
+        if self.atomIds is not None:
+            atom.id = self.atomIds[i]
+            atom.cgnr = self.cgnr[i]
+        return atom
+
+    def makeBond(self, i, atoms):
+        ids = self.bondAtoms[2 * i:2 * i + 2]
+        return Bond([atoms[j] for j in ids], self.kBond[i], self.rEq[i])
+
+    def makeAngle(self, i, atoms):
+        ids = self.angleAtoms[3 * i:3 * i + 3]
+        return Angle([atoms[j] for j in ids], self.kTheta[i], self.thetaEq[i])
+
+    def makeDihedral(self, i, atoms):
+        ids = self.dihedralAtoms[4 * i:4 * i + 4]
+        return Dihedral([atoms[j] for j in ids], self.kPhi[i], self.period[i], self.phase[i])
+
+    def makePair(self, i, atoms):
+        return (atoms[self.pairAtoms[2 * i]], atoms[self.pairAtoms[2 * i + 1]])
+
+
+class CompactObject(object):
+
+    """
+        Base of the model classes below: attributes live in __slots__, not
+        in a per-instance __dict__, and are pickled as a dict of attributes,
+        so pickles from before the slots still load and vice versa.
+    """
+
+    __slots__ = ()
+
+    def __getstate__(self):
+        return dict([(name, getattr(self, name)) for name in self.__slots__
+                     if hasattr(self, name)])
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+
+class Atom(CompactObject):
 
     """
         Charges in prmtop file has to be divide by 18.2223 to convert to charge
@@ -3291,6 +4528,8 @@ class Atom(object):
         Coord is given in Ang. and mass in Atomic Mass Unit.
     """
 
+    __slots__ = ('atomName', 'atomType', 'id', 'cgnr', 'resid', 'mass', 'charge', 'coords')
+
     def __init__(self, atomName, atomType, id_, resid, mass, charge, coord):
         self.atomName = atomName
         self.atomType = atomType
@@ -3308,12 +4547,15 @@ class Atom(object):
         return '<Atom id=%s, name=%s, %s>' % (self.id, self.atomName, self.atomType)
 
 
-class AtomType(object):
+class AtomType(CompactObject):
 
     """
-        AtomType per atom in gaff or amber.
+        AtomType per atom in gaff or amber, one instance shared by all atoms
+        of the same type.
     """
 
+    __slots__ = ('atomTypeName', 'mass', 'ACOEF', 'BCOEF')
+
     def __init__(self, atomTypeName, mass, ACOEF, BCOEF):
         self.atomTypeName = atomTypeName
         self.mass = mass
@@ -3327,12 +4569,14 @@ class AtomType(object):
         return '<AtomType=%s>' % self.atomTypeName
 
 
-class Bond(object):
+class Bond(CompactObject):
 
     """
         attributes: pair of Atoms, spring constant (kcal/mol), dist. eq. (Ang)
     """
 
+    __slots__ = ('atoms', 'kBond', 'rEq')
+
     def __init__(self, atoms, kBond, rEq):
         self.atoms = atoms
         self.kBond = kBond
@@ -3345,12 +4589,14 @@ class Bond(object):
         return '<%s, r=%s>' % (self.atoms, self.rEq)
 
 
-class Angle(object):
+class Angle(CompactObject):
 
     """
         attributes: 3 Atoms, spring constant (kcal/mol/rad^2), angle eq. (rad)
     """
 
+    __slots__ = ('atoms', 'kTheta', 'thetaEq')
+
     def __init__(self, atoms, kTheta, thetaEq):
         self.atoms = atoms
         self.kTheta = kTheta
@@ -3363,13 +4609,15 @@ class Angle(object):
         return '<%s, ang=%.2f>' % (self.atoms, self.thetaEq * 180 / Pi)
 
 
-class Dihedral(object):
+class Dihedral(CompactObject):
 
     """
         attributes: 4 Atoms, spring constant (kcal/mol), periodicity,
         phase (rad)
     """
 
+    __slots__ = ('atoms', 'kPhi', 'period', 'phase')
+
     def __init__(self, atoms, kPhi, period, phase):
         self.atoms = atoms
         self.kPhi = kPhi
@@ -3382,6 +4630,125 @@ class Dihedral(object):
     def __repr__(self):
         return '<%s, ang=%.2f>' % (self.atoms, self.phase * 180 / Pi)
 
+batchExts = ('.mol2', '.mdl', '.mol', '.pdb')
+batchListExts = ('.txt', '.lst')
+
+
+def listBatchInputs(args):
+    """
+        Input files for --batch, in the given order and without repeats;
+        each arg may be an input file, a directory (its files with extension
+        in batchExts), a list file (extension in batchListExts) with one input
+        per line or a glob pattern
+    """
+    inputs = []
+    for arg in args:
+        if os.path.isdir(arg):
+            found = sorted([os.path.join(arg, f) for f in os.listdir(arg)
+                            if os.path.splitext(f)[1] in batchExts])
+        elif os.path.isfile(arg) and os.path.splitext(arg)[1] in batchListExts:
+            listDir = os.path.dirname(arg)
+            found = []
+            for line in open(arg):
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    found.append(os.path.join(listDir, line))
+        elif os.path.isfile(arg):
+            if os.path.splitext(arg)[1] not in batchExts:
+                raise Exception("'%s': not an input (%s) nor a list of inputs (%s) for '--batch'"
+                                % (arg, ', '.join(batchExts), ', '.join(batchListExts)))
+            found = [arg]
+        else:
+            found = sorted(glob.glob(arg))
+        for inputFile in found:
+            inputFile = os.path.abspath(inputFile)
+            if inputFile not in inputs:
+                inputs.append(inputFile)
+    return inputs
+
+
+def runBatchJob(job):
+    """
+        Run the ACTopol pipeline for one --batch input, in a pool worker.
+        Its output goes to <basename>.acpype/acpype.log.
+        Returns (inputFile, failed, seconds, message)
+    """
+    inputFile, basename, rootDir, acKwargs = job
+    t0 = time.time()
+    homeDir = os.path.join(rootDir, basename + '.acpype')
+    if not os.path.exists(homeDir):
+        os.mkdir(homeDir)
+    logFileName = os.path.join(homeDir, 'acpype.log')
+    logFile = open(logFileName, 'w')
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = logFile
+    failed = True
+    try:
+        try:
+            molecule = ACTopol(inputFile, basename=basename, **acKwargs)
+            if not molecule.acExe:
+                raise Exception("no 'antechamber' executable")
+            molecule.createACTopol()
+            molecule.createMolTopol()
+            failed = False
+            msg = ''
+        except SystemExit:  # some checks abort with sys.exit
+            msg = "aborted, see '%s'" % logFileName
+        except Exception as e:
+            traceback.print_exc(file=logFile)
+            msg = str(e)
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+        logFile.close()
+        rmtree(os.path.join(rootDir, '.acpype_tmp_%s' % basename), ignore_errors=True)
+    return inputFile, failed, time.time() - t0, msg
+
+
+def runBatch(inputFiles, numJobs, acKwargs):
+    """
+        Run runBatchJob for every input file on a pool of numJobs processes,
+        printing a status line as each one finishes. Outputs go to
+        <basename>.acpype in the current dir, basenames made unique.
+        Returns the number of failed inputs
+    """
+    rootDir = os.path.abspath('.')
+    jobs = []
+    baseNames = set()
+    for inputFile in inputFiles:
+        base = os.path.splitext(os.path.basename(inputFile))[0]
+        name = base
+        count = 1
+        while name in baseNames:
+            count += 1
+            name = '%s_%i' % (base, count)
+        baseNames.add(name)
+        jobs.append((inputFile, name, rootDir, acKwargs))
+    total = len(jobs)
+    print("Running %i inputs on %i processes ..." % (total, numJobs))
+    failures = 0
+    pool = multiprocessing.Pool(numJobs)
+    try:
+        done = 0
+        for inputFile, failed, seconds, msg in pool.imap_unordered(runBatchJob, jobs):
+            done += 1
+            failures += failed
+            status = failed and 'FAILED' or 'OK'
+            line = "[%*i/%i] %-6s %s (%.1fs)" % (len(str(total)), done, total, status,
+                                                 inputFile, seconds)
+            if msg:
+                line += ': %s' % msg
+            print(line)
+            sys.stdout.flush()
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    print("%i inputs done, %i failed" % (total, failures))
+    return failures
+
+
 if __name__ == '__main__':
     t0 = time.time()
     print(header)
@@ -3475,7 +4842,7 @@ if __name__ == '__main__':
                       type='int',
                       default=36000,
                       dest='max_time',
-                      help="max time (in sec) tolerance for sqm/mopac, default is 10 hours",)
+                      help="max time (in sec) tolerance for antechamber (sqm/mopac) and leap, default is 10 hours",)
     parser.add_option('-y', '--ipython',
                       action="store_true",
                       dest='ipython',
@@ -3501,6 +4868,32 @@ if __name__ == '__main__':
                       action="store_true",
                       dest='chiral',
                       help="create improper dihedral parameters for chiral atoms in CNS",)
+    parser.add_option('--batch',
+                      action="store_true",
+                      dest='batch',
+                      help="run acpype for every input given as arguments: files, directories (their '.mol2', '.mdl', '.mol' and '.pdb' files), glob patterns or '.txt'/'.lst' files listing inputs; each one gets its own 'basename.acpype' folder",)
+    parser.add_option('--jobs',
+                      action="store",
+                      type='int',
+                      default=multiprocessing.cpu_count(),
+                      dest='jobs',
+                      help="for '--batch', number of inputs processed in parallel, default is the number of CPUs",)
+    parser.add_option('--mmap',
+                      action="store_true",
+                      dest='mmap',
+                      help="for 'amb2gmx' mode, read prmtop and inpcrd through memory maps (very large systems)",)
+    parser.add_option('--ac_cache',
+                      action="store_true",
+                      dest='ac_cache',
+                      help="reuse antechamber (mol2) and parmchk (frcmod) results for the same input and options from a per-user cache (~/.cache/acpype or $ACPYPE_CACHE_DIR)",)
+    parser.add_option('--parse_cache',
+                      action="store_true",
+                      dest='parse_cache',
+                      help="for 'amb2gmx' mode, keep decoded prmtop sections in a per-user cache (~/.cache/acpype or $ACPYPE_CACHE_DIR) and reuse them for unchanged files",)
+    parser.add_option('--memprofile',
+                      action="store_true",
+                      dest='memprofile',
+                      help="trace memory allocations (python 3 tracemalloc) and report, for every stage (parsing, each writer, ...), traced memory, peak and top allocation sites; slow",)
 
     options, remainder = parser.parse_args()
 
@@ -3509,7 +4902,14 @@ if __name__ == '__main__':
 #     if options.chiral:
 #         options.cnstop = True
 
-    if not options.input:
+    if options.batch:
+        if options.input or options.inpcrd or options.prmtop or options.basename:
+            parser.error("options '-i', '-p', '-x' and '-b' can't be used with '--batch'")
+        if not remainder:
+            parser.error("missing input files for '--batch'")
+        if options.jobs < 1:
+            parser.error("option --jobs must be at least 1")
+    elif not options.input:
         amb2gmx = True
         if not options.inpcrd or not options.prmtop:
             parser.error("missing input files")
@@ -3523,27 +4923,54 @@ if __name__ == '__main__':
     if options.direct and not amb2gmx:
         parser.error("option -u is only meaningful in 'amb2gmx' mode")
 
+    if options.mmap and not amb2gmx:
+        parser.error("option --mmap is only meaningful in 'amb2gmx' mode")
+
+    if options.ac_cache and amb2gmx:
+        parser.error("option --ac_cache is not meaningful in 'amb2gmx' mode")
+
+    if options.parse_cache and not amb2gmx:
+        parser.error("option --parse_cache is only meaningful in 'amb2gmx' mode")
+
+    if options.memprofile:
+        if tracemalloc is None:
+            parser.error("option --memprofile needs python 3.4 or higher")
+        if options.batch:
+            parser.error("option --memprofile can't be used with '--batch'")
+        tracemalloc.start()
+
+    acKwargs = dict(chargeType=options.charge_method,
+                    chargeVal=options.net_charge, debug=options.debug,
+                    multiplicity=options.multiplicity, atomType=options.atom_type,
+                    force=options.force, outTopol=options.outtop,
+                    engine=options.engine, allhdg=options.cnstop,
+                    timeTol=options.max_time,
+                    qprog=options.qprog, ekFlag='''"%s"''' % options.keyword,
+                    verbose=options.verboseless, gmx45=options.gmx45,
+                    disam=options.disambiguate, direct=options.direct,
+                    is_sorted=options.sorted, chiral=options.chiral,
+                    useCache=options.ac_cache)
+
     try:
-        if amb2gmx:
+        if options.batch:
+            inputFiles = listBatchInputs(remainder)
+            if not inputFiles:
+                raise Exception("no input files found for '--batch'")
+            if runBatch(inputFiles, options.jobs, acKwargs):
+                raise Exception("some inputs failed")
+        elif amb2gmx:
             print("Converting Amber input files to Gromacs ...")
             system = MolTopol(acFileXyz=options.inpcrd, acFileTop=options.prmtop,
                               debug=options.debug, basename=options.basename,
                               verbose=options.verboseless, gmx45=options.gmx45,
                               disam=options.disambiguate, direct=options.direct,
-                              is_sorted=options.sorted, chiral=options.chiral)
+                              is_sorted=options.sorted, chiral=options.chiral,
+                              useMmap=options.mmap, parseCache=options.parse_cache)
             system.printDebug("prmtop and inpcrd files parsed")
             system.writeGromacsTopolFiles(amb2gmx=True)
+            system.printMemProfile()
         else:
-            molecule = ACTopol(options.input, chargeType=options.charge_method,
-                               chargeVal=options.net_charge, debug=options.debug,
-                               multiplicity=options.multiplicity, atomType=options.atom_type,
-                               force=options.force, outTopol=options.outtop,
-                               engine=options.engine, allhdg=options.cnstop,
-                               basename=options.basename, timeTol=options.max_time,
-                               qprog=options.qprog, ekFlag='''"%s"''' % options.keyword,
-                               verbose=options.verboseless, gmx45=options.gmx45,
-                               disam=options.disambiguate, direct=options.direct,
-                               is_sorted=options.sorted, chiral=options.chiral)
+            molecule = ACTopol(options.input, basename=options.basename, **acKwargs)
 
             if not molecule.acExe:
                 molecule.printError("no 'antechamber' executable... aborting ! ")
@@ -3555,6 +4982,7 @@ if __name__ == '__main__':
 
             molecule.createACTopol()
             molecule.createMolTopol()
+            molecule.printMemProfile()
         acpypeFailed = False
     except:
         exceptionType, exceptionValue, exceptionTraceback = sys.exc_info()
@@ -3584,7 +5012,3 @@ if __name__ == '__main__':
         pass
     if acpypeFailed:
         sys.exit(1)
-    try:
-        os.chdir(molecule.rootDir)
-    except:
-        pass
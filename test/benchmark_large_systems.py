@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+# usage: ./benchmark_large_systems.py [-s 1e3,1e4,1e5,1e6] [-k water,polymer]
+#                                     [-u] [--json out.json]
+#
+# Scaling benchmark of the amb2gmx path on synthetic systems written by
+# synthetic_systems.py: for every kind and size it times, and takes the peak
+# RSS after, MolTopol (parsing atoms, bonds, angles and dihedrals),
+# setAtomType4Gromacs, writeGroFile, writeGromacsTop and writeCnsTopolFiles.
+#
+# Every case runs in its own python process so peak memory of one case
+# doesn't hide the next one. '-u' converts water and ions directly instead
+# of using the amb2gmx templates.
+
+import sys
+import os
+import json
+import time
+import optparse
+import tempfile
+import subprocess
+from shutil import rmtree
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(testDir))
+
+stageNames = ['MolTopol', 'setAtomType4Gromacs', 'writeGroFile', 'writeGromacsTop',
+              'writeCnsTopolFiles']
+
+
+def runCase(kind, natoms, workDir, direct):
+    '''one case in this process, returns its results'''
+    from acpype import MolTopol  # @UnresolvedImport
+    from synthetic_systems import writeSystem  # @UnresolvedImport
+
+    baseName = os.path.join(workDir, '%s_%i' % (kind, natoms))
+    t0 = time.time()
+    result = {'kind': kind, 'natoms': writeSystem(kind, natoms, baseName),
+              'generate': time.time() - t0,
+              'prmtopSize': os.path.getsize(baseName + '.prmtop')}
+    os.chdir(workDir)
+
+    t0 = time.time()
+    molecule = MolTopol(acFileXyz=baseName + '.inpcrd', acFileTop=baseName + '.prmtop',
+                        verbose=False, direct=direct)
+    initWall = time.time() - t0
+    initStages = molecule.stages or []  # loadFiles
+    stages = molecule.stages = []
+    with molecule.timeStage('MolTopol') as stage:
+        for attr in ('atoms', 'bonds', 'angles', 'properDihedrals'):
+            getattr(molecule, attr)
+    stage['wall'] = round(stage['wall'] + initWall, 4)
+    with molecule.timeStage('setAtomType4Gromacs'):
+        molecule.setAtomType4Gromacs()
+    with molecule.timeStage('writeGroFile'):
+        molecule.writeGroFile()
+    with molecule.timeStage('writeGromacsTop'):
+        molecule.writeGromacsTop(amb2gmx=True)
+    with molecule.timeStage('writeCnsTopolFiles'):
+        molecule.writeCnsTopolFiles()
+    result['stages'] = [st for st in stages if st['depth'] == 0]
+    result['subStages'] = initStages + [st for st in stages if st['depth'] > 0]
+    return result
+
+
+def runChild(kind, natoms, direct):
+    '''runCase in a new process, returns its results or None if it failed'''
+    workDir = tempfile.mkdtemp(prefix='acpype_large_')
+    cmd = [sys.executable, os.path.abspath(__file__), '--child', kind, str(natoms), workDir]
+    if direct:
+        cmd.append('-u')
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        lines = proc.communicate()[0].decode('utf-8', 'replace').strip().splitlines()
+        try:
+            return json.loads(lines[-1])
+        except (IndexError, ValueError):
+            print("%s %i failed (exit status %i):\n%s" % (kind, natoms, proc.returncode, '\n'.join(lines)))
+            return None
+    finally:
+        rmtree(workDir)
+
+
+def report(results):
+    head = '  %-8s %9s %9s' % ('kind', 'atoms', 'generate')
+    for name in stageNames:
+        head += ' %12s' % name[:12]
+    print("\nwall time, sec. (peak RSS after the stage, MB)")
+    print(head)
+    for res in results:
+        line = '  %-8s %9i %9.2f' % (res['kind'], res['natoms'], res['generate'])
+        for stage in res['stages']:
+            line += ' %12s' % ('%.2f (%i)' % (stage['wall'], (stage.get('maxRss') or 0) // 1024))
+        print(line)
+    print("\nper atom, usec.")
+    print(head)
+    for res in results:
+        line = '  %-8s %9i %9.2f' % (res['kind'], res['natoms'], 1e6 * res['generate'] / res['natoms'])
+        for stage in res['stages']:
+            line += ' %12.2f' % (1e6 * stage['wall'] / res['natoms'])
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-s', '--sizes', dest='sizes', default='1e3,1e4,1e5,1e6',
+                      help="number of atoms, comma separated (default 1e3,1e4,1e5,1e6)")
+    parser.add_option('-k', '--kinds', dest='kinds', default='water,polymer',
+                      help="synthetic systems, water and/or polymer (default both)")
+    parser.add_option('-u', '--direct', action='store_true', dest='direct', default=False,
+                      help="convert water and ions directly, not with amb2gmx templates")
+    parser.add_option('--json', dest='json', help="also write the results to this file")
+    parser.add_option('--child', action='store_true', dest='child', default=False,
+                      help="internal, run one case: --child kind natoms workdir")
+    options, args = parser.parse_args()
+
+    if options.child:
+        kind, natoms, workDir = args
+        print(json.dumps(runCase(kind, int(natoms), workDir, options.direct)))
+        sys.exit(0)
+
+    t0 = time.time()
+    results = []
+    for kind in options.kinds.split(','):
+        for size in options.sizes.split(','):
+            res = runChild(kind, int(float(size)), options.direct)
+            if res:
+                results.append(res)
+                print("%s %i atoms done in %.1fs" % (kind, res['natoms'],
+                                                     sum([st['wall'] for st in res['stages']])))
+    report(results)
+    if options.json:
+        json.dump(results, open(options.json, 'w'), indent=1, sort_keys=True)
+    print("\nTotal time of execution: %.1fs" % (time.time() - t0))
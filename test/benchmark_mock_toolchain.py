@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+# usage: ./benchmark_mock_toolchain.py [-n 200] [-c bcc] [--json out.json] [mols]
+#        ./benchmark_mock_toolchain.py --record [mols]   (needs AmberTools)
+#
+# Times ACTopol + createACTopol + createMolTopol over many iterations with
+# mock_toolchain.py standing in for antechamber, parmchk, tleap and babel,
+# so Python side regressions (parsing, writing, orchestration) show up
+# without real QM. Per-stage times come from the acpype run report stages.
+#
+# mols are basenames of the inputs in this dir (AAA, DDD, FFF, KKK, dmp; a
+# '.pdb' suffix runs the pdb input instead of the mol2 one). A molecule is
+# replayed from mock_recordings/<mol>; '--record' fills that dir from a run
+# of the real toolchain. Only 'dmp' runs by default, replayed from
+# Data/Ligand.acpype if not recorded; the others need '--record' first.
+
+import sys
+import os
+import json
+import time
+import optparse
+import tempfile
+from shutil import copyfile, rmtree
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(testDir))
+
+from acpype import ACTopol  # @UnresolvedImport
+
+recordingsDir = os.path.join(testDir, 'mock_recordings')
+mockTools = ['antechamber', 'parmchk', 'tleap', 'babel']
+defaultMols = ['dmp']  # the only one with outputs in the tree
+
+# recording file: file in Data/Ligand.acpype, the outputs for dmp
+ligandFiles = {'antechamber.mol2': 'Ligand_bcc_gaff.mol2', 'sqm.in': 'sqm.in',
+               'sqm.out': 'sqm.out', 'charmm.rtf': 'Ligand_CHARMM.rtf',
+               'charmm.prm': 'Ligand_CHARMM.prm', 'charmm.inp': 'Ligand_CHARMM.inp',
+               'parmchk.frcmod': 'Ligand_AC.frcmod', 'tleap.prmtop': 'Ligand_AC.prmtop',
+               'tleap.inpcrd': 'Ligand_AC.inpcrd', 'tleap.lib': 'Ligand_AC.lib'}
+
+
+def inputFile(mol):
+    if mol.endswith('.pdb'):
+        return os.path.join(testDir, mol)
+    return os.path.join(testDir, mol + '.mol2')
+
+
+def makeMockBin(binDir):
+    '''wrappers named as the real programs calling mock_toolchain.py'''
+    for tool in mockTools:
+        path = os.path.join(binDir, tool)
+        open(path, 'w').write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' %
+                              (sys.executable, os.path.join(testDir, 'mock_toolchain.py'), tool))
+        os.chmod(path, 0o755)
+
+
+def getRecording(mol, workDir):
+    recDir = os.path.join(recordingsDir, mol.replace('.pdb', ''))
+    if os.path.isdir(recDir):
+        return recDir
+    if mol.replace('.pdb', '') == 'dmp':
+        recDir = os.path.join(workDir, 'recording_dmp')
+        os.mkdir(recDir)
+        for name, fileName in ligandFiles.items():
+            copyfile(os.path.join(testDir, 'Data', 'Ligand.acpype', fileName),
+                     os.path.join(recDir, name))
+        return recDir
+    return None
+
+
+def record(mols, chargeType):
+    '''run the real toolchain once per molecule and keep its outputs'''
+    for mol in mols:
+        base = os.path.basename(mol).replace('.pdb', '')
+        recDir = os.path.join(recordingsDir, base)
+        workDir = tempfile.mkdtemp(prefix='acpype_record_')
+        os.chdir(workDir)
+        molecule = ACTopol(inputFile(mol), chargeType=chargeType, debug=True, force=True)
+        molecule.createACTopol()
+        molecule.createMolTopol()
+        outputs = {'antechamber.mol2': molecule.acMol2FileName, 'sqm.in': 'sqm.in',
+                   'sqm.out': 'sqm.out', 'charmm.rtf': molecule.charmmBase + '.rtf',
+                   'charmm.prm': molecule.charmmBase + '.prm',
+                   'charmm.inp': molecule.charmmBase + '.inp',
+                   'parmchk.frcmod': molecule.acFrcmodFileName,
+                   'tleap.prmtop': molecule.acTopFileName, 'tleap.inpcrd': molecule.acXyzFileName,
+                   'tleap.lib': molecule.acBaseName + '.lib'}
+        if not os.path.exists(recDir):
+            os.makedirs(recDir)
+        for name, fileName in outputs.items():
+            path = molecule.homePath(fileName)
+            if os.path.exists(path):
+                copyfile(path, os.path.join(recDir, name))
+        open(os.path.join(recDir, 'tleap.out'), 'w').write(getattr(molecule, 'tleapLog', ''))
+        os.chdir(testDir)
+        rmtree(workDir)
+        print("recorded %s in %s" % (mol, recDir))
+
+
+def runOnce(mol, chargeType):
+    '''one pipeline run in the current dir, returns {stage: wall}'''
+    times = {}
+    t0 = time.time()
+    molecule = ACTopol(inputFile(mol), chargeType=chargeType, verbose=False, force=True)
+    times['ACTopol'] = time.time() - t0
+    t1 = time.time()
+    molecule.createACTopol()
+    times['createACTopol'] = time.time() - t1
+    t1 = time.time()
+    molecule.createMolTopol()
+    times['createMolTopol'] = time.time() - t1
+    times['total'] = time.time() - t0
+    for stage in molecule.stages:
+        name = '  ' * (stage['depth'] + 1) + stage['stage']
+        times[name] = times.get(name, 0.0) + stage['wall']
+    return times
+
+
+def benchmark(mols, num, chargeType):
+    benchDir = tempfile.mkdtemp(prefix='acpype_bench_')
+    binDir = os.path.join(benchDir, 'bin')
+    os.mkdir(binDir)
+    makeMockBin(binDir)
+    os.environ['PATH'] = binDir + os.pathsep + os.environ.get('PATH', '')
+    for var in ('AMBERHOME', 'ACHOME'):
+        os.environ.pop(var, None)
+    recordings = {}
+    for mol in mols:
+        recDir = getRecording(mol, benchDir)
+        if recDir:
+            recordings[mol] = recDir
+        else:
+            print("skipping %s: no recording, run with '--record' where AmberTools is installed" % mol)
+    results = {}
+    try:
+        for _i in range(num):
+            for mol in mols:
+                if mol not in recordings:
+                    continue
+                os.environ['ACPYPE_MOCK_RECORDING'] = recordings[mol]
+                runDir = tempfile.mkdtemp(dir=benchDir)
+                os.chdir(runDir)
+                times = runOnce(mol, chargeType)
+                os.chdir(benchDir)
+                rmtree(runDir)
+                molResult = results.setdefault(mol, {})
+                for name, wall in times.items():
+                    molResult.setdefault(name, []).append(wall)
+    finally:
+        os.chdir(testDir)
+        rmtree(benchDir)
+    return results
+
+
+def report(results):
+    for mol in sorted(results):
+        stages = results[mol]
+        runs = len(stages['total'])
+        total = sum(stages['total'])
+        print("\n%s: %i runs, %.1f ms/run, %.2f runs/s" % (mol, runs, 1000 * total / runs, runs / total))
+        print("  %-36s %10s %8s" % ('stage', 'ms/run', '% run'))
+        for name in ['ACTopol', 'createACTopol', 'createMolTopol']:
+            print("  %-36s %10.2f %8.1f" % (name, 1000 * sum(stages[name]) / runs,
+                                           100 * sum(stages[name]) / total))
+        for name in sorted([n for n in stages if n.startswith(' ')],
+                           key=lambda n: -sum(stages[n])):
+            print("  %-36s %10.2f %8.1f" % (name, 1000 * sum(stages[name]) / runs,
+                                           100 * sum(stages[name]) / total))
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options] [mols]")
+    parser.add_option('-n', dest='num', type='int', default=200, help="iterations (default 200)")
+    parser.add_option('-c', dest='chargeType', default='bcc', help="charge method (default bcc)")
+    parser.add_option('--json', dest='json', help="also write the timings (sec.) to this file")
+    parser.add_option('--record', action='store_true', dest='record', default=False,
+                      help="record the outputs of the real toolchain for mols")
+    options, args = parser.parse_args()
+    mols = args or defaultMols
+
+    if options.record:
+        record(mols, options.chargeType)
+        sys.exit(0)
+
+    t0 = time.time()
+    results = benchmark(mols, options.num, options.chargeType)
+    report(results)
+    if options.json:
+        json.dump(results, open(options.json, 'w'), indent=1, sort_keys=True)
+    print("\nTotal time of execution: %.1fs" % (time.time() - t0))
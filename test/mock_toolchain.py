@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# usage: mock_toolchain.py antechamber|parmchk|tleap|babel _args_
+#
+# Stand-in for the AmberTools and OpenBabel programs called by acpype. It
+# replays the outputs recorded for a molecule in the dir given by
+# $ACPYPE_MOCK_RECORDING (see benchmark_mock_toolchain.py), so the acpype
+# pipeline can run, and be timed, without AmberTools.
+#
+# Recording files:
+#   antechamber.mol2                 antechamber -fo mol2 output
+#   sqm.in, sqm.out                  left by antechamber when it runs sqm
+#   charmm.rtf, charmm.prm, charmm.inp   antechamber -fo charmm outputs
+#   parmchk.frcmod                   parmchk output
+#   tleap.prmtop, tleap.inpcrd, tleap.lib, tleap.out   tleap outputs and log
+#   babel.mol2                       babel -omol2 output (optional)
+
+import os
+import re
+import sys
+from shutil import copyfile
+
+
+def recorded(name):
+    recDir = os.environ.get('ACPYPE_MOCK_RECORDING')
+    if not recDir:
+        sys.exit("mock_toolchain: ACPYPE_MOCK_RECORDING not set")
+    path = os.path.join(recDir, name)
+    if not os.path.exists(path):
+        return None
+    return path
+
+
+def replay(name, dest, needed=True):
+    path = recorded(name)
+    if path:
+        copyfile(path, dest)
+    elif needed:
+        sys.exit("mock_toolchain: no recorded '%s'" % name)
+
+
+def getOpt(args, flag, default=None):
+    if flag in args:
+        return args[args.index(flag) + 1]
+    return default
+
+
+def antechamber(args):
+    out = getOpt(args, '-o')
+    fo = getOpt(args, '-fo')
+    if fo == 'mol2':
+        if getOpt(args, '-c') in ('bcc', 'mul'):
+            replay('sqm.in', 'sqm.in', False)
+            replay('sqm.out', 'sqm.out', False)
+        replay('antechamber.mol2', out)
+    elif fo == 'charmm':
+        for ext in ('rtf', 'prm', 'inp'):
+            replay('charmm.' + ext, '%s.%s' % (out, ext), False)
+    else:
+        sys.exit("mock_toolchain: antechamber output format '%s' not recorded" % fo)
+
+
+def parmchk(args):
+    replay('parmchk.frcmod', getOpt(args, '-o'))
+
+
+def tleap(args):
+    script = open(getOpt(args, '-f')).read()
+    match = re.search(r'saveamberparm\s+\S+\s+(\S+)\s+(\S+)', script)
+    replay('tleap.prmtop', match.group(1))
+    replay('tleap.inpcrd', match.group(2))
+    match = re.search(r'saveoff\s+\S+\s+(\S+)', script)
+    if match:
+        replay('tleap.lib', match.group(1), False)
+    log = recorded('tleap.out')
+    if log:
+        sys.stdout.write(open(log).read())
+    open('leap.log', 'w').write(log and open(log).read() or '')
+
+
+def babel(args):
+    out = [arg[6:] for arg in args if arg.startswith('-omol2')][0] or args[-1]
+    if recorded('babel.mol2'):
+        replay('babel.mol2', out)
+    else:
+        replay('antechamber.mol2', out)
+
+
+if __name__ == '__main__':
+    tools = {'antechamber': antechamber, 'parmchk': parmchk, 'tleap': tleap, 'babel': babel}
+    if len(sys.argv) < 2 or sys.argv[1] not in tools:
+        sys.exit("usage: mock_toolchain.py %s _args_" % '|'.join(sorted(tools)))
+    tools[sys.argv[1]](sys.argv[2:])
@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+
+# usage: ./synthetic_systems.py water|polymer natoms [basename]
+#
+# Writes a synthetic AMBER prmtop/inpcrd pair of about natoms atoms, to feed
+# the amb2gmx path (acpype -p basename.prmtop -x basename.inpcrd) with large
+# systems without running tleap:
+#
+#   water    Ligand_AC from Data/Ligand.acpype, counter ions, Na+/Cl- pairs
+#            (about 0.15 M) and TIP3P waters on a cubic lattice, in a box
+#   polymer  one polyethylene chain (GAFF c3/hc) of (natoms - 2) / 3 units,
+#            one residue per unit
+#
+# Nonbonded parameters of all atom types are combined with Lorentz-Berthelot
+# rules and the exclusion list is built from the bonds, as tleap does.
+
+import sys
+import os
+import math
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(testDir))
+
+from acpype import PrmtopReader, decodeInpcrd  # @UnresolvedImport
+
+ligandDir = os.path.join(testDir, 'Data', 'Ligand.acpype')
+chargeFactor = 18.2223  # prmtop charge units per e
+
+# type: (rmin/2, epsilon), from parm10.dat, frcmod.ionsjc_tip3p and gaff.dat
+ljParams = {'OW': (1.7683, 0.1520), 'HW': (0.0, 0.0), 'Na+': (1.369, 0.0874393),
+            'Cl-': (2.513, 0.0355910), 'c3': (1.9080, 0.1094), 'hc': (1.4870, 0.0157)}
+watSpacing = 3.1  # lattice spacing for waters and ions, ~1 g/cm^3
+ionsPerWater = 1.0 / 370  # Na+/Cl- pairs per water, ~0.15 M
+polymerRow = 100  # CH2 units per row of the folded chain
+
+
+class Fragment(object):
+
+    """
+        Atoms and bonded terms of one molecule, with the parameters held in
+        the terms, ready to be added many times to a SyntheticSystem.
+    """
+
+    def __init__(self):
+        self.atoms = []  # [name, type, charge (e), mass, residue index]
+        self.residues = []  # [label, ...]
+        self.bonds = []  # (i, j, (kb, b0))
+        self.angles = []  # (i, j, k, (kt, t0))
+        self.dihedrals = []  # (i, j, k, l, (kp, periodicity, phase), no14, improper)
+        self.coords = []  # [x, y, z] per atom
+
+
+class SyntheticSystem(object):
+
+    """
+        Fragments stacked into one prmtop, parameters tables shared
+    """
+
+    def __init__(self, title):
+        self.title = title
+        self.atoms = []
+        self.coords = []
+        self.resLabels = []
+        self.resPointers = []
+        self.bonds = []  # [i, j, paramIdx], 0 based
+        self.angles = []
+        self.dihedrals = []  # [i, j, k, l, paramIdx, no14, improper]
+        self.bondParams = {}  # params: idx
+        self.angleParams = {}
+        self.dihParams = {}
+        self.types = {}  # type name: type index, 0 based
+        self.box = None
+
+    def addFragment(self, frag, shift=(0.0, 0.0, 0.0)):
+        off = len(self.atoms)
+        roff = len(self.resLabels)
+        lastRes = -1
+        for name, aType, charge, mass, res in frag.atoms:
+            if aType not in self.types:
+                self.types[aType] = len(self.types)
+            if res != lastRes:
+                self.resLabels.append(frag.residues[res])
+                self.resPointers.append(len(self.atoms))
+                lastRes = res
+            self.atoms.append((name, aType, charge, mass, roff + res))
+        for x, y, z in frag.coords:
+            self.coords.append((x + shift[0], y + shift[1], z + shift[2]))
+        for i, j, par in frag.bonds:
+            idx = self.bondParams.setdefault(par, len(self.bondParams))
+            self.bonds.append((off + i, off + j, idx))
+        for i, j, k, par in frag.angles:
+            idx = self.angleParams.setdefault(par, len(self.angleParams))
+            self.angles.append((off + i, off + j, off + k, idx))
+        for i, j, k, l, par, no14, improper in frag.dihedrals:
+            idx = self.dihParams.setdefault(par, len(self.dihParams))
+            self.dihedrals.append((off + i, off + j, off + k, off + l, idx, no14, improper))
+
+    def isHydrogen(self, i):
+        return self.atoms[i][3] < 2.0
+
+    def getExclusions(self):
+        '''1-2, 1-3 and 1-4 partners with a higher index, per atom'''
+        neighbours = [[] for i in range(len(self.atoms))]
+        for i, j, idx in self.bonds:
+            neighbours[i].append(j)
+            neighbours[j].append(i)
+        excluded = []
+        for i in range(len(self.atoms)):
+            found = set(neighbours[i])
+            shell = neighbours[i]
+            for _n in range(2):
+                nextShell = []
+                for j in shell:
+                    for k in neighbours[j]:
+                        if k != i and k not in found:
+                            found.add(k)
+                            nextShell.append(k)
+                shell = nextShell
+            excluded.append(sorted([j for j in found if j > i]))
+        return excluded
+
+    def getLJ(self):
+        '''nonbonded index and A, B coefficients, Lorentz-Berthelot rules'''
+        ntypes = len(self.types)
+        names = sorted(self.types, key=self.types.get)
+        nbIndex = [0] * (ntypes * ntypes)
+        acoef = []
+        bcoef = []
+        for j in range(ntypes):
+            for i in range(j + 1):
+                ri, ei = ljParams[names[i]]
+                rj, ej = ljParams[names[j]]
+                rij = ri + rj
+                eij = math.sqrt(ei * ej)
+                acoef.append(eij * rij ** 12)
+                bcoef.append(2 * eij * rij ** 6)
+                nbIndex[ntypes * i + j] = nbIndex[ntypes * j + i] = len(acoef)
+        return nbIndex, acoef, bcoef
+
+    def getTermLists(self):
+        bondsH, bondsA = [], []
+        for i, j, idx in self.bonds:
+            dest = bondsH if self.isHydrogen(i) or self.isHydrogen(j) else bondsA
+            dest += [3 * i, 3 * j, idx + 1]
+        anglesH, anglesA = [], []
+        for i, j, k, idx in self.angles:
+            dest = anglesH if self.isHydrogen(i) or self.isHydrogen(k) else anglesA
+            dest += [3 * i, 3 * j, 3 * k, idx + 1]
+        dihsH, dihsA = [], []
+        for i, j, k, l, idx, no14, improper in self.dihedrals:
+            if k == 0 or l == 0:  # a zero index can't carry the sign flags
+                i, j, k, l = l, k, j, i
+            dest = dihsH if True in [self.isHydrogen(n) for n in (i, j, k, l)] else dihsA
+            dest += [3 * i, 3 * j, -3 * k if no14 else 3 * k, -3 * l if improper else 3 * l, idx + 1]
+        return bondsH, bondsA, anglesH, anglesA, dihsH, dihsA
+
+    def writePrmtop(self, fileName):
+        natom = len(self.atoms)
+        excluded = self.getExclusions()
+        nbIndex, acoef, bcoef = self.getLJ()
+        bondsH, bondsA, anglesH, anglesA, dihsH, dihsA = self.getTermLists()
+        numExcl = [len(ex) or 1 for ex in excluded]
+        exclList = []
+        for ex in excluded:
+            exclList += [j + 1 for j in ex] or [0]
+        resPointers = [p + 1 for p in self.resPointers]
+        resSizes = [b - a for a, b in zip(resPointers, resPointers[1:] + [natom + 1])]
+        bondPars = sorted(self.bondParams, key=self.bondParams.get)
+        anglePars = sorted(self.angleParams, key=self.angleParams.get)
+        dihPars = sorted(self.dihParams, key=self.dihParams.get)
+        pointers = [natom, len(self.types), len(bondsH) // 3, len(bondsA) // 3,
+                    len(anglesH) // 4, len(anglesA) // 4, len(dihsH) // 5, len(dihsA) // 5,
+                    0, 0, len(exclList), len(self.resLabels), len(bondsA) // 3,
+                    len(anglesA) // 4, len(dihsA) // 5, len(bondPars), len(anglePars),
+                    len(dihPars), 1, 0, 0, 0, 0, 0, 0, 0, 0, self.box and 1 or 0,
+                    max(resSizes), 0, 0]
+        sections = [('TITLE', '20a4', [self.title]),
+                    ('POINTERS', '10I8', pointers),
+                    ('ATOM_NAME', '20a4', [a[0] for a in self.atoms]),
+                    ('CHARGE', '5E16.8', [a[2] * chargeFactor for a in self.atoms]),
+                    ('MASS', '5E16.8', [a[3] for a in self.atoms]),
+                    ('ATOM_TYPE_INDEX', '10I8', [self.types[a[1]] + 1 for a in self.atoms]),
+                    ('NUMBER_EXCLUDED_ATOMS', '10I8', numExcl),
+                    ('NONBONDED_PARM_INDEX', '10I8', nbIndex),
+                    ('RESIDUE_LABEL', '20a4', self.resLabels),
+                    ('RESIDUE_POINTER', '10I8', resPointers),
+                    ('BOND_FORCE_CONSTANT', '5E16.8', [p[0] for p in bondPars]),
+                    ('BOND_EQUIL_VALUE', '5E16.8', [p[1] for p in bondPars]),
+                    ('ANGLE_FORCE_CONSTANT', '5E16.8', [p[0] for p in anglePars]),
+                    ('ANGLE_EQUIL_VALUE', '5E16.8', [p[1] for p in anglePars]),
+                    ('DIHEDRAL_FORCE_CONSTANT', '5E16.8', [p[0] for p in dihPars]),
+                    ('DIHEDRAL_PERIODICITY', '5E16.8', [p[1] for p in dihPars]),
+                    ('DIHEDRAL_PHASE', '5E16.8', [p[2] for p in dihPars]),
+                    ('SOLTY', '5E16.8', [0.0]),
+                    ('LENNARD_JONES_ACOEF', '5E16.8', acoef),
+                    ('LENNARD_JONES_BCOEF', '5E16.8', bcoef),
+                    ('BONDS_INC_HYDROGEN', '10I8', bondsH),
+                    ('BONDS_WITHOUT_HYDROGEN', '10I8', bondsA),
+                    ('ANGLES_INC_HYDROGEN', '10I8', anglesH),
+                    ('ANGLES_WITHOUT_HYDROGEN', '10I8', anglesA),
+                    ('DIHEDRALS_INC_HYDROGEN', '10I8', dihsH),
+                    ('DIHEDRALS_WITHOUT_HYDROGEN', '10I8', dihsA),
+                    ('EXCLUDED_ATOMS_LIST', '10I8', exclList),
+                    ('HBOND_ACOEF', '5E16.8', []),
+                    ('HBOND_BCOEF', '5E16.8', []),
+                    ('HBCUT', '5E16.8', []),
+                    ('AMBER_ATOM_TYPE', '20a4', [a[1] for a in self.atoms]),
+                    ('TREE_CHAIN_CLASSIFICATION', '20a4', ['BLA'] * natom),
+                    ('JOIN_ARRAY', '10I8', [0] * natom),
+                    ('IROTAT', '10I8', [0] * natom)]
+        if self.box:
+            nmol = len(self.getMolSizes())
+            sections += [('SOLVENT_POINTERS', '3I8', [len(self.resLabels), nmol, 2]),
+                         ('ATOMS_PER_MOLECULE', '10I8', self.getMolSizes()),
+                         ('BOX_DIMENSIONS', '5E16.8', [90.0] + list(self.box))]
+        sections += [('RADIUS_SET', '1a80', ['modified Bondi radii (mbondi)']),
+                     ('RADII', '5E16.8', [1.5] * natom),
+                     ('SCREEN', '5E16.8', [0.8] * natom)]
+        out = open(fileName, 'w')
+        out.write('%-80s\n' % '%VERSION  VERSION_STAMP = V0001.000  DATE = 01/01/20  00:00:00')
+        for flag, fmt, data in sections:
+            out.write('%%FLAG %-74s\n%%FORMAT(%s)%s\n' % (flag, fmt, ' ' * (71 - len(fmt))))
+            writeFortran(out, fmt, data)
+        out.close()
+
+    def getMolSizes(self):
+        '''atoms per molecule, from the bonds, molecules being consecutive'''
+        reach = list(range(len(self.atoms)))
+        for i, j, idx in self.bonds:
+            a, b = min(i, j), max(i, j)
+            reach[a] = max(reach[a], b)
+        sizes = []
+        first = last = 0
+        for i in range(len(reach)):
+            last = max(last, reach[i])
+            if i == last:
+                sizes.append(last - first + 1)
+                first = i + 1
+        return sizes
+
+    def writeInpcrd(self, fileName):
+        out = open(fileName, 'w')
+        out.write('%s\n%6i\n' % (self.title, len(self.coords)))
+        flat = [c for xyz in self.coords for c in xyz]
+        for i in range(0, len(flat), 6):
+            out.write(''.join(['%12.7f' % c for c in flat[i:i + 6]]) + '\n')
+        if self.box:
+            out.write(''.join(['%12.7f' % c for c in list(self.box) + [90.0, 90.0, 90.0]]) + '\n')
+        out.close()
+
+
+def writeFortran(out, fmt, data):
+    '''write data in a prmtop %FORMAT, as nEw.d, nIw or nak'''
+    for kind in 'EIa':
+        if kind in fmt:
+            perLine, width = fmt.split(kind)
+            break
+    perLine = int(perLine)
+    if kind == 'E':
+        width, prec = [int(n) for n in width.split('.')]
+        conv = '%%%i.%iE' % (width, prec)
+    elif kind == 'I':
+        conv = '%%%ii' % int(width)
+    else:
+        conv = '%%-%is' % int(width)
+    if not data:
+        out.write('\n')
+        return
+    for i in range(0, len(data), perLine):
+        out.write(''.join([conv % d for d in data[i:i + perLine]]) + '\n')
+
+
+def ligandFragment():
+    '''Ligand_AC.prmtop and .inpcrd as a Fragment'''
+    reader = PrmtopReader(open(os.path.join(ligandDir, 'Ligand_AC.prmtop')).readlines())
+    get = reader.getSection
+    frag = Fragment()
+    ntypes = get('POINTERS')[1]
+    nbIndex = get('NONBONDED_PARM_INDEX')
+    acoef = get('LENNARD_JONES_ACOEF')
+    bcoef = get('LENNARD_JONES_BCOEF')
+    frag.residues = get('RESIDUE_LABEL')
+    resPointers = get('RESIDUE_POINTER')
+    res = 0
+    for i, (name, charge, mass, aType, typeIdx) in enumerate(
+            zip(get('ATOM_NAME'), get('CHARGE'), get('MASS'), get('AMBER_ATOM_TYPE'),
+                get('ATOM_TYPE_INDEX'))):
+        if res + 1 < len(resPointers) and i + 1 >= resPointers[res + 1]:
+            res += 1
+        frag.atoms.append([name, aType, charge / chargeFactor, mass, res])
+        ico = nbIndex[ntypes * (typeIdx - 1) + typeIdx - 1]
+        A, B = acoef[ico - 1], bcoef[ico - 1]
+        if B:
+            ljParams.setdefault(aType, (0.5 * (2 * A / B) ** (1.0 / 6), 0.25 * B * B / A))
+        else:
+            ljParams.setdefault(aType, (0.0, 0.0))
+    kb, b0 = get('BOND_FORCE_CONSTANT'), get('BOND_EQUIL_VALUE')
+    for flag in ('BONDS_INC_HYDROGEN', 'BONDS_WITHOUT_HYDROGEN'):
+        data = get(flag)
+        for n in range(0, len(data), 3):
+            i, j, idx = data[n:n + 3]
+            frag.bonds.append((i // 3, j // 3, (kb[idx - 1], b0[idx - 1])))
+    kt, t0 = get('ANGLE_FORCE_CONSTANT'), get('ANGLE_EQUIL_VALUE')
+    for flag in ('ANGLES_INC_HYDROGEN', 'ANGLES_WITHOUT_HYDROGEN'):
+        data = get(flag)
+        for n in range(0, len(data), 4):
+            i, j, k, idx = data[n:n + 4]
+            frag.angles.append((i // 3, j // 3, k // 3, (kt[idx - 1], t0[idx - 1])))
+    kp, per, phase = get('DIHEDRAL_FORCE_CONSTANT'), get('DIHEDRAL_PERIODICITY'), get('DIHEDRAL_PHASE')
+    for flag in ('DIHEDRALS_INC_HYDROGEN', 'DIHEDRALS_WITHOUT_HYDROGEN'):
+        data = get(flag)
+        for n in range(0, len(data), 5):
+            i, j, k, l, idx = data[n:n + 5]
+            frag.dihedrals.append((i // 3, j // 3, abs(k) // 3, abs(l) // 3,
+                                   (kp[idx - 1], per[idx - 1], phase[idx - 1]), k < 0, l < 0))
+    coords = decodeInpcrd(open(os.path.join(ligandDir, 'Ligand_AC.inpcrd'), 'rb').read())[0]
+    frag.coords = [tuple(coords[n:n + 3]) for n in range(0, len(coords), 3)]
+    return frag
+
+
+def waterFragment():
+    '''TIP3P, rigid as tleap writes it: 3 bonds and no angle'''
+    frag = Fragment()
+    frag.residues = ['WAT']
+    frag.atoms = [['O', 'OW', -0.834, 16.0, 0], ['H1', 'HW', 0.417, 1.008, 0],
+                  ['H2', 'HW', 0.417, 1.008, 0]]
+    frag.bonds = [(0, 1, (553.0, 0.9572)), (0, 2, (553.0, 0.9572)), (1, 2, (553.0, 1.5136))]
+    frag.coords = [(0.0, 0.0, 0.0), (0.9572, 0.0, 0.0), (-0.2400, 0.9266, 0.0)]
+    return frag
+
+
+def ionFragment(name, charge, mass):
+    frag = Fragment()
+    frag.residues = [name]
+    frag.atoms = [[name, name, charge, mass, 0]]
+    frag.coords = [(0.0, 0.0, 0.0)]
+    return frag
+
+
+def polymerFragment(units):
+    '''H-(CH2)n-H, one residue 'PE' per CH2 unit, a zigzag along x folded
+       every polymerRow units to keep coordinates in the inpcrd field width
+       (the folds are stretched bonds, acpype doesn't mind)'''
+    frag = Fragment()
+    bondCC, bondCH = (303.1, 1.5350), (337.3, 1.0920)
+    angCCC, angCCH, angHCH = [(k, math.radians(t)) for k, t in
+                              ((63.21, 110.63), (46.37, 110.05), (39.43, 108.35))]
+    torsion = (0.1556, 3.0, 0.0)  # X -c3-c3-X
+    carbons = []
+    hydrogens = []  # per carbon
+    for n in range(units):
+        frag.residues.append('PE')
+        row, pos = divmod(n, polymerRow)
+        if row % 2:
+            pos = polymerRow - 1 - pos
+        x = 1.2553 * pos
+        y = 0.8875 * (n % 2) + 4.0 * (row % polymerRow)
+        z = 4.0 * (row // polymerRow)
+        side = -1 if n % 2 else 1
+        c = len(frag.atoms)
+        ends = int(n == 0) + int(n == units - 1)
+        frag.atoms.append(['C1', 'c3', -0.2 - 0.1 * ends, 12.01, n])
+        frag.coords.append((x, y, z))
+        names = ['H1', 'H2', 'H3', 'H4'][:2 + ends]
+        hs = []
+        for m, hName in enumerate(names):
+            hs.append(len(frag.atoms))
+            frag.atoms.append([hName, 'hc', 0.1, 1.008, n])
+            if m < 2:
+                frag.coords.append((x, y + 0.63 * side, z + 0.89 * (1 - 2 * m)))
+            else:  # chain ends
+                frag.coords.append((x + (-1.03 if n == 0 and m == 2 else 1.03), y - 0.36 * side, z))
+        carbons.append(c)
+        hydrogens.append(hs)
+    neighbours = dict([(c, list(hs)) for c, hs in zip(carbons, hydrogens)])
+    for n, c in enumerate(carbons):
+        for h in hydrogens[n]:
+            frag.bonds.append((c, h, bondCH))
+        if n:
+            frag.bonds.append((carbons[n - 1], c, bondCC))
+            neighbours[carbons[n - 1]].append(c)
+            neighbours[c].append(carbons[n - 1])
+    for c in carbons:
+        nb = neighbours[c]
+        for a in range(len(nb)):
+            for b in range(a + 1, len(nb)):
+                i, k = nb[a], nb[b]
+                nC = int(i in neighbours) + int(k in neighbours)
+                frag.angles.append((i, c, k, [angHCH, angCCH, angCCC][nC]))
+    for n in range(1, units):
+        j, k = carbons[n - 1], carbons[n]
+        for i in neighbours[j]:
+            if i == k:
+                continue
+            for l in neighbours[k]:
+                if l != j:
+                    frag.dihedrals.append((i, j, k, l, torsion, False, False))
+    return frag
+
+
+def makeWaterSystem(natoms, title='SYS'):
+    '''Ligand_AC, counter ions, ~0.15 M NaCl and TIP3P waters up to natoms'''
+    ligand = ligandFragment()
+    system = SyntheticSystem(title)
+    system.addFragment(ligand)
+    ligCharge = int(round(sum([a[2] for a in ligand.atoms])))
+    nLeft = max(natoms - len(ligand.atoms), 0)
+    nPairs = int(nLeft * ionsPerWater / 3)
+    nWat = max((nLeft - 2 * nPairs - abs(ligCharge)) // 3, 0)
+    nNa = nPairs + max(-ligCharge, 0)
+    nCl = nPairs + max(ligCharge, 0)
+    # lattice sites out of the ligand bounding box
+    xyz = list(zip(*ligand.coords))
+    low = [min(c) - watSpacing for c in xyz]
+    high = [max(c) + watSpacing for c in xyz]
+    nSites = nWat + nNa + nCl
+    side = 1
+    while side ** 3 - freeSitesMissing(side, low, high) < nSites:
+        side += 1
+    sites = []
+    for i in range(side):
+        for j in range(side):
+            for k in range(side):
+                p = (i * watSpacing, j * watSpacing, k * watSpacing)
+                if not all([low[d] <= p[d] <= high[d] for d in range(3)]):
+                    sites.append(p)
+    sites = sites[:nSites]
+    na = ionFragment('Na+', 1.0, 22.99)
+    cl = ionFragment('Cl-', -1.0, 35.45)
+    water = waterFragment()
+    step = max(len(sites) // max(nNa + nCl, 1), 1)
+    ionSites = sites[::step][:nNa + nCl]
+    ionSet = set(ionSites)
+    for p in ionSites[:nNa]:
+        system.addFragment(na, p)
+    for p in ionSites[nNa:]:
+        system.addFragment(cl, p)
+    for p in sites:
+        if p not in ionSet:
+            system.addFragment(water, p)
+    boxSide = side * watSpacing
+    system.box = (boxSide, boxSide, boxSide)
+    return system
+
+
+def freeSitesMissing(side, low, high):
+    '''lattice sites of a side^3 cube falling in the ligand box'''
+    count = 1
+    for d in range(3):
+        count *= len([i for i in range(side) if low[d] <= i * watSpacing <= high[d]])
+    return count
+
+
+def makePolymerSystem(natoms, title='SYS'):
+    system = SyntheticSystem(title)
+    system.addFragment(polymerFragment(max((natoms - 2) // 3, 2)))
+    return system
+
+
+systemMakers = {'water': makeWaterSystem, 'polymer': makePolymerSystem}
+
+
+def writeSystem(kind, natoms, baseName):
+    '''writes baseName.prmtop and baseName.inpcrd, returns the number of atoms'''
+    system = systemMakers[kind](natoms, title=os.path.basename(baseName))
+    system.writePrmtop(baseName + '.prmtop')
+    system.writeInpcrd(baseName + '.inpcrd')
+    return len(system.atoms)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (3, 4) or sys.argv[1] not in systemMakers:
+        sys.exit("usage: synthetic_systems.py %s natoms [basename]" % '|'.join(sorted(systemMakers)))
+    kind = sys.argv[1]
+    natoms = int(float(sys.argv[2]))
+    baseName = len(sys.argv) == 4 and sys.argv[3] or '%s_%i' % (kind, natoms)
+    n = writeSystem(kind, natoms, baseName)
+    print("%s.prmtop and %s.inpcrd written, %i atoms" % (baseName, baseName, n))
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+# usage: python -m pytest test/test_parm_library.py (or run it directly)
+#
+# ParmLibrary checks on the leap parm files shipped in ffamber_additions:
+# lookup with reversed keys, frcmod entries overriding those of the .dat,
+# impropers kept as given and the write -> readParmDat round trip.
+
+import sys
+import os
+import shutil
+import tempfile
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(testDir))
+
+from acpype import readParmDat, readFrcmod, writeParmMerge  # @UnresolvedImport
+
+ffDir = os.path.join(os.path.dirname(testDir), 'ffamber_additions')
+gaffDat = os.path.join(ffDir, 'parm10gaff.dat')
+sbDat = os.path.join(ffDir, 'parm99SBgaff.dat')
+ligandFrcmod = os.path.join(testDir, 'Data', 'Ligand.acpype', 'Ligand_AC.frcmod')
+
+# a frcmod giving new values, with the atom types reversed, to entries of parm10gaff.dat
+frcmodText = '''remark: new values for entries of parm10gaff.dat
+MASS
+
+BOND
+ca-c3  300.0    1.5000       test
+
+ANGL
+n -cc-c     70.000     117.000   test
+
+DIHE
+
+IMPROPER
+ha-ca-ca-ca         1.5          180.0         2.0          test
+
+NONBON
+
+'''
+
+
+def mergeToFile(fdat2, frcmod, tmpDir):
+    mname = os.path.join(tmpDir, 'merged.dat')
+    mdatFile = open(mname, 'w')
+    try:
+        writeParmMerge(mdatFile, gaffDat, fdat2, frcmod, 'merged test')
+    finally:
+        mdatFile.close()
+    return mname
+
+
+def writeFrcmod(tmpDir):
+    fname = os.path.join(tmpDir, 'test.frcmod')
+    open(fname, 'w').write(frcmodText)
+    return fname
+
+
+def test_reversed_key_lookup():
+    lib = readParmDat(gaffDat)
+    bond = lib.getEntry('BOND', ('ca', 'c3'))
+    assert bond == lib.getEntry('BOND', ('c3', 'ca'))
+    assert bond[0].startswith('c3-ca  323.5    1.5130')
+    # 'c -cc-n' comes first in the file, its reversed 'n -cc-c' is the same angle
+    angle = lib.getEntry('ANGL', ('n', 'cc', 'c'))
+    assert len(angle) == 1 and angle[0].startswith('c -cc-n    68.110     116.330')
+    assert ('c', 'cc', 'n') in lib.order['ANGL']
+    assert ('n', 'cc', 'c') not in lib.order['ANGL']
+    # 'no-os' is twice in the file, only the first is kept
+    assert len(lib.getEntry('BOND', ('os', 'no'))) == 1
+    # wildcards of leap for dihedrals
+    assert lib.getEntry('DIHE', ('ha', 'ca', 'ca', 'ha'))[0].startswith('X -ca-ca-X')
+
+
+def test_frcmod_overrides_dat():
+    tmpDir = tempfile.mkdtemp(prefix='acpype_parm_')
+    try:
+        lib = readParmDat(gaffDat)
+        pos = lib.order['BOND'].index(('c3', 'ca'))
+        numBonds = len(lib.order['BOND'])
+        lib.merge(readFrcmod(writeFrcmod(tmpDir)), override=True)
+        # replaced in place, not appended
+        assert lib.order['BOND'].index(('c3', 'ca')) == pos
+        assert len(lib.order['BOND']) == numBonds
+        assert lib.getEntry('BOND', ('c3', 'ca')) == ['ca-c3  300.0    1.5000       test']
+        assert lib.getEntry('ANGL', ('c', 'cc', 'n')) == ['n -cc-c     70.000     117.000   test']
+
+        merged = readParmDat(mergeToFile(writeFrcmod(tmpDir), True, tmpDir))
+        assert merged.title == 'merged test'
+        assert merged.getEntry('BOND', ('ca', 'c3')) == ['ca-c3  300.0    1.5000       test']
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+def test_improper_not_canonicalised():
+    lib = readParmDat(gaffDat)
+    assert lib.getKey('IMPR', ('ha', 'ca', 'ca', 'ca')) == ('ha', 'ca', 'ca', 'ca')
+    assert lib.getKey('DIHE', ('ha', 'ca', 'ca', 'ca')) == ('ca', 'ca', 'ca', 'ha')
+    lib.merge(readFrcmod(ligandFrcmod), override=True)
+    assert lib.getEntry('IMPR', ('n', 'n', 'c', 'o'))[0].startswith('n -n -c -o         10.5')
+    assert ('n', 'n', 'c', 'o') in lib.order['IMPR']
+    assert ('o', 'c', 'n', 'n') not in lib.order['IMPR']
+    # 'ca-ca-ca-ha' of the frcmod is its own entry, its reverse is not the same improper
+    assert lib.getEntry('IMPR', ('ca', 'ca', 'ca', 'ha'))[0].startswith('ca-ca-ca-ha         1.1')
+    assert lib.getEntry('IMPR', ('ha', 'ca', 'ca', 'ca')) is None
+    assert lib.getEntry('IMPR', ('ca', 'ca', 'ca', 'ha')) != lib.getEntry('IMPR', ('c', 'ca', 'ca', 'ha'))
+    assert lib.getEntry('IMPR', ('c', 'ca', 'ca', 'ha'))[0].startswith('X -X -ca-ha')
+
+
+def test_write_read_round_trip():
+    tmpDir = tempfile.mkdtemp(prefix='acpype_parm_')
+    try:
+        for fdat2, frcmod in ((sbDat, False), (ligandFrcmod, True), (writeFrcmod(tmpDir), True)):
+            lib = readParmDat(gaffDat)
+            if frcmod:
+                lib.merge(readFrcmod(fdat2), override=True)
+            else:
+                lib.merge(readParmDat(fdat2))
+            lib.title = 'merged test'
+            back = readParmDat(mergeToFile(fdat2, frcmod, tmpDir))
+            assert back.title == lib.title
+            assert back.hydrophilic == lib.hydrophilic
+            assert back.nonbHeader == lib.nonbHeader
+            assert back.tail == lib.tail
+            for block in lib.blockNames:
+                assert back.order[block] == lib.order[block], block
+                assert back.entries[block] == lib.entries[block], block
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+def test_merge_dat_keeps_first():
+    lib = readParmDat(gaffDat)
+    sb = readParmDat(sbDat)
+    numMass = len(lib.order['MASS'])
+    lib.merge(sb)
+    # only the types missing in parm10gaff.dat are added, e.g. the ions of parm99SB
+    added = [key for key in sb.order['MASS'] if key not in readParmDat(gaffDat).entries['MASS']]
+    assert added and ('IM',) in added
+    assert len(lib.order['MASS']) == numMass + len(added)
+    assert lib.order['MASS'][-len(added):] == added
+    for atomType in sb.hydrophilic:
+        assert atomType in lib.hydrophilic
+
+
+if __name__ == '__main__':
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print("%s ok" % name)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+# usage: python -m pytest test/test_read_atoms.py (or run it directly)
+#
+# readMdlAtoms and readInputAtoms on the glycine zwitterion fixtures
+# gly_v2000.mdl and gly_v3000.sdf: atoms are named element + count, residue
+# 'MOL' and charge the formal one, as antechamber -fi mdl gives them.
+
+import sys
+import os
+import shutil
+import tempfile
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(testDir))
+
+from acpype import readMdlAtoms, readInputAtoms  # @UnresolvedImport
+
+v2000 = os.path.join(testDir, 'gly_v2000.mdl')
+v3000 = os.path.join(testDir, 'gly_v3000.sdf')
+
+glyNames = ['N1', 'C1', 'C2', 'O1', 'O2', 'H1', 'H2', 'H3', 'H4', 'H5']
+glyCoords = [(1.4238, 0.0471, -0.0183), (0.0, 0.0, 0.0), (-0.5227, -1.4246, 0.0321),
+             (-1.7621, -1.5622, 0.0456), (0.3129, -2.3559, 0.0408), (1.7669, 1.0098, -0.0408),
+             (1.7763, -0.4329, 0.818), (1.7568, -0.4537, -0.8456), (-0.3583, 0.5286, 0.8867),
+             (-0.3464, 0.516, -0.8977)]
+glyCharges = [1.0, 0.0, 0.0, 0.0, -1.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+
+
+def checkGly(atoms):
+    assert [atom[0] for atom in atoms] == glyNames
+    assert set([atom[1] for atom in atoms]) == set(['MOL'])
+    for atom, xyz in zip(atoms, glyCoords):
+        assert max([abs(a - b) for a, b in zip(atom[2], xyz)]) < 1e-6
+    assert [atom[3] for atom in atoms] == glyCharges
+
+
+def test_v2000():
+    atoms = readMdlAtoms(v2000)
+    checkGly(atoms)
+    # 'M  CHG' supersedes the charge codes of the atom block, C1 has code 3 (+1)
+    assert atoms[1][3] == 0.0
+
+
+def test_v2000_charge_codes():
+    tmpDir = tempfile.mkdtemp(prefix='acpype_mdl_')
+    try:
+        fileName = os.path.join(tmpDir, 'gly.mol')
+        lines = [line for line in open(v2000) if not line.startswith('M  CHG')]
+        open(fileName, 'w').write(''.join(lines))
+        charges = [atom[3] for atom in readInputAtoms(fileName)]
+        assert charges == [0.0, 1.0] + [0.0] * 8
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+def test_v3000():
+    # CHG= of the atom lines; only the first record of the sdf is read
+    checkGly(readMdlAtoms(v3000))
+
+
+def test_read_input_atoms():
+    assert readInputAtoms(v2000) == readMdlAtoms(v2000)
+    assert readInputAtoms(v3000) == readMdlAtoms(v3000)
+    try:
+        readInputAtoms(os.path.join(testDir, 'gly.xyz'))
+    except Exception as e:
+        assert 'unknown extension' in str(e)
+    else:
+        assert False, "no exception for an unknown extension"
+
+
+if __name__ == '__main__':
+    for name, func in sorted(globals().items()):
+        if name.startswith('test_') and callable(func):
+            func()
+            print("%s ok" % name)